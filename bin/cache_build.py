@@ -1,36 +1,27 @@
 #!/usr/bin/env python3
 import argparse
-import math
-import time
-import urllib.request
-
-
-def build_cache(base_url: str, start_level: int = 0, end_level: int = 10) -> int:
-    """Send initial requests to build up the cache
-
-    :param base_url: Base URL to hit
-    :param start_level: Start Z level (defaults to 0)
-    :param end_level: End Z level (defaults to 10)
-    :return: How many tiles were cached
-    """
-    num_tiles_cached = 0
-    for z in range(start_level, end_level + 1):
-        for x in range(int(math.pow(2, z))):
-            for y in range(int(math.pow(2, z))):
-                url = f"{base_url}/{z}/{x}/{y}.png"
-                with urllib.request.urlopen(url):
-                    num_tiles_cached += 1
-                    print(url)
-    return num_tiles_cached
+import json
+from pathlib import Path
+
+from elastic_datashader.warm import WORLD, Checkpoint, TileRenderer, enumerate_tiles, fetch_tile, geojson_bboxes, warm_tiles
+
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Request TMS tiles to build up the cache"
+        description="Request or render TMS tiles to build up the cache"
+    )
+    parser.add_argument(
+        "target",
+        type=str,
+        help="Base URL of a layer's index to request tiles from, such as http://localhost:6002/tms/my-index, "
+             "or an index pattern to render tiles for in this process",
     )
     parser.add_argument(
-        "base_url",
+        "-q",
+        "--query",
         type=str,
-        help="Base URL to request without the tile z/x/y information",
+        default="",
+        help="Layer parameters as a query string, as Kibana sends them with tile requests",
     )
     parser.add_argument(
         "-l",
@@ -46,17 +37,72 @@ def main():
         default=0,
         help="Min level to descend to (default 0)",
     )
+    parser.add_argument(
+        "-b",
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="Only warm tiles intersecting this bounding box",
+    )
+    parser.add_argument(
+        "-g",
+        "--geojson",
+        type=Path,
+        help="Only warm tiles intersecting the bounding boxes of this GeoJSON file's geometries",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Tiles requested or rendered at once (default 4)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        help="File recording warmed tiles, which a rerun skips",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=300,
+        help="Seconds to wait for each requested tile (default 300)",
+    )
     args = parser.parse_args()
 
-    s1 = time.time()
-    num_tiles = build_cache(
-        args.base_url,
-        start_level=args.start_level,
-        end_level=args.end_level
-    )
-    duration = time.time() - s1
-    per_tile = duration / num_tiles
-    print(f"Took {duration} sec for {num_tiles} tiles ({per_tile} s/tile)")
+    if args.geojson:
+        bboxes = geojson_bboxes(json.loads(args.geojson.read_text(encoding="utf-8")))
+    elif args.bbox:
+        bboxes = [tuple(args.bbox)]
+    else:
+        bboxes = [WORLD]
+
+    if args.target.startswith(("http://", "https://")):
+        tiles = enumerate_tiles(bboxes, args.start_level, args.end_level)
+        layer = f"{args.target}?{args.query}"
+
+        def warm_tile(tile):
+            return fetch_tile(args.target, args.query, tile, args.timeout)
+    else:
+        # Rendering here knows where the layer's data is, so skips tiles without any
+        warm_tile = TileRenderer(args.target, args.query)
+        tiles = enumerate_tiles(bboxes, args.start_level, args.end_level, warm_tile.data_bounds(), warm_tile.density())
+        layer = f"{args.target} {warm_tile.parameter_hash}"
+
+    def progress(tile, ok, latency):
+        print(f"{tile.z}/{tile.x}/{tile.y} {'ok' if ok else 'failed'} {latency:.2f}s")
+
+    checkpoint = Checkpoint(args.checkpoint, layer) if args.checkpoint else None
+
+    try:
+        stats = warm_tiles(tiles, warm_tile, args.concurrency, checkpoint, progress)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    print(stats.summary())
 
 if __name__ == "__main__":
     main()
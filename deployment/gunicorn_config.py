@@ -8,6 +8,12 @@ from datetime import datetime
 accesslog = "-"
 errorlog = "-"
 
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges from the shared Prometheus metrics
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
 def pre_request(worker, req):
     worker.current_request = req
 
@@ -1,4 +1,3 @@
-from asyncio import sleep
 from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from os import scandir
@@ -7,6 +6,7 @@ import os
 from contextlib import suppress
 from pathlib import Path
 from shutil import rmtree
+from threading import get_ident
 from time import time
 from typing import Dict, Iterable, Optional
 
@@ -44,6 +44,14 @@ def get_index_hash(idx: str) -> str:
     return idx_hash
 
 def tile_name(idx, x, y, z, parameter_hash) -> str:
+    '''
+    Cache key of a tile, which is also its path in the filesystem cache
+
+    The ``.png`` suffix is part of the key rather than the image type: the
+    tile format is a hashed parameter, so a WebP or palette PNG tile is
+    cached under its own parameter hash with the same suffix.  Read the
+    format from the layer's parameters, not from the file name.
+    '''
     idx_hash = get_index_hash(idx)
     return f"{idx_hash}/{parameter_hash}/{z}/{x}/{y}.png"
 
@@ -84,13 +92,14 @@ def du(path: Path) -> str:
     """
     return naturalsize(directory_size(path), gnu=True)
 
-def cache_entry_exists(cache_path: Path, tile: str) -> bool:
+def cache_entry_exists(cache_path: Path, tile: str, max_age: Optional[float] = None) -> bool:
+    """Whether a tile is cached and younger than ``max_age`` seconds (defaults to the cache timeout)"""
     tile_path = cache_path / tile
 
     if not tile_path.exists():
         return False
 
-    if path_age(datetime.now(timezone.utc), tile_path) > config.cache_timeout:
+    if path_age(datetime.now(timezone.utc), tile_path) > (config.cache_timeout if max_age is None else timedelta(seconds=max_age)):
         return False
 
     return True
@@ -122,8 +131,11 @@ def set_cache(cache_path: Path, tile: str, img: bytes) -> None:
     # Make the directory if it doesn't already exist
     tile_path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Write the file to the cache
-    tile_path.write_bytes(img)
+    # Write the file to the cache, replacing any existing tile atomically so
+    # a stale tile can keep being served while it is re-rendered
+    tmp_path = tile_path.with_name(f"{tile_path.name}.{os.getpid()}.{get_ident()}.tmp")
+    tmp_path.write_bytes(img)
+    os.replace(tmp_path, tile_path)
 
 def claim_cache_placeholder(cache_path: Path, tile: str) -> bool:
     """
@@ -202,23 +214,6 @@ def get_idx_names(cache_path: Path) -> Iterable[str]:
         if path.is_dir():
             yield path.name
 
-async def background_cache_cleanup():
-    while True:
-        try:
-            logger.info("Starting background cache cleanup")
-            cache_cleanup_start = time()
-
-            for idx_name in get_idx_names(config.cache_path):
-                age_off_cache(config.cache_path, idx_name, config.cache_timeout)
-
-            cache_cleanup_end = time()
-            logger.info("Finished background cache cleanup in %ss", cache_cleanup_end-cache_cleanup_start)
-            await sleep(config.cache_cleanup_interval.total_seconds())
-
-        except Exception as ex:  # pylint: disable=W0703
-            # ensure this loop never dies
-            logger.error(str(ex))
-
 def build_layer_info(cache_path: Path) -> Dict[str, OrderedDict]:
     """Build up dictionary of layer info
 
@@ -0,0 +1,668 @@
+"""
+cache_backends.py contains the tile cache stores.  Tiles are addressed by
+index, tile coordinates and parameter hash, so callers don't depend on how
+a store lays tiles out on disk.
+"""
+from abc import ABC, abstractmethod
+from asyncio import get_running_loop, sleep
+from collections import OrderedDict
+from datetime import timedelta
+from pathlib import Path
+from time import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import sqlite3
+
+from humanize import naturalsize
+
+from .cache import (
+    cache_entry_exists,
+    cache_placeholder_exists,
+    claim_cache_placeholder,
+    clear_hash_cache,
+    get_cache,
+    get_index_hash,
+    release_cache_placeholder,
+    rendering_tile_name,
+    set_cache,
+    tile_name,
+)
+from .config import Config, config
+from .drawing import TILE_FORMATS
+from .hotcache import HotTileCache, default_hot_cache_path
+from .logger import logger
+from .manifest import (
+    EVICTION_ORDER,
+    CacheManifest,
+    HitCounter,
+    SQLiteConnections,
+    remove_tile_files,
+    select_evictions,
+)
+from .rolling import slice_store
+from .timeutil import pretty_time_delta
+
+# (idx, x, y, z, parameter_hash, img)
+CacheEntry = Tuple[str, int, int, int, str, bytes]
+
+class TileCache(ABC):
+    """Interface for tile cache stores
+
+    ``idx_name`` arguments refer to the hashed index name, as listed by ``index_names``
+    """
+    @abstractmethod
+    def get(self, idx: str, x: int, y: int, z: int, parameter_hash: str) -> Optional[bytes]:
+        """Retrieve a tile, or None if it isn't cached"""
+
+    @abstractmethod
+    def exists(self, idx: str, x: int, y: int, z: int, parameter_hash: str, max_age: Optional[float] = None) -> bool:
+        """Whether a tile is cached and still fresh
+
+        :param max_age: Seconds the tile stays fresh, from its ``CachePolicy``
+            (defaults to the cache timeout)
+        """
+
+    @abstractmethod
+    def created(self, idx: str, x: int, y: int, z: int, parameter_hash: str) -> Optional[float]:
+        """Time a tile was cached, or None if it isn't cached"""
+
+    @abstractmethod
+    def put(
+        self,
+        idx: str,
+        x: int,
+        y: int,
+        z: int,
+        parameter_hash: str,
+        img: bytes,
+        render_time: float = 0.0,
+        keep_until: Optional[float] = None,
+    ) -> None:
+        """Add a tile to the cache
+
+        :param render_time: Seconds the tile took to render, used by the cost eviction policy
+        :param keep_until: Don't age the tile off before this time, for tiles with a long TTL
+        """
+
+    def put_many(self, entries: Iterable[CacheEntry]) -> None:
+        """Add several tiles to the cache"""
+        for entry in entries:
+            self.put(*entry)
+
+    @abstractmethod
+    def claim(self, idx: str, x: int, y: int, z: int, parameter_hash: str) -> bool:
+        """Claim the rendering task for a tile
+
+        :return: True if this call claimed the task, False if it is already claimed
+        """
+
+    @abstractmethod
+    def is_claimed(self, idx: str, x: int, y: int, z: int, parameter_hash: str, max_age: Optional[float] = None) -> bool:
+        """Whether the tile is currently being rendered
+
+        :param max_age: Seconds the tile stays fresh, for stores that know a
+            fresh tile isn't being rendered (defaults to the cache timeout)
+        """
+
+    @abstractmethod
+    def release(self, idx: str, x: int, y: int, z: int, parameter_hash: str) -> None:
+        """Release the claim on a tile's rendering task"""
+
+    @abstractmethod
+    def evict(self, idx_name: str, max_age: timedelta) -> None:
+        """Remove tiles older than ``max_age``, except those with a later ``keep_until``"""
+
+    @abstractmethod
+    def clear(self, idx_name: str, param_hash: Optional[str] = None) -> None:
+        """Remove all tiles for an index, or for one of its parameter hashes"""
+
+    @abstractmethod
+    def index_names(self) -> Iterable[str]:
+        """Hashed names of the cached indices"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, OrderedDict]:
+        """Age and size of each index and parameter hash, newest first"""
+
+    @abstractmethod
+    def size(self) -> int:
+        """Total size of the cache in bytes"""
+
+    def build_index(self) -> None:
+        """Index any tiles cached before the store kept an index"""
+
+    def record_hit(self, idx: str, x: int, y: int, z: int, parameter_hash: str) -> None:
+        """Count a hit on a tile that was served without calling ``get``"""
+
+    @abstractmethod
+    def enforce_capacity(self, max_bytes: int, max_bytes_per_index: int, policy: str) -> None:
+        """Evict tiles until the cache and each index fit within their byte limits
+
+        :param max_bytes: Limit for the whole cache, or 0 for no limit
+        :param max_bytes_per_index: Limit for each index hash, or 0 for no limit
+        :param policy: Which tiles go first, one of ``EVICTION_ORDER``
+        """
+
+class FilesystemTileCache(TileCache):
+    """One file per tile under ``idx_hash/param_hash/z/x/y.png``, with
+    ``.rendering`` placeholder files claiming rendering tasks
+
+    Tiles are recorded in a ``CacheManifest`` so age-off and statistics
+    don't need to walk the directory tree.
+    """
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self.manifest = CacheManifest(cache_path)
+
+    def get(self, idx, x, y, z, parameter_hash):
+        name = tile_name(idx, x, y, z, parameter_hash)
+        img = get_cache(self.cache_path, name)
+
+        if img is not None:
+            self.manifest.record_hit(name)
+
+        return img
+
+    def exists(self, idx, x, y, z, parameter_hash, max_age=None):
+        return cache_entry_exists(self.cache_path, tile_name(idx, x, y, z, parameter_hash), max_age)
+
+    def created(self, idx, x, y, z, parameter_hash):
+        try:
+            return (self.cache_path / tile_name(idx, x, y, z, parameter_hash)).stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def put(self, idx, x, y, z, parameter_hash, img, render_time=0.0, keep_until=None):
+        name = tile_name(idx, x, y, z, parameter_hash)
+        # Record the tile first, so a file is never left where age-off and
+        # eviction can't find it
+        self.manifest.record_put(name, len(img), render_time=render_time, keep_until=keep_until)
+
+        try:
+            set_cache(self.cache_path, name, img)
+        except Exception:
+            # Keep the row of a tile being replaced, whose old file is still there
+            if not (self.cache_path / name).exists():
+                self.manifest.remove([name])
+
+            raise
+
+    def claim(self, idx, x, y, z, parameter_hash):
+        return claim_cache_placeholder(self.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash))
+
+    def is_claimed(self, idx, x, y, z, parameter_hash, max_age=None):
+        return cache_placeholder_exists(self.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash))
+
+    def release(self, idx, x, y, z, parameter_hash):
+        release_cache_placeholder(self.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash))
+
+    def evict(self, idx_name, max_age):
+        keys = self.manifest.expired(idx_name, time() - max_age.total_seconds())
+
+        if keys:
+            logger.info("Aging off %d tiles from %s", len(keys), idx_name)
+            remove_tile_files(self.cache_path, keys)
+            self.manifest.remove(keys)
+
+    def clear(self, idx_name, param_hash=None):
+        clear_hash_cache(self.cache_path, idx_name, param_hash)
+        self.manifest.remove_prefix(idx_name, param_hash)
+
+    def index_names(self):
+        return self.manifest.index_names()
+
+    def stats(self):
+        return self.manifest.stats()
+
+    def size(self):
+        return self.manifest.total_size()
+
+    def build_index(self):
+        if not self.manifest.is_built():
+            self.manifest.build()
+
+    def record_hit(self, idx, x, y, z, parameter_hash):
+        self.manifest.record_hit(tile_name(idx, x, y, z, parameter_hash))
+
+    def enforce_capacity(self, max_bytes, max_bytes_per_index, policy):
+        self.manifest.flush_hits()
+
+        if max_bytes_per_index > 0:
+            for idx_name, size in self.manifest.index_sizes().items():
+                if size > max_bytes_per_index:
+                    self._remove(select_evictions([self.manifest.eviction_candidates(policy, idx_name)], size - max_bytes_per_index))
+
+        if max_bytes > 0:
+            size = self.manifest.total_size()
+
+            if size > max_bytes:
+                self._remove(select_evictions([self.manifest.eviction_candidates(policy)], size - max_bytes))
+
+    def _remove(self, keys: List[str]) -> None:
+        logger.info("Evicting %d tiles from %s to stay within the cache size limits", len(keys), self.cache_path)
+        remove_tile_files(self.cache_path, keys)
+        self.manifest.remove(keys)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (
+    parameter_hash TEXT NOT NULL,
+    zoom_level INTEGER NOT NULL,
+    tile_column INTEGER NOT NULL,
+    tile_row INTEGER NOT NULL,
+    tile_data BLOB NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    render_time REAL NOT NULL DEFAULT 0,
+    keep_until REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS tiles_key ON tiles (parameter_hash, zoom_level, tile_column, tile_row);
+CREATE INDEX IF NOT EXISTS tiles_created ON tiles (created);
+CREATE TABLE IF NOT EXISTS claims (
+    parameter_hash TEXT NOT NULL,
+    zoom_level INTEGER NOT NULL,
+    tile_column INTEGER NOT NULL,
+    tile_row INTEGER NOT NULL,
+    claimed REAL NOT NULL,
+    PRIMARY KEY (parameter_hash, zoom_level, tile_column, tile_row)
+);
+"""
+
+TILE_KEY = "parameter_hash = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?"
+
+def tms_row(y: int, z: int) -> int:
+    """MBTiles rows count from the bottom (TMS) rather than the top (XYZ)"""
+    return (1 << z) - 1 - y
+
+class SQLiteTileCache(TileCache):
+    """One MBTiles-style SQLite database per index hash at ``idx_hash.mbtiles``
+
+    Tiles are keyed by parameter hash and their TMS coordinates, so lookups are
+    index seeks rather than filesystem path walks, and claims are rows in the same
+    database.  Databases run in WAL mode so readers don't block the writer.
+    The ``format`` metadata is that of the default tile format; tiles of other
+    formats are kept under the parameter hashes of the requests for them.
+    """
+    def __init__(self, cache_path: Path, cache_timeout: timedelta, render_timeout: timedelta):
+        self.cache_path = cache_path
+        self.cache_timeout = cache_timeout
+        self.render_timeout = render_timeout
+        self.hits = HitCounter()
+        self._connections = SQLiteConnections(SQLITE_SCHEMA, self._init_metadata)
+
+    def db_path(self, idx_name: str) -> Path:
+        return self.cache_path / f"{idx_name}.mbtiles"
+
+    @staticmethod
+    def _init_metadata(conn: sqlite3.Connection, db_path: Path) -> None:
+        # Once per connection, since even a no-op insert waits on other writers
+        conn.execute(
+            "INSERT OR IGNORE INTO metadata (name, value) VALUES ('name', ?), ('format', ?)",
+            (db_path.stem, TILE_FORMATS[config.tile_format].split("/")[1]),
+        )
+
+    def _connect(self, idx_name: str) -> sqlite3.Connection:
+        return self._connections.get(self.db_path(idx_name))
+
+    def _existing(self, idx_name: str) -> Optional[sqlite3.Connection]:
+        if not self.db_path(idx_name).exists():
+            return None
+
+        return self._connect(idx_name)
+
+    def get(self, idx, x, y, z, parameter_hash):
+        idx_name = get_index_hash(idx)
+        key = (parameter_hash, z, x, tms_row(y, z))
+        row = self._connect(idx_name).execute(f"SELECT tile_data FROM tiles WHERE {TILE_KEY}", key).fetchone()
+
+        if row is None:
+            return None
+
+        self._record_hit(idx_name, key)
+        return row[0]
+
+    def record_hit(self, idx, x, y, z, parameter_hash):
+        self._record_hit(get_index_hash(idx), (parameter_hash, z, x, tms_row(y, z)))
+
+    def _record_hit(self, idx_name: str, key: Tuple) -> None:
+        if self.hits.add((idx_name, *key)):
+            self.flush_hits()
+
+    def flush_hits(self) -> None:
+        batches = {}
+
+        for hits, accessed, (idx_name, *key) in self.hits.drain():
+            batches.setdefault(idx_name, []).append((hits, accessed, *key))
+
+        for idx_name, rows in batches.items():
+            conn = self._connect(idx_name)
+
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(f"UPDATE tiles SET hits = hits + ?, accessed = MAX(accessed, ?) WHERE {TILE_KEY}", rows)
+
+    def exists(self, idx, x, y, z, parameter_hash, max_age=None):
+        if max_age is None:
+            max_age = self.cache_timeout.total_seconds()
+
+        row = self._connect(get_index_hash(idx)).execute(
+            f"SELECT 1 FROM tiles WHERE {TILE_KEY} AND created >= ?",
+            (parameter_hash, z, x, tms_row(y, z), time() - max_age),
+        ).fetchone()
+
+        return row is not None
+
+    def created(self, idx, x, y, z, parameter_hash):
+        row = self._connect(get_index_hash(idx)).execute(
+            f"SELECT created FROM tiles WHERE {TILE_KEY}",
+            (parameter_hash, z, x, tms_row(y, z)),
+        ).fetchone()
+
+        return None if row is None else row[0]
+
+    def put(self, idx, x, y, z, parameter_hash, img, render_time=0.0, keep_until=None):
+        self._insert([(idx, x, y, z, parameter_hash, img, render_time, keep_until)])
+
+    def put_many(self, entries):
+        self._insert((*entry, 0.0, None) for entry in entries)
+
+    def _insert(self, entries: Iterable[Tuple]) -> None:
+        batches = {}
+        now = time()
+
+        for idx, x, y, z, parameter_hash, img, render_time, keep_until in entries:
+            batches.setdefault(get_index_hash(idx), []).append(
+                (parameter_hash, z, x, tms_row(y, z), img, now, now, render_time, keep_until)
+            )
+
+        # One transaction per database, so a batch costs a single WAL sync
+        for idx_name, rows in batches.items():
+            conn = self._connect(idx_name)
+
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tiles "
+                    "(parameter_hash, zoom_level, tile_column, tile_row, tile_data, created, accessed, render_time, keep_until) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+
+    def claim(self, idx, x, y, z, parameter_hash):
+        key = (parameter_hash, z, x, tms_row(y, z))
+        conn = self._connect(get_index_hash(idx))
+
+        # Don't worry about claims that are older than the render timeout
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(f"DELETE FROM claims WHERE {TILE_KEY} AND claimed < ?", (*key, time() - self.render_timeout.total_seconds()))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO claims (parameter_hash, zoom_level, tile_column, tile_row, claimed) VALUES (?, ?, ?, ?, ?)",
+                (*key, time()),
+            )
+
+        return cursor.rowcount == 1
+
+    def is_claimed(self, idx, x, y, z, parameter_hash, max_age=None):
+        row = self._connect(get_index_hash(idx)).execute(
+            f"SELECT 1 FROM claims WHERE {TILE_KEY}",
+            (parameter_hash, z, x, tms_row(y, z)),
+        ).fetchone()
+
+        return row is not None
+
+    def release(self, idx, x, y, z, parameter_hash):
+        self._connect(get_index_hash(idx)).execute(
+            f"DELETE FROM claims WHERE {TILE_KEY}",
+            (parameter_hash, z, x, tms_row(y, z)),
+        )
+
+    def evict(self, idx_name, max_age):
+        conn = self._existing(idx_name)
+
+        if conn is None:
+            return
+
+        now = time()
+        cursor = conn.execute(
+            "DELETE FROM tiles WHERE created < ? AND COALESCE(keep_until, 0) < ?",
+            (now - max_age.total_seconds(), now),
+        )
+
+        if cursor.rowcount > 0:
+            logger.info("Aged off %d tiles from %s", cursor.rowcount, self.db_path(idx_name))
+            conn.execute("PRAGMA incremental_vacuum")
+
+    def clear(self, idx_name, param_hash=None):
+        conn = self._existing(idx_name)
+
+        if conn is None:
+            return
+
+        if param_hash:
+            conn.execute("DELETE FROM tiles WHERE parameter_hash = ?", (param_hash,))
+        else:
+            conn.execute("DELETE FROM tiles")
+
+        conn.execute("PRAGMA incremental_vacuum")
+
+    def index_names(self):
+        for path in self.cache_path.glob("*.mbtiles"):
+            yield path.stem
+
+    def stats(self):
+        self.flush_hits()
+        layer_info = {}
+        now = time()
+
+        for idx_name in self.index_names():
+            rows = self._connect(idx_name).execute(
+                "SELECT parameter_hash, MAX(created), SUM(LENGTH(tile_data)) FROM tiles "
+                "GROUP BY parameter_hash ORDER BY MAX(created) DESC"
+            ).fetchall()
+
+            if rows:
+                layer_info[idx_name] = OrderedDict(
+                    (
+                        param_hash,
+                        {
+                            "age_timestamp": created,
+                            "age": pretty_time_delta(seconds=now-created),
+                            "size": naturalsize(size, gnu=True),
+                        }
+                    )
+                    for param_hash, created, size in rows
+                )
+
+        return layer_info
+
+    def size(self):
+        return sum(path.stat().st_size for path in self.cache_path.glob("*.mbtiles*"))
+
+    def _index_size(self, idx_name: str) -> int:
+        return self._connect(idx_name).execute("SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles").fetchone()[0]
+
+    def _eviction_candidates(self, idx_name: str, policy: str) -> Iterator[Tuple]:
+        order = EVICTION_ORDER[policy].replace("size", "LENGTH(tile_data)")
+        rows = self._connect(idx_name).execute(f"SELECT {order}, LENGTH(tile_data), rowid FROM tiles ORDER BY {order}")
+
+        for *row, rowid in rows:
+            yield (*row, (idx_name, rowid))
+
+    def enforce_capacity(self, max_bytes, max_bytes_per_index, policy):
+        self.flush_hits()
+        sizes = {idx_name: self._index_size(idx_name) for idx_name in self.index_names()}
+
+        if max_bytes_per_index > 0:
+            for idx_name, size in sizes.items():
+                if size > max_bytes_per_index:
+                    self._remove(select_evictions([self._eviction_candidates(idx_name, policy)], size - max_bytes_per_index))
+                    sizes[idx_name] = self._index_size(idx_name)
+
+        size = sum(sizes.values())
+
+        if 0 < max_bytes < size:
+            candidates = [self._eviction_candidates(idx_name, policy) for idx_name in sizes]
+            self._remove(select_evictions(candidates, size - max_bytes))
+
+    def _remove(self, keys: List[Tuple[str, int]]) -> None:
+        batches = {}
+
+        for idx_name, rowid in keys:
+            batches.setdefault(idx_name, []).append((rowid,))
+
+        for idx_name, rows in batches.items():
+            logger.info("Evicting %d tiles from %s to stay within the cache size limits", len(rows), self.db_path(idx_name))
+            conn = self._connect(idx_name)
+
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany("DELETE FROM tiles WHERE rowid = ?", rows)
+
+            conn.execute("PRAGMA incremental_vacuum")
+
+class HotTileCacheLayer(TileCache):
+    """Consults a shared-memory ``HotTileCache`` before the wrapped store
+
+    Tiles read from the store are promoted into the hot cache and new tiles
+    are written through to both.  Hot entries keep the store's creation time
+    so freshness checks give the same answer from either layer.
+    """
+    def __init__(self, store: TileCache, hot: HotTileCache, cache_timeout: timedelta):
+        self.store = store
+        self.hot = hot
+        self.cache_timeout = cache_timeout
+
+    def get(self, idx, x, y, z, parameter_hash):
+        key = tile_name(idx, x, y, z, parameter_hash)
+
+        if (img := self.hot.get(key)) is not None:
+            # Keep the store's hit counts meaningful for its eviction policy
+            self.store.record_hit(idx, x, y, z, parameter_hash)
+            return img
+
+        img = self.store.get(idx, x, y, z, parameter_hash)
+
+        if img is not None:
+            self.hot.put(key, img, self.store.created(idx, x, y, z, parameter_hash))
+
+        return img
+
+    def exists(self, idx, x, y, z, parameter_hash, max_age=None):
+        if max_age is None:
+            max_age = self.cache_timeout.total_seconds()
+
+        if self.hot.get(tile_name(idx, x, y, z, parameter_hash), max_age) is not None:
+            return True
+
+        return self.store.exists(idx, x, y, z, parameter_hash, max_age)
+
+    def created(self, idx, x, y, z, parameter_hash):
+        if (created := self.hot.created(tile_name(idx, x, y, z, parameter_hash))) is not None:
+            return created
+
+        return self.store.created(idx, x, y, z, parameter_hash)
+
+    def put(self, idx, x, y, z, parameter_hash, img, render_time=0.0, keep_until=None):
+        self.store.put(idx, x, y, z, parameter_hash, img, render_time, keep_until)
+        self.hot.put(tile_name(idx, x, y, z, parameter_hash), img)
+
+    def put_many(self, entries):
+        entries = list(entries)
+        self.store.put_many(entries)
+
+        for idx, x, y, z, parameter_hash, img in entries:
+            self.hot.put(tile_name(idx, x, y, z, parameter_hash), img)
+
+    def claim(self, idx, x, y, z, parameter_hash):
+        return self.store.claim(idx, x, y, z, parameter_hash)
+
+    def is_claimed(self, idx, x, y, z, parameter_hash, max_age=None):
+        if max_age is None:
+            max_age = self.cache_timeout.total_seconds()
+
+        # Renders are only claimed once a tile is missing or expired,
+        # so a fresh hot entry means there is no claim to look for
+        if self.hot.get(tile_name(idx, x, y, z, parameter_hash), max_age) is not None:
+            return False
+
+        return self.store.is_claimed(idx, x, y, z, parameter_hash, max_age)
+
+    def release(self, idx, x, y, z, parameter_hash):
+        self.store.release(idx, x, y, z, parameter_hash)
+
+    def evict(self, idx_name, max_age):
+        self.store.evict(idx_name, max_age)
+        self.hot.invalidate(f"{idx_name}/", older_than=time() - max_age.total_seconds())
+
+    def clear(self, idx_name, param_hash=None):
+        self.store.clear(idx_name, param_hash)
+        self.hot.invalidate(f"{idx_name}/{param_hash}/" if param_hash else f"{idx_name}/")
+
+    def index_names(self):
+        return self.store.index_names()
+
+    def stats(self):
+        return self.store.stats()
+
+    def size(self):
+        return self.store.size()
+
+    def build_index(self):
+        self.store.build_index()
+
+    def record_hit(self, idx, x, y, z, parameter_hash):
+        self.store.record_hit(idx, x, y, z, parameter_hash)
+
+    def enforce_capacity(self, max_bytes, max_bytes_per_index, policy):
+        # The hot cache has its own byte budget, and evicted tiles it holds are still valid
+        self.store.enforce_capacity(max_bytes, max_bytes_per_index, policy)
+
+def create_tile_cache(c: Config) -> TileCache:
+    if c.cache_backend == "sqlite":
+        store = SQLiteTileCache(c.cache_path, c.cache_timeout, c.render_timeout)
+    else:
+        store = FilesystemTileCache(c.cache_path)
+
+    if c.hot_cache_bytes > 0:
+        hot = HotTileCache(c.hot_cache_path or default_hot_cache_path(c.cache_path), c.hot_cache_bytes)
+        return HotTileCacheLayer(store, hot, c.cache_timeout)
+
+    return store
+
+tile_cache = create_tile_cache(config)
+
+async def background_cache_cleanup():
+    while True:
+        try:
+            logger.info("Starting background cache cleanup")
+            cache_cleanup_start = time()
+
+            # The store is blocking I/O, so keep it off the event loop
+            loop = get_running_loop()
+            await loop.run_in_executor(None, tile_cache.build_index)
+
+            for idx_name in await loop.run_in_executor(None, tile_cache.index_names):
+                # Expired tiles are kept for the grace period so they can be served while they re-render
+                await loop.run_in_executor(None, tile_cache.evict, idx_name, config.cache_timeout + config.cache_stale_grace)
+
+            if config.rolling_windows:
+                await loop.run_in_executor(None, slice_store.prune, config.cache_timeout)
+
+            if config.cache_max_bytes > 0 or config.cache_max_bytes_per_index > 0:
+                await loop.run_in_executor(
+                    None,
+                    tile_cache.enforce_capacity,
+                    config.cache_max_bytes,
+                    config.cache_max_bytes_per_index,
+                    config.cache_eviction_policy,
+                )
+
+            cache_cleanup_end = time()
+            logger.info("Finished background cache cleanup in %ss", cache_cleanup_end-cache_cleanup_start)
+            await sleep(config.cache_cleanup_interval.total_seconds())
+
+        except Exception as ex:  # pylint: disable=W0703
+            # ensure this loop never dies
+            logger.error(str(ex))
@@ -0,0 +1,62 @@
+"""
+cache_policy.py decides how long a tile stays fresh, in the tile cache and in
+browser and proxy caches, from the time range of its parameters.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from .config import config
+
+# Relative time ranges are quantized to this, so their parameters only map
+# to the same window of time until the next boundary
+QUANTIZE_INTERVAL = timedelta(minutes=5)
+
+@dataclass(frozen=True)
+class CachePolicy:
+    """How long tiles for a parameter set may be cached
+
+    :param time_class: ``historical`` for absolute windows that closed before the
+        cache timeout, ``open`` for absolute windows that may still receive data,
+        or ``relative`` for windows relative to now
+    :param ttl: Seconds a cached tile stays fresh
+    :param window_end: Time the request's parameters move on to the next window
+        of time, for relative ranges
+    """
+    time_class: str
+    ttl: float
+    window_end: Optional[float] = None
+
+    @property
+    def immutable(self) -> bool:
+        """Whether tiles will never change, so clients needn't revalidate them"""
+        return self.time_class == "historical"
+
+    def max_age(self, age: float, now: float) -> int:
+        """Seconds a client may cache a tile that is ``age`` seconds old"""
+        remaining = self.ttl - age
+
+        if self.window_end is not None:
+            remaining = min(remaining, self.window_end - now)
+
+        return max(0, int(remaining))
+
+def get_cache_policy(params: Dict[str, Any], now: Optional[datetime] = None) -> CachePolicy:
+    """Classify a parameter set by its time range
+
+    :param params: Parameters from ``extract_parameters``
+    :param now: Current time (defaults to now)
+    :return: Cache policy for the parameter set's tiles
+    """
+    now = now or datetime.now(timezone.utc)
+    stop_time = params.get("stop_time")
+
+    if params.get("time_relative", True):
+        window_end = (stop_time + QUANTIZE_INTERVAL).timestamp() if stop_time else None
+        return CachePolicy("relative", config.cache_timeout.total_seconds(), window_end)
+
+    # Allow late-arriving data one cache timeout to land before calling a window closed
+    if stop_time is not None and stop_time <= now - config.cache_timeout:
+        return CachePolicy("historical", config.cache_historical_timeout.total_seconds())
+
+    return CachePolicy("open", config.cache_timeout.total_seconds())
@@ -0,0 +1,157 @@
+"""
+cli.py is the ``elastic_datashader`` command, for work done without the server,
+such as rendering a layer's tiles in bulk on every core.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import argparse
+import json
+import os
+import time
+
+import mercantile
+
+from .cache_backends import tile_cache
+from .cache_policy import get_cache_policy
+from .config import config
+from .drawing import TILE_FORMATS
+from .mbtiles import MBTilesWriter
+from .warm import WORLD, BBox, Checkpoint, TileRenderer, enumerate_tiles, geojson_bboxes, warm_tiles
+
+# Each worker process's renderer, set up once by _init_worker
+_renderer: Optional[TileRenderer] = None
+
+def _init_worker(idx: str, query: str, headers: Dict[str, str]) -> None:
+    global _renderer  # pylint: disable=W0603
+    _renderer = TileRenderer(idx, query, headers)
+
+def _render_tile(tile: mercantile.Tile) -> Tuple[bytes, float]:
+    start = time.time()
+    img, _ = _renderer.render(tile)
+    return img, time.time() - start
+
+def parse_headers(headers: List[str]) -> Dict[str, str]:
+    """``Name: value`` strings as a dictionary"""
+    result = {}
+
+    for header in headers:
+        name, sep, value = header.partition(":")
+
+        if not sep:
+            raise ValueError(f"header '{header}' must be formatted as Name: value")
+
+        result[name.strip()] = value.strip()
+
+    return result
+
+def area_bboxes(args: argparse.Namespace) -> List[BBox]:
+    if args.geojson:
+        return geojson_bboxes(json.loads(args.geojson.read_text(encoding="utf-8")))
+
+    if args.bbox:
+        return [tuple(args.bbox)]
+
+    return [WORLD]
+
+def render(args: argparse.Namespace) -> int:
+    """Render a layer's tiles over an area and zoom range in worker processes,
+    into the tile cache or an MBTiles archive"""
+    headers = parse_headers(args.header)
+    renderer = TileRenderer(args.idx, args.query, headers)
+    bboxes = area_bboxes(args)
+    tiles = enumerate_tiles(bboxes, args.start_level, args.end_level, renderer.data_bounds(), renderer.density())
+    checkpoint = Checkpoint(args.checkpoint, f"{args.idx} {renderer.parameter_hash}") if args.checkpoint else None
+
+    if args.mbtiles:
+        bounds = (
+            max(-180.0, min(bbox[0] for bbox in bboxes)),
+            max(-85.051129, min(bbox[1] for bbox in bboxes)),
+            min(180.0, max(bbox[2] for bbox in bboxes)),
+            min(85.051129, max(bbox[3] for bbox in bboxes)),
+        )
+        # The archive's format is the image type, whichever PNG variant encoded it
+        tile_format = TILE_FORMATS[renderer.params["tile_format"]].split("/")[1]
+        # Tiles are checkpointed once they're committed to the archive, so an
+        # interrupted run doesn't skip tiles it lost
+        on_commit = (lambda committed: checkpoint.record(*committed)) if checkpoint is not None else None
+        writer = MBTilesWriter(args.mbtiles, args.idx, tile_format, args.start_level, args.end_level, bounds, on_commit)
+
+        def store(tile: mercantile.Tile, img: bytes, _: float) -> None:
+            writer.put(tile, img)
+    else:
+        writer = None
+        policy = get_cache_policy(renderer.params)
+
+        def store(tile: mercantile.Tile, img: bytes, render_time: float) -> None:
+            keep_until = time.time() + policy.ttl + config.cache_stale_grace.total_seconds()
+            tile_cache.put(args.idx, tile.x, tile.y, tile.z, renderer.parameter_hash, img, render_time, keep_until)
+
+
+    def progress(tile: mercantile.Tile, ok: bool, latency: float) -> None:
+        if args.verbose:
+            print(f"{tile.z}/{tile.x}/{tile.y} {'ok' if ok else 'failed'} {latency:.2f}s")
+
+    # Spawned workers don't inherit the locks and threads of this process
+    with ProcessPoolExecutor(args.processes, mp_context=get_context("spawn"), initializer=_init_worker, initargs=(args.idx, args.query, headers)) as executor:
+        def render_tile(tile: mercantile.Tile) -> bool:
+            img, render_time = executor.submit(_render_tile, tile).result()
+            store(tile, img, render_time)
+            return True
+
+        try:
+            stats = warm_tiles(tiles, render_tile, args.processes, checkpoint, progress, record=writer is None)
+        finally:
+            try:
+                if writer is not None:
+                    writer.close()
+            finally:
+                if checkpoint is not None:
+                    checkpoint.close()
+
+    print(stats.summary())
+    return 1 if stats.failed else 0
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="elastic_datashader", description="Elastic-Datashader TMS server tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    render_parser = commands.add_parser("render", help="Render a layer's tiles without the server")
+    render_parser.set_defaults(func=render)
+    render_parser.add_argument("idx", help="Index pattern to render")
+    render_parser.add_argument(
+        "-q", "--query", default="",
+        help="Layer parameters as a query string, as Kibana sends them with tile requests",
+    )
+    render_parser.add_argument("-s", "--start_level", type=int, default=0, help="Min level to render (default 0)")
+    render_parser.add_argument("-l", "--end_level", type=int, default=10, help="Max level to render (default 10)")
+    render_parser.add_argument(
+        "-b", "--bbox", type=float, nargs=4, metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="Only render tiles intersecting this bounding box",
+    )
+    render_parser.add_argument(
+        "-g", "--geojson", type=Path,
+        help="Only render tiles intersecting the bounding boxes of this GeoJSON file's geometries",
+    )
+    render_parser.add_argument(
+        "-p", "--processes", type=int, default=os.cpu_count() or 1,
+        help="Worker processes rendering tiles (default one per core)",
+    )
+    render_parser.add_argument("-o", "--mbtiles", type=Path, help="Write tiles to this MBTiles archive instead of the tile cache")
+    render_parser.add_argument("--checkpoint", type=Path, help="File recording rendered tiles, which a rerun skips")
+    render_parser.add_argument(
+        "-H", "--header", action="append", default=[],
+        help="Request header for Elasticsearch, such as 'es-security-runas-user: analyst'",
+    )
+    render_parser.add_argument("-v", "--verbose", action="store_true", help="Print each tile as it finishes")
+
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = make_parser().parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    raise SystemExit(main())
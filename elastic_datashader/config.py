@@ -7,30 +7,60 @@ from re import compile as compile_regex
 from socket import getfqdn
 from typing import Any, Dict, Optional
 
+import zlib
+
 import yaml
 
+from .drawing import TILE_FORMATS
+
 BASE64_PATTERN = compile_regex("([A-Za-z0-9+/]{4})*([A-Za-z0-9+/]{3}=|[A-Za-z0-9+/]{2}==)?")
 
+PNG_COMPRESS_TYPES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
 @dataclass(frozen=True)
 class Config:
     allowlist_headers: Optional[str]
     api_key: Optional[str]
+    cache_backend: str
     cache_cleanup_interval: timedelta
+    cache_eviction_policy: str
+    cache_historical_timeout: timedelta
+    cache_max_bytes: int
+    cache_max_bytes_per_index: int
     cache_path: Path
+    cache_stale_grace: timedelta
     cache_timeout: timedelta
+    category_top_k: int
     datashader_headers: Dict[Any, Any]
     elastic_hosts: str
     ellipse_render_mode: str
     ellipse_render_min_zoom: int
     hostname: str
+    hot_cache_bytes: int
+    hot_cache_path: Optional[Path]
     log_level: int
     max_batch: int
     max_bins: int
     max_ellipses_per_tile: int
     max_legend_items_per_tile: int
+    negotiate_tile_format: bool
     num_ellipse_points: int
+    png_compress_level: int
+    png_compress_type: int
+    prefetch: bool
     query_timeout_seconds: int
+    render_threads: int
     render_timeout: timedelta
+    rolling_settle_time: timedelta
+    rolling_windows: bool
+    tile_format: str
+    tile_wait: timedelta
     tms_key: Optional[str]
     use_scroll: bool
     verify_indices: bool
@@ -62,6 +92,27 @@ def get_log_level(level_name: Optional[str]) -> int:
 
     return level_value
 
+def get_png_compress_type(strategy_name: Optional[str]) -> int:
+    if strategy_name is None:
+        return zlib.Z_DEFAULT_STRATEGY
+
+    try:
+        return PNG_COMPRESS_TYPES[strategy_name.lower()]
+    except KeyError as ex:
+        raise ValueError(f"Invalid PNG compression strategy {strategy_name}") from ex
+
+def false_if_none(val: Optional[str]) -> bool:
+    if val is None:
+        return False
+
+    return val.lower() in ("yes", "true", "on")
+
+def optional_path(val: Optional[str]) -> Optional[Path]:
+    if val is None or val == "":
+        return None
+
+    return Path(val)
+
 def true_if_none(val: Optional[str]) -> bool:
     if val is None:
         return True
@@ -84,26 +135,77 @@ def check_config(c: Config) -> None:
     if c.api_key and not is_base64_encoded(c.api_key):
         raise ValueError(f"DATASHADER_ELASTIC_API_KEY '{c.api_key}' does not appear to be base64 encoded")
 
+    if c.cache_backend not in ("filesystem", "sqlite"):
+        raise ValueError(f"DATASHADER_CACHE_BACKEND '{c.cache_backend}' must be filesystem or sqlite")
+
+    if c.cache_eviction_policy not in ("lru", "lfu", "cost"):
+        raise ValueError(f"DATASHADER_CACHE_EVICTION_POLICY '{c.cache_eviction_policy}' must be lru, lfu or cost")
+
+    if c.cache_historical_timeout < c.cache_timeout:
+        raise ValueError(f"DATASHADER_CACHE_HISTORICAL_TIMEOUT '{c.cache_historical_timeout}' must be at least DATASHADER_CACHE_TIMEOUT")
+
+    if c.cache_stale_grace < timedelta(0):
+        raise ValueError(f"DATASHADER_CACHE_STALE_GRACE '{c.cache_stale_grace}' must not be negative")
+
+    if c.cache_max_bytes < 0 or c.cache_max_bytes_per_index < 0:
+        raise ValueError("DATASHADER_CACHE_MAX_BYTES and DATASHADER_CACHE_MAX_BYTES_PER_INDEX must not be negative")
+
+    if c.category_top_k < 1:
+        raise ValueError(f"DATASHADER_CATEGORY_TOP_K '{c.category_top_k}' must be at least 1")
+
+    if not 0 <= c.png_compress_level <= 9:
+        raise ValueError(f"DATASHADER_PNG_COMPRESS_LEVEL '{c.png_compress_level}' must be between 0 and 9")
+
+    if c.render_threads < 1:
+        raise ValueError(f"DATASHADER_RENDER_THREADS '{c.render_threads}' must be at least 1")
+
+    if c.rolling_settle_time < timedelta(0):
+        raise ValueError(f"DATASHADER_ROLLING_SETTLE_TIME '{c.rolling_settle_time}' must not be negative")
+
+    if c.tile_wait < timedelta(0):
+        raise ValueError(f"DATASHADER_TILE_WAIT '{c.tile_wait}' must not be negative")
+
+    if c.tile_format not in TILE_FORMATS:
+        raise ValueError(f"DATASHADER_TILE_FORMAT '{c.tile_format}' must be one of {', '.join(TILE_FORMATS)}")
+
 def config_from_env(env) -> Config:
     return Config(
         allowlist_headers=env.get("DATASHADER_ALLOWLIST_HEADERS", None),
         api_key=env.get("DATASHADER_ELASTIC_API_KEY", None),
+        cache_backend=env.get("DATASHADER_CACHE_BACKEND", "filesystem"),
         cache_cleanup_interval=timedelta(seconds=int(env.get("DATASHADER_CACHE_CLEANUP_INTERVAL", 5*60))),
+        cache_eviction_policy=env.get("DATASHADER_CACHE_EVICTION_POLICY", "lru").lower(),
+        cache_historical_timeout=timedelta(seconds=int(env.get("DATASHADER_CACHE_HISTORICAL_TIMEOUT", 7*24*60*60))),
+        cache_max_bytes=int(env.get("DATASHADER_CACHE_MAX_BYTES", 0)),
+        cache_max_bytes_per_index=int(env.get("DATASHADER_CACHE_MAX_BYTES_PER_INDEX", 0)),
         cache_path=Path(env.get("DATASHADER_CACHE_DIRECTORY", "tms-cache")),
+        cache_stale_grace=timedelta(seconds=int(env.get("DATASHADER_CACHE_STALE_GRACE", 5*60))),
         cache_timeout=timedelta(seconds=int(env.get("DATASHADER_CACHE_TIMEOUT", 60*60))),
+        category_top_k=int(env.get("DATASHADER_CATEGORY_TOP_K", 16)),
         datashader_headers=load_datashader_headers(env.get("DATASHADER_HEADER_FILE", "headers.yaml")),
         elastic_hosts=env.get("DATASHADER_ELASTIC", "http://localhost:9200"),
         ellipse_render_mode=env.get("DATASHADER_ELLIPSE_RENDER_MODE", "matrix"),
         ellipse_render_min_zoom=env.get("DATASHADER_ELLIPSE_RENDER_MIN_ZOOM", 8),
         hostname=getfqdn(),
+        hot_cache_bytes=int(env.get("DATASHADER_HOT_CACHE_BYTES", 0)),
+        hot_cache_path=optional_path(env.get("DATASHADER_HOT_CACHE_PATH", None)),
         log_level=get_log_level(env.get("DATASHADER_LOG_LEVEL", None)),
         max_batch=int(env.get("DATASHADER_MAX_BATCH", 10_000)),
         max_bins=int(env.get("DATASHADER_MAX_BINS", 10_000)),
         max_ellipses_per_tile=int(env.get("DATASHADER_MAX_ELLIPSES_PER_TILE", 100_000)),
         max_legend_items_per_tile=int(env.get("MAX_LEGEND_ITEMS_PER_TILE", 20)),
+        negotiate_tile_format=false_if_none(env.get("DATASHADER_NEGOTIATE_TILE_FORMAT", None)),
         num_ellipse_points=int(env.get("DATASHADER_NUM_ELLIPSE_POINTS", 100)),
+        png_compress_level=int(env.get("DATASHADER_PNG_COMPRESS_LEVEL", 6)),
+        png_compress_type=get_png_compress_type(env.get("DATASHADER_PNG_COMPRESS_TYPE", None)),
+        prefetch=false_if_none(env.get("DATASHADER_PREFETCH", None)),
         query_timeout_seconds=int(env.get("DATASHADER_QUERY_TIMEOUT", 900)),
+        render_threads=int(env.get("DATASHADER_RENDER_THREADS", 8)),
         render_timeout=timedelta(seconds=int(env.get("DATASHADER_RENDER_TIMEOUT", 30))),
+        rolling_settle_time=timedelta(seconds=int(env.get("DATASHADER_ROLLING_SETTLE_TIME", 5*60))),
+        rolling_windows=false_if_none(env.get("DATASHADER_ROLLING_WINDOWS", None)),
+        tile_format=env.get("DATASHADER_TILE_FORMAT", "png"),
+        tile_wait=timedelta(seconds=int(env.get("DATASHADER_TILE_WAIT", 30))),
         tms_key=env.get("DATASHADER_TMS_KEY", None),
         use_scroll=true_if_none(env.get("DATASHADER_USE_SCROLL", None)),
         verify_indices=true_if_none(env.get("DATASHADER_VERIFY_INDICES", None)),
@@ -0,0 +1,128 @@
+"""
+density.py summarizes where a layer's documents are with one low precision
+geotile_grid aggregation, so tiles can be sized up (or skipped when empty)
+without querying Elasticsearch.
+"""
+from base64 import b64decode, b64encode
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Optional
+
+import copy
+import zlib
+
+import numpy as np
+
+from .logger import logger
+
+# 4**8 cells, which is also the largest bucket count Elasticsearch allows by default
+DENSITY_PRECISION = 8
+
+CELL_DTYPE = np.dtype([("x", "<u4"), ("y", "<u4"), ("count", "<u8")])
+
+class DensityPyramid:
+    """Document counts per geotile at ``precision``, summed up to coarser zooms
+    on demand
+
+    :param cells: Non-empty cells as a ``CELL_DTYPE`` array
+    :param precision: Zoom level of the cells
+    """
+    def __init__(self, cells: np.ndarray, precision: int = DENSITY_PRECISION):
+        self.cells = cells
+        self.precision = precision
+        self._levels: Dict[int, Dict[int, int]] = {}
+
+    @classmethod
+    def from_buckets(cls, buckets: Iterable, precision: int = DENSITY_PRECISION) -> "DensityPyramid":
+        """Build from ``geotile_grid`` buckets keyed ``z/x/y``"""
+        cells = []
+
+        for bucket in buckets:
+            _, x, y = (int(part) for part in bucket.key.split("/"))
+            cells.append((x, y, bucket.doc_count))
+
+        return cls(np.array(cells, dtype=CELL_DTYPE), precision)
+
+    def encode(self) -> Dict[str, Any]:
+        """Compact form to store with the generated parameters"""
+        return {
+            "precision": self.precision,
+            "cells": b64encode(zlib.compress(self.cells.tobytes())).decode("ascii"),
+        }
+
+    def _level(self, z: int) -> Dict[int, int]:
+        # Counts per tile at zoom z, keyed by x << 32 | y
+        if z not in self._levels:
+            shift = np.uint64(self.precision - z)
+            keys = (self.cells["x"].astype(np.uint64) >> shift) << np.uint64(32) | (self.cells["y"].astype(np.uint64) >> shift)
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse, weights=self.cells["count"], minlength=len(unique_keys))
+            self._levels[z] = dict(zip(unique_keys.tolist(), counts.astype(np.int64).tolist()))
+
+        return self._levels[z]
+
+    def is_exact(self, z: int) -> bool:
+        """Whether counts at zoom ``z`` are exact rather than those of an ancestor"""
+        return z <= self.precision
+
+    def tile_count(self, x: int, y: int, z: int) -> int:
+        """Documents in a tile, or in its ancestor at ``precision`` for deeper tiles,
+        so zero always means the tile is empty"""
+        if z > self.precision:
+            shift = z - self.precision
+            x, y, z = x >> shift, y >> shift, self.precision
+
+        return self._level(z).get(x << 32 | y, 0)
+
+    def max_tile_count(self, z: int) -> float:
+        """Documents in the densest tile at zoom ``z``, assuming uniform density
+        within cells for tiles deeper than ``precision``"""
+        level = self._level(min(z, self.precision))
+
+        if not level:
+            return 0
+
+        return max(level.values()) / 4 ** max(0, z - self.precision)
+
+    def occupied_cells(self, x: int, y: int, z: int, precision: int) -> float:
+        """Non-empty geotiles at ``precision`` within a tile, which beyond the
+        pyramid's own precision assumes its cells are entirely occupied"""
+        if z > self.precision:
+            return 4 ** (precision - z) if self.tile_count(x, y, z) else 0
+
+        shift = np.uint32(self.precision - z)
+        within = self.cells[(self.cells["x"] >> shift == x) & (self.cells["y"] >> shift == y)]
+
+        if precision >= self.precision:
+            return len(within) * 4 ** (precision - self.precision)
+
+        shift = np.uint32(self.precision - precision)
+        return len(np.unique((within["x"] >> shift).astype(np.uint64) << np.uint64(32) | (within["y"] >> shift)))
+
+@lru_cache(maxsize=32)
+def _decode(precision: int, cells: str) -> DensityPyramid:
+    return DensityPyramid(np.frombuffer(zlib.decompress(b64decode(cells)), dtype=CELL_DTYPE), precision)
+
+def load_density(encoded: Optional[Dict[str, Any]]) -> Optional[DensityPyramid]:
+    """Decode a pyramid stored with the generated parameters, if there is one"""
+    if not encoded:
+        return None
+
+    return _decode(encoded["precision"], encoded["cells"])
+
+def fetch_density(base_s, geopoint_field: str) -> Optional[DensityPyramid]:
+    """Aggregate a layer's document counts per geotile
+
+    :param base_s: Search for the layer's documents
+    :param geopoint_field: geo_point field to aggregate
+    :return: Density pyramid, or None if the aggregation failed
+    """
+    density_s = copy.copy(base_s)[0:0]
+    density_s.aggs.bucket("density", "geotile_grid", field=geopoint_field, precision=DENSITY_PRECISION, size=4 ** DENSITY_PRECISION)
+
+    try:
+        resp = density_s.execute()
+    except Exception as ex:  # pylint: disable=W0703
+        logger.warning("Failed to build density pyramid: %s", ex)
+        return None
+
+    return DensityPyramid.from_buckets(resp.aggregations.density.buckets)
@@ -1,8 +1,9 @@
 from functools import lru_cache
 from hashlib import sha256
-from typing import Dict, Iterable, Tuple
+from typing import Dict, Iterable, Optional, Tuple
 
 import io
+import zlib
 
 from PIL import Image, ImageDraw
 from colorcet import palette
@@ -13,6 +14,13 @@ import numpy as np
 
 from .constants import METERS_PER_DEG_LAT
 
+TILE_FORMATS = {
+    "png": "image/png",
+    "png-fast": "image/png",
+    "png8": "image/png",
+    "webp": "image/webp",
+}
+
 def force_within_range(val: int, lower_inclusive: int, upper_exclusive: int) -> int:
     return max(lower_inclusive, min(val, upper_exclusive-1))
 
@@ -176,6 +184,84 @@ def gen_debug_overlay(img: bytes, text: str) -> bytes:
         return output.getvalue()
 
 
+def apply_overlays(
+    rgba: np.ndarray,
+    overlay_color: Optional[Tuple[int, int, int, int]] = None,
+    debug_text: Optional[str] = None,
+    thickness: int = 8,
+) -> np.ndarray:
+    """Composite the hatch and debug overlays onto a raster in memory
+
+    :param rgba: (H, W, 4) uint8 array with the first row at the top
+    :param overlay_color: Color of the hatch overlay (None for no hatching)
+    :param debug_text: Text for the debug frame (None for no debug frame)
+    :param thickness: Thickness of the hatch lines
+    :return: (H, W, 4) uint8 array
+    """
+    if overlay_color is None and debug_text is None:
+        return rgba
+
+    out = Image.fromarray(rgba)
+
+    if overlay_color is not None:
+        out = Image.alpha_composite(out, gen_overlay_img(*out.size, thickness=thickness, color=overlay_color))
+
+    if debug_text is not None:
+        out = Image.alpha_composite(out, gen_debug_img(*out.size, debug_text))
+
+    return np.asarray(out)
+
+
+def encode_png(rgba: np.ndarray, compress_level: int = 6, compress_type: int = zlib.Z_DEFAULT_STRATEGY) -> bytes:
+    """Encode an RGBA array as a PNG
+
+    :param rgba: (H, W, 4) uint8 array with the first row at the top
+    :param compress_level: zlib compression level, 0 (none) to 9 (smallest)
+    :param compress_type: zlib compression strategy
+    :return: PNG image bytes
+    """
+    with io.BytesIO() as output:
+        Image.fromarray(rgba).save(output, format="PNG", compress_level=compress_level, compress_type=compress_type)
+        return output.getvalue()
+
+
+def encode_tile(
+    rgba: np.ndarray,
+    tile_format: str = "png",
+    compress_level: int = 6,
+    compress_type: int = zlib.Z_DEFAULT_STRATEGY,
+) -> bytes:
+    """Encode an RGBA array in one of the ``TILE_FORMATS``
+
+    "png" is a full-color PNG with the given compression, "png-fast" is a full-color PNG
+    at the fastest deflate level, "png8" is a palette PNG quantized to 256 colors and
+    "webp" is a lossless WebP
+
+    :param rgba: (H, W, 4) uint8 array with the first row at the top
+    :param tile_format: Name of the output format
+    :param compress_level: zlib compression level for "png" and "png8"
+    :param compress_type: zlib compression strategy for "png" and "png8"
+    :return: Image bytes
+    """
+    if tile_format == "png":
+        return encode_png(rgba, compress_level, compress_type)
+
+    if tile_format == "png-fast":
+        return encode_png(rgba, 1, zlib.Z_DEFAULT_STRATEGY)
+
+    with io.BytesIO() as output:
+        if tile_format == "png8":
+            img = Image.fromarray(rgba).quantize(256, method=Image.Quantize.FASTOCTREE)
+            img.save(output, format="PNG", compress_level=compress_level, compress_type=compress_type)
+        elif tile_format == "webp":
+            # method 0 is the fastest encoder and still well ahead of PNG on size
+            Image.fromarray(rgba).save(output, format="WEBP", lossless=True, quality=50, method=0)
+        else:
+            raise ValueError(f"Invalid tile format {tile_format}")
+
+        return output.getvalue()
+
+
 @lru_cache(10)
 def gen_empty(width: int, height: int) -> bytes:
     """Generate empty image
@@ -191,7 +277,13 @@ def gen_empty(width: int, height: int) -> bytes:
 
 
 @lru_cache(10)
-def generate_x_tile(width: int, height: int, thickness: int=8, color: Tuple[int, int, int, int]=(255, 0, 0, 255)) -> bytes:
+def generate_x_tile(
+    width: int,
+    height: int,
+    thickness: int=8,
+    color: Tuple[int, int, int, int]=(255, 0, 0, 255),
+    tile_format: str = "png",
+) -> bytes:
     """
     Generate a tile with an X drawn over it.
     This can be used to indicate an error (red),
@@ -200,6 +292,7 @@ def generate_x_tile(width: int, height: int, thickness: int=8, color: Tuple[int,
     :param width: Width of image
     :param height: Height of image
     :param thickness: Thickness of the stroke to draw the X
+    :param tile_format: One of the ``TILE_FORMATS``
     :return: image
     """
     overlay = Image.new("RGBA", (width, height))
@@ -209,6 +302,9 @@ def generate_x_tile(width: int, height: int, thickness: int=8, color: Tuple[int,
     draw.line([(0, 0), (width, height)], color, thickness)
     draw.line([(width, 0), (0, height)], color, thickness)
 
+    if tile_format != "png":
+        return encode_tile(np.asarray(overlay), tile_format)
+
     with io.BytesIO() as output:
         overlay.save(output, format="PNG")
         return output.getvalue()
@@ -1,6 +1,10 @@
+from collections import OrderedDict
+from contextlib import nullcontext
 from pathlib import Path
+from threading import Lock
 from typing import Any, Dict, List, Optional
 import copy
+import json
 import struct
 import time
 import urllib
@@ -88,6 +92,10 @@ def verify_datashader_indices(elasticsearch_hosts: str):
                         "complete": {
                             "type": "boolean"
                         },
+                        "density": {
+                            "type": "object",
+                            "enabled": False
+                        },
                         "generating_host": {
                             "type": "keyword"
                         },
@@ -133,6 +141,10 @@ def verify_datashader_indices(elasticsearch_hosts: str):
     tile_mapping = {
         "mappings": {
             "properties": {
+                "profile": {
+                    "type": "text",
+                    "index": False
+                },
                 "params": {
                     "properties": {
                         "dsl_filter": {
@@ -172,19 +184,31 @@ def convert_nm_to_ellipse_units(distance: float, units: str) -> float:
     # NB. assume "majmin_m" if any others
     return distance * 1852
 
-def get_search_base(
-    elastic_hosts: str,
-    headers: Optional[str],
-    params: Dict[str, Any],
-    idx: int,
-) -> Search:
-    """
-
-    :param elastic_hosts:
-    :param params:
-    :param idx:
-    :param header_file:
-    :return:
+# Parameters that go into the base query body
+BASE_QUERY_PARAMS = (
+    "timestamp_field",
+    "start_time",
+    "stop_time",
+    "lucene_query",
+    "dsl_query",
+    "dsl_filter",
+    "render_mode",
+    "search_nautical_miles",
+    "ellipse_units",
+    "ellipse_major",
+    "ellipse_minor",
+)
+
+BASE_QUERY_CACHE_SIZE = 256
+
+_base_queries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_base_queries_lock = Lock()
+
+def build_base_query(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the query body that limits a search to a parameter set's documents
+
+    :param params: Parameters from ``extract_parameters``
+    :return: Search body
     """
     timestamp_field = params["timestamp_field"]
     start_time = params["start_time"]
@@ -192,17 +216,8 @@ def get_search_base(
     lucene_query = params["lucene_query"]
     dsl_query = params["dsl_query"]
     dsl_filter = params["dsl_filter"]
-    user = params.get("user")
-    x_opaque_id = params.get("x-opaque-id")
-    # Connect to Elasticsearch
-    es = Elasticsearch(
-        hosts_url_to_nodeconfig(elastic_hosts),
-        timeout=config.query_timeout_seconds,
-        headers=get_es_headers(headers, user, x_opaque_id),
-    )
 
-    # Create base search
-    base_s = Search(index=idx, using=es)
+    base_s = Search()
 
     # Add time bounds
     # Handle time calculations
@@ -230,39 +245,106 @@ def get_search_base(
     if lucene_query:
         base_s = base_s.filter("query_string", query=lucene_query)
 
+    base_dict = base_s.to_dict()
+
     # Add dsl filtering
     if dsl_filter or dsl_query:
-        # Need to convert to a dict, merge with filters then convert back to a search object
-        base_dict = base_s.to_dict()
-
         # setup an empty filter list if necessary
-        if base_dict.get("query", {}).get("bool", {}).get("filter") is None:
-            base_dict["query"]["bool"]["filter"] = []
+        bool_query = base_dict.setdefault("query", {}).setdefault("bool", {})
+        bool_query.setdefault("filter", [])
 
         # Add the dsl_query
         if dsl_query:
-            base_dict["query"]["bool"]["filter"].append(dsl_query)
+            bool_query["filter"].append(dsl_query)
 
         # add dsl_filters
         if dsl_filter:
             for f in dsl_filter["filter"]:
-                base_dict["query"]["bool"]["filter"].append(f)
+                bool_query["filter"].append(f)
 
-            if base_dict.get("query", {}).get("bool", {}).get("must_not") is None:
-                base_dict["query"]["bool"]["must_not"] = []
+            bool_query.setdefault("must_not", [])
 
             for f in dsl_filter["must_not"]:
-                base_dict["query"]["bool"]["must_not"].append(f)
+                bool_query["must_not"].append(f)
 
-        # convert back
-        base_s = Search.from_dict(base_dict).index(idx).using(es)
+    return base_dict
 
-    base_s = base_s.params(ignore_unavailable=True)
+def get_shared_base_query(params: Dict[str, Any]) -> Dict[str, Any]:
+    """``build_base_query``, reusing the body built for earlier requests with
+    the same parameters
 
-    if user:
-        base_s = base_s.params(preference=user)
+    Bodies are checked by parsing them with elasticsearch_dsl when they're
+    built, so DSL it can't parse raises here rather than once a render runs.
+
+    :param params: Parameters from ``extract_parameters``
+    :return: Search body shared with other callers, which mustn't be modified
+    """
+    key = json.dumps([params.get(name) for name in BASE_QUERY_PARAMS], sort_keys=True, default=str)
+
+    with _base_queries_lock:
+        base_dict = _base_queries.get(key)
+
+        if base_dict is not None:
+            _base_queries.move_to_end(key)
+
+    if base_dict is None:
+        base_dict = build_base_query(params)
+        # Raises for queries and filters elasticsearch_dsl doesn't know
+        Search().update_from_dict(base_dict)
 
-    return base_s
+        with _base_queries_lock:
+            _base_queries[key] = base_dict
+
+            while len(_base_queries) > BASE_QUERY_CACHE_SIZE:
+                _base_queries.popitem(last=False)
+
+    return base_dict
+
+def get_base_query(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of the shared base query body, which the caller may modify
+
+    :param params: Parameters from ``extract_parameters``
+    :return: Search body
+    """
+    return copy.deepcopy(get_shared_base_query(params))
+
+def get_search_client(elastic_hosts: str, headers: Optional[str], params: Dict[str, Any]) -> Elasticsearch:
+    """Client for searching on behalf of a request"""
+    return Elasticsearch(
+        hosts_url_to_nodeconfig(elastic_hosts),
+        timeout=config.query_timeout_seconds,
+        headers=get_es_headers(headers, params.get("user"), params.get("x-opaque-id")),
+    )
+
+def get_search_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """URL parameters for every search on behalf of a request"""
+    search_params = {"ignore_unavailable": True}
+
+    if params.get("user"):
+        search_params["preference"] = params["user"]
+
+    return search_params
+
+def get_search_base(
+    elastic_hosts: str,
+    headers: Optional[str],
+    params: Dict[str, Any],
+    idx: int,
+) -> Search:
+    """
+
+    :param elastic_hosts:
+    :param params:
+    :param idx:
+    :param header_file:
+    :return:
+    """
+    # Connect to Elasticsearch
+    es = get_search_client(elastic_hosts, headers, params)
+
+    # Create base search
+    base_s = Search(index=idx, using=es).update_from_dict(get_base_query(params))
+    return base_s.params(**get_search_params(params))
 
 def build_dsl_filter(filter_inputs) -> Optional[Dict[str, Any]]:
     """
@@ -275,7 +357,7 @@ def build_dsl_filter(filter_inputs) -> Optional[Dict[str, Any]]:
     filter_dict = {"filter": [{"match_all": {}}], "must_not": []}
 
     for f in filter_inputs:
-        logger.info("Filter %s\n %s", f.get("meta").get("type"), f)
+        logger.debug("Filter %s\n %s", f.get("meta").get("type"), f)
         # Skip disabled filters
         if f.get("meta").get("disabled") in ("true", True):
             continue
@@ -306,7 +388,7 @@ def build_dsl_filter(filter_inputs) -> Optional[Dict[str, Any]]:
                             filter_dict["must_not"].append({geo_type: f.get(geo_type)})
                         else:
                             filter_dict["filter"].append({geo_type: f.get(geo_type)})
-    logger.info("Filter output %s", filter_dict)
+    logger.debug("Filter output %s", filter_dict)
     return filter_dict
 
 def load_datashader_headers(header_file_path_str: Optional[str]) -> Dict[Any, Any]:
@@ -489,7 +571,7 @@ def bucket_noop(bucket, search):
     # pylint: disable=unused-argument
     return bucket
 class Scan:
-    def __init__(self, searches, inner_aggs=None, field=None, precision=None, size=10, timeout=None, bucket_callback=bucket_noop):
+    def __init__(self, searches, inner_aggs=None, field=None, precision=None, size=10, timeout=None, bucket_callback=bucket_noop, stages=None):
         self.field = field
         self.precision = precision
         self.searches = searches
@@ -506,6 +588,8 @@ class Scan:
         self.bucket_callback = bucket_callback
         if self.bucket_callback is None:
             self.bucket_callback = bucket_noop
+        # Times each search as an aggregation_page stage
+        self.stages = stages
 
     def execute(self):
         """
@@ -525,7 +609,8 @@ class Scan:
             if self.field and self.precision:
                 s.aggs.bucket("comp", "geotile_grid", field=self.field, precision=self.precision, size=self.size)
             # logger.info(json.dumps(s.to_dict(), indent=2, default=str))
-            return s.execute()
+            with self.stages("aggregation_page") if self.stages else nullcontext():
+                return s.execute()
 
         timeout_at = None
         if self.timeout:
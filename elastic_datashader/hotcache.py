@@ -0,0 +1,330 @@
+"""
+hotcache.py contains a tile cache that lives in a shared memory-mapped
+arena, so every worker process on a host can serve popular tiles without
+touching the disk cache.
+"""
+from contextlib import contextmanager
+from hashlib import blake2b
+from os import getpid
+from pathlib import Path
+from threading import Lock
+from time import time, time_ns
+from typing import Iterator, List, Optional, Tuple
+
+import fcntl
+import mmap
+import os
+
+import numpy as np
+
+from .logger import logger
+
+MAGIC = b"DSHOTC01"
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("num_sets", "<u4"),
+    ("ways", "<u4"),
+    ("set_bytes", "<u8"),
+])
+
+ENTRY_DTYPE = np.dtype([
+    ("h1", "<u8"),
+    ("h2", "<u8"),
+    ("offset", "<u4"),
+    ("key_len", "<u4"),
+    ("val_len", "<u4"),
+    ("hits", "<u4"),
+    ("created", "<f8"),
+    ("atime", "<u8"),
+])
+
+# Each set starts with its data tail offset followed by the entry table
+SET_HEADER_BYTES = 8
+
+def default_hot_cache_path(cache_path: Path) -> Path:
+    # Prefer a tmpfs so the hot cache never touches the disk
+    shm_path = Path("/dev/shm")
+
+    if shm_path.is_dir():
+        return shm_path / "elastic_datashader_hot_cache"
+
+    return cache_path / ".hot_cache"
+
+def key_digest(key: bytes) -> Tuple[int, int]:
+    digest = blake2b(key, digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+class HotTileCache:
+    """Byte-budgeted, set-associative tile cache in a shared memory-mapped file
+
+    The arena is split into fixed-size sets.  A key hashes to one set, which holds
+    up to ``ways`` entries and their key and value bytes.  Each set is guarded by
+    an ``fcntl`` byte-range lock (between processes) and a thread lock (within a
+    process), so workers only contend when they touch the same set.  When a set is
+    full its least recently used entries are evicted and the survivors compacted.
+    Keys are stored alongside values so entries can be invalidated by prefix.
+
+    :param path: File backing the arena, ideally on a tmpfs such as /dev/shm
+    :param size_bytes: Total arena size in bytes
+    :param set_bytes: Size of each set in bytes, which caps the size of a single entry
+    :param ways: Maximum number of entries per set
+    """
+    def __init__(self, path: Path, size_bytes: int, set_bytes: int = 1 << 20, ways: int = 64):
+        self.path = path
+        self.num_sets = max(1, size_bytes // set_bytes)
+        self.ways = ways
+        self.set_bytes = set_bytes
+        self.table_bytes = SET_HEADER_BYTES + ways * ENTRY_DTYPE.itemsize
+        self.data_bytes = set_bytes - self.table_bytes
+        self.max_entry_bytes = self.data_bytes // 4
+        self.size_bytes = HEADER_DTYPE.itemsize + self.num_sets * set_bytes
+
+        if self.data_bytes <= 0:
+            raise ValueError(f"Hot cache sets of {set_bytes} bytes are too small for {ways} ways")
+
+        self._pid = None
+        self._fd = None
+        self._mm = None
+        self._locks: List[Lock] = []
+        self._open_lock = Lock()
+
+    def _open(self) -> None:
+        # File descriptors, maps and thread locks must not be shared across a fork
+        if self._pid == getpid():
+            return
+
+        # Only one thread of a process maps the arena, since a second mapping
+        # would replace set locks that the first thread's callers may hold
+        with self._open_lock:
+            if self._pid != getpid():
+                self._map()
+
+    def _map(self) -> None:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX, HEADER_DTYPE.itemsize, 0)
+
+        try:
+            expected = np.array([(MAGIC, self.num_sets, self.ways, self.set_bytes)], dtype=HEADER_DTYPE).tobytes()
+
+            if os.fstat(fd).st_size != self.size_bytes or os.pread(fd, HEADER_DTYPE.itemsize, 0) != expected:
+                logger.info("Initializing hot tile cache %s with %d bytes", self.path, self.size_bytes)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size_bytes)
+                os.pwrite(fd, expected, 0)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_DTYPE.itemsize, 0)
+
+        self._fd = fd
+        self._mm = mmap.mmap(fd, self.size_bytes)
+        self._locks = [Lock() for _ in range(self.num_sets)]
+        self._pid = getpid()
+
+    def _set_start(self, set_index: int) -> int:
+        return HEADER_DTYPE.itemsize + set_index * self.set_bytes
+
+    def _entries(self, set_index: int) -> np.ndarray:
+        return np.frombuffer(
+            self._mm,
+            dtype=ENTRY_DTYPE,
+            count=self.ways,
+            offset=self._set_start(set_index) + SET_HEADER_BYTES,
+        )
+
+    def _tail(self, set_index: int) -> np.ndarray:
+        return np.frombuffer(self._mm, dtype="<u4", count=1, offset=self._set_start(set_index))
+
+    @contextmanager
+    def _lock(self, set_index: int) -> Iterator[None]:
+        # fcntl locks are held per process, so threads also need a lock of their own
+        start = self._set_start(set_index)
+
+        with self._locks[set_index]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, start)
+
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, start)
+
+    def _find(self, entries: np.ndarray, h1: int, h2: int) -> int:
+        matches = np.flatnonzero((entries["h1"] == h1) & (entries["h2"] == h2) & (entries["key_len"] > 0))
+        return int(matches[0]) if matches.size else -1
+
+    def _data_start(self, set_index: int) -> int:
+        return self._set_start(set_index) + self.table_bytes
+
+    def get(self, key: str, max_age: Optional[float] = None) -> Optional[bytes]:
+        """Retrieve a value, marking it as recently used
+
+        :param key: Cache key
+        :param max_age: Ignore entries older than this many seconds
+        :return: Cached value, or None if it isn't cached
+        """
+        self._open()
+        key_bytes = key.encode("utf-8")
+        h1, h2 = key_digest(key_bytes)
+        set_index = h1 % self.num_sets
+
+        with self._lock(set_index):
+            entries = self._entries(set_index)
+            way = self._find(entries, h1, h2)
+
+            if way < 0:
+                return None
+
+            if max_age is not None and time() - entries["created"][way] > max_age:
+                return None
+
+            start = self._data_start(set_index) + int(entries["offset"][way])
+            key_len = int(entries["key_len"][way])
+
+            if self._mm[start:start + key_len] != key_bytes:
+                return None
+
+            entries["atime"][way] = time_ns()
+            entries["hits"][way] += 1
+            return self._mm[start + key_len:start + key_len + int(entries["val_len"][way])]
+
+    def created(self, key: str) -> Optional[float]:
+        """Creation time of a value, or None if it isn't cached"""
+        self._open()
+        key_bytes = key.encode("utf-8")
+        h1, h2 = key_digest(key_bytes)
+        set_index = h1 % self.num_sets
+
+        with self._lock(set_index):
+            entries = self._entries(set_index)
+            way = self._find(entries, h1, h2)
+
+            if way < 0:
+                return None
+
+            start = self._data_start(set_index) + int(entries["offset"][way])
+
+            if self._mm[start:start + int(entries["key_len"][way])] != key_bytes:
+                return None
+
+            return float(entries["created"][way])
+
+    def put(self, key: str, value: bytes, created: Optional[float] = None) -> bool:
+        """Add a value, evicting the least recently used entries of its set if needed
+
+        :param key: Cache key
+        :param value: Value to cache
+        :param created: Creation time of the value (defaults to now)
+        :return: True if the value was cached, False if it is too large
+        """
+        self._open()
+        key_bytes = key.encode("utf-8")
+        needed = len(key_bytes) + len(value)
+
+        if needed > self.max_entry_bytes:
+            return False
+
+        h1, h2 = key_digest(key_bytes)
+        set_index = h1 % self.num_sets
+
+        with self._lock(set_index):
+            entries = self._entries(set_index)
+            tail = self._tail(set_index)
+            way = self._find(entries, h1, h2)
+
+            if way >= 0:
+                entries["key_len"][way] = 0
+
+            if tail[0] + needed > self.data_bytes or not (entries["key_len"] == 0).any():
+                self._evict(set_index, needed)
+
+            way = int(np.flatnonzero(entries["key_len"] == 0)[0])
+            start = self._data_start(set_index) + int(tail[0])
+            self._mm[start:start + needed] = key_bytes + value
+            entries[way] = (h1, h2, tail[0], len(key_bytes), len(value), 0, time() if created is None else created, time_ns())
+            tail[0] += needed
+
+        return True
+
+    def _evict(self, set_index: int, needed: int) -> None:
+        # Drop least recently used entries until the new one fits, then compact the survivors
+        entries = self._entries(set_index)
+        live = np.flatnonzero(entries["key_len"] > 0)
+        live = live[np.argsort(entries["atime"][live])]
+        sizes = entries["key_len"][live].astype(np.int64) + entries["val_len"][live]
+        used = int(sizes.sum())
+        evicted = 0
+
+        while evicted < live.size and (used + needed > self.data_bytes or live.size - evicted >= self.ways):
+            used -= int(sizes[evicted])
+            entries["key_len"][live[evicted]] = 0
+            evicted += 1
+
+        self._compact(set_index)
+
+    def _compact(self, set_index: int) -> None:
+        entries = self._entries(set_index)
+        data_start = self._data_start(set_index)
+        live = np.flatnonzero(entries["key_len"] > 0)
+        live = live[np.argsort(entries["offset"][live])]
+        tail = 0
+
+        # Entries are moved in offset order, so a move never overwrites a record that hasn't moved yet
+        for way in live:
+            size = int(entries["key_len"][way]) + int(entries["val_len"][way])
+            offset = int(entries["offset"][way])
+
+            if offset != tail:
+                self._mm.move(data_start + tail, data_start + offset, size)
+                entries["offset"][way] = tail
+
+            tail += size
+
+        self._tail(set_index)[0] = tail
+
+    def invalidate(self, prefix: str, older_than: Optional[float] = None) -> int:
+        """Remove entries whose key starts with ``prefix``
+
+        :param prefix: Key prefix
+        :param older_than: Only remove entries created before this time
+        :return: Number of entries removed
+        """
+        self._open()
+        prefix_bytes = prefix.encode("utf-8")
+        removed = 0
+
+        for set_index in range(self.num_sets):
+            with self._lock(set_index):
+                entries = self._entries(set_index)
+                data_start = self._data_start(set_index)
+                candidates = entries["key_len"] >= len(prefix_bytes)
+
+                if older_than is not None:
+                    candidates &= entries["created"] < older_than
+
+                set_removed = 0
+
+                for way in np.flatnonzero(candidates):
+                    start = data_start + int(entries["offset"][way])
+
+                    if self._mm[start:start + len(prefix_bytes)] == prefix_bytes:
+                        entries["key_len"][way] = 0
+                        set_removed += 1
+
+                if set_removed:
+                    self._compact(set_index)
+                    removed += set_removed
+
+        return removed
+
+    def stats(self) -> Tuple[int, int]:
+        """Number of entries and bytes held in the arena"""
+        self._open()
+        count = 0
+        used = 0
+
+        for set_index in range(self.num_sets):
+            entries = self._entries(set_index)
+            live = entries["key_len"] > 0
+            count += int(live.sum())
+            used += int(entries["key_len"][live].sum() + entries["val_len"][live].sum())
+
+        return count, used
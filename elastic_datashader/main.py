@@ -4,12 +4,12 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import urllib3
 
-from .cache import background_cache_cleanup
+from .cache_backends import background_cache_cleanup
 from .config import config
 from .elastic import verify_datashader_indices
 from .drawing import initialize_custom_color_maps
 from .logger import logger
-from .routers import cache, data, index, indices, legend, tms
+from .routers import cache, data, index, indices, legend, metrics, tms
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 urllib3.disable_warnings(UserWarning)
@@ -28,6 +28,7 @@ app.include_router(data.router)
 app.include_router(index.router)
 app.include_router(indices.router)
 app.include_router(legend.router)
+app.include_router(metrics.router)
 app.include_router(tms.router)
 
 
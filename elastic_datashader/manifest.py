@@ -0,0 +1,311 @@
+"""
+manifest.py contains the SQLite bookkeeping shared by the tile cache
+stores: connection handling, buffered hit counting and the manifest that
+indexes the filesystem store's tiles.
+"""
+from collections import OrderedDict
+from heapq import merge
+from os import getpid
+from pathlib import Path
+from threading import Lock, local
+from time import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import os
+import sqlite3
+
+from humanize import naturalsize
+
+from .logger import logger
+from .timeutil import pretty_time_delta
+
+class SQLiteConnections:
+    """Per-thread SQLite connections, since connections can't be shared
+    across threads or across a fork
+
+    :param schema: Script run on each new connection to create any missing tables
+    :param setup: Called with each new connection and its database path once the
+        schema exists, for writes that only need to happen once per connection
+    """
+    def __init__(self, schema: str, setup: Optional[Callable[[sqlite3.Connection, Path], None]] = None):
+        self.schema = schema
+        self.setup = setup
+        self._local = local()
+
+    def get(self, db_path: Path) -> sqlite3.Connection:
+        connections = getattr(self._local, "connections", None)
+
+        if connections is None or self._local.pid != getpid():
+            connections = self._local.connections = {}
+            self._local.pid = getpid()
+
+        conn = connections.get(db_path)
+
+        if conn is None:
+            # Autocommit, with explicit transactions where several statements go together
+            conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.executescript(self.schema)
+
+            if self.setup is not None:
+                self.setup(conn, db_path)
+
+            connections[db_path] = conn
+
+        return conn
+
+class HitCounter:
+    """Buffers cache hits so a hit doesn't cost a database write
+
+    :param max_pending: Number of distinct keys to buffer before a flush is due
+    :param max_delay: Seconds since the last flush after which a flush is due
+    """
+    def __init__(self, max_pending: int = 256, max_delay: float = 5.0):
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self._pending: Dict[Tuple, List[float]] = {}
+        self._last_flush = time()
+        self._lock = Lock()
+
+    def add(self, key: Tuple) -> bool:
+        """Count a hit on ``key``
+
+        :return: True if the buffered hits should be flushed
+        """
+        now = time()
+
+        with self._lock:
+            pending = self._pending.setdefault(key, [0, now])
+            pending[0] += 1
+            pending[1] = now
+            return len(self._pending) >= self.max_pending or now - self._last_flush >= self.max_delay
+
+    def drain(self) -> List[Tuple[int, float, Tuple]]:
+        """Take the buffered hits as (hits, last access time, key) tuples"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time()
+
+        return [(hits, accessed, key) for key, (hits, accessed) in pending.items()]
+
+# ORDER BY clauses putting the tiles to evict first, which the lru and lfu
+# policies read in index order.  The cost policy keeps tiles that are hit often
+# and were slow to render, per byte of cache they occupy, and has to sort them.
+EVICTION_ORDER = {
+    "lru": "accessed",
+    "lfu": "hits, accessed",
+    "cost": "(hits + 1) * (render_time + 0.01) / MAX(size, 1), accessed",
+}
+
+def select_evictions(candidates: Iterable[Iterable[Tuple]], excess: int) -> List[Any]:
+    """Pick tiles to evict until at least ``excess`` bytes are freed
+
+    :param candidates: One or more sequences of ``(*sort_key, size, key)`` rows,
+        each already in eviction order
+    :param excess: Number of bytes to free
+    :return: Keys of the tiles to evict
+    """
+    keys = []
+    freed = 0
+
+    for *_, size, key in merge(*candidates, key=lambda row: row[:-2]):
+        if freed >= excess:
+            break
+
+        keys.append(key)
+        freed += size
+
+    return keys
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (
+    key TEXT PRIMARY KEY,
+    idx_name TEXT NOT NULL,
+    parameter_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    render_time REAL NOT NULL DEFAULT 0,
+    keep_until REAL
+);
+CREATE INDEX IF NOT EXISTS tiles_created ON tiles (idx_name, created);
+CREATE INDEX IF NOT EXISTS tiles_parameter_hash ON tiles (idx_name, parameter_hash);
+CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (idx_name, accessed);
+CREATE INDEX IF NOT EXISTS tiles_accessed_all ON tiles (accessed);
+CREATE INDEX IF NOT EXISTS tiles_hits ON tiles (idx_name, hits, accessed);
+CREATE INDEX IF NOT EXISTS tiles_hits_all ON tiles (hits, accessed);
+"""
+
+class CacheManifest:
+    """Index of the tiles in the filesystem store, kept in ``.manifest.sqlite``
+    under the cache directory
+
+    Keys are tile names (``idx_hash/param_hash/z/x/y.png``) relative to the cache
+    directory.  Rows are written when a tile is cached and updated when it is hit,
+    so age-off and the cache statistics are index scans rather than directory walks.
+
+    :param cache_path: Cache directory
+    """
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self.db_path = cache_path / ".manifest.sqlite"
+        self.hits = HitCounter()
+        self._connections = SQLiteConnections(MANIFEST_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        return self._connections.get(self.db_path)
+
+    def record_put(
+        self,
+        key: str,
+        size: int,
+        created: Optional[float] = None,
+        render_time: float = 0.0,
+        keep_until: Optional[float] = None,
+    ) -> None:
+        idx_name, parameter_hash, _ = key.split("/", 2)
+        created = time() if created is None else created
+
+        self._conn().execute(
+            "INSERT OR REPLACE INTO tiles (key, idx_name, parameter_hash, size, created, accessed, hits, render_time, keep_until) "
+            "VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+            (key, idx_name, parameter_hash, size, created, created, render_time, keep_until),
+        )
+
+    def record_hit(self, key: str) -> None:
+        if self.hits.add((key,)):
+            self.flush_hits()
+
+    def flush_hits(self) -> None:
+        rows = [(hits, accessed, key) for hits, accessed, (key,) in self.hits.drain()]
+
+        if rows:
+            conn = self._conn()
+
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany("UPDATE tiles SET hits = hits + ?, accessed = MAX(accessed, ?) WHERE key = ?", rows)
+
+    def expired(self, idx_name: str, cutoff: float) -> List[str]:
+        """Keys of an index's tiles created before ``cutoff``, other than
+        those that are to be kept longer"""
+        return [
+            key for key, in self._conn().execute(
+                "SELECT key FROM tiles WHERE idx_name = ? AND created < ? AND COALESCE(keep_until, 0) < ?",
+                (idx_name, cutoff, time()),
+            )
+        ]
+
+    def remove(self, keys: Iterable[str]) -> None:
+        conn = self._conn()
+
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM tiles WHERE key = ?", ((key,) for key in keys))
+
+    def remove_prefix(self, idx_name: str, param_hash: Optional[str] = None) -> None:
+        if param_hash:
+            self._conn().execute("DELETE FROM tiles WHERE idx_name = ? AND parameter_hash = ?", (idx_name, param_hash))
+        else:
+            self._conn().execute("DELETE FROM tiles WHERE idx_name = ?", (idx_name,))
+
+    def index_names(self) -> List[str]:
+        return [idx_name for idx_name, in self._conn().execute("SELECT DISTINCT idx_name FROM tiles")]
+
+    def total_size(self) -> int:
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+
+    def index_sizes(self) -> Dict[str, int]:
+        return dict(self._conn().execute("SELECT idx_name, SUM(size) FROM tiles GROUP BY idx_name"))
+
+    def eviction_candidates(self, policy: str, idx_name: Optional[str] = None) -> sqlite3.Cursor:
+        """Tiles as ``(*sort_key, size, key)`` rows in the order ``policy`` would evict them
+
+        :param policy: Key of ``EVICTION_ORDER``
+        :param idx_name: Only consider this index's tiles
+        """
+        order = EVICTION_ORDER[policy]
+
+        if idx_name is None:
+            return self._conn().execute(f"SELECT {order}, size, key FROM tiles ORDER BY {order}")
+
+        return self._conn().execute(f"SELECT {order}, size, key FROM tiles WHERE idx_name = ? ORDER BY {order}", (idx_name,))
+
+    def stats(self) -> Dict[str, OrderedDict]:
+        """Age and size of each index and parameter hash, newest first, in the
+        same form as ``build_layer_info``"""
+        self.flush_hits()
+        layer_info = {}
+        now = time()
+
+        rows = self._conn().execute(
+            "SELECT idx_name, parameter_hash, MAX(created), SUM(size) FROM tiles "
+            "GROUP BY idx_name, parameter_hash ORDER BY MAX(created) DESC"
+        )
+
+        for idx_name, param_hash, created, size in rows:
+            layer_info.setdefault(idx_name, OrderedDict())[param_hash] = {
+                "age_timestamp": created,
+                "age": pretty_time_delta(seconds=now-created),
+                "size": naturalsize(size, gnu=True),
+            }
+
+        return layer_info
+
+    def is_built(self) -> bool:
+        row = self._conn().execute("SELECT value FROM metadata WHERE name = 'built'").fetchone()
+        return row is not None
+
+    def build(self) -> None:
+        """Add tiles that were cached before the manifest existed, by crawling the cache directory once"""
+        logger.info("Building cache manifest %s", self.db_path)
+        rows = []
+
+        for file_path in self.cache_path.glob("*/*/*/*/*.png"):  # idx/hash/z/x/y.png
+            try:
+                stat = file_path.stat()
+            except FileNotFoundError:
+                continue
+
+            key = file_path.relative_to(self.cache_path).as_posix()
+            idx_name, parameter_hash, _ = key.split("/", 2)
+            rows.append((key, idx_name, parameter_hash, stat.st_size, stat.st_mtime, stat.st_mtime))
+
+        conn = self._conn()
+
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR IGNORE INTO tiles (key, idx_name, parameter_hash, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES ('built', ?)", (str(time()),))
+
+        logger.info("Added %d existing tiles to cache manifest", len(rows))
+
+def remove_tile_files(cache_path: Path, keys: Iterable[str]) -> None:
+    """Delete tile files, then any directories they leave empty
+
+    :param cache_path: Cache directory
+    :param keys: Tile names relative to the cache directory
+    """
+    dirs = set()
+
+    for key in keys:
+        file_path = cache_path / key
+        # set missing_ok=True in case another process deleted the same file
+        file_path.unlink(missing_ok=True)
+
+        # z/x directories, then the parameter hash directory
+        dirs.update(list(file_path.parents)[:3])
+
+    # Deepest first, so emptied children are gone before their parents are tried
+    for dir_path in sorted(dirs, key=lambda p: len(p.parts), reverse=True):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            pass
@@ -0,0 +1,90 @@
+"""
+mbtiles.py writes rendered tiles into an MBTiles archive, a SQLite database
+that map viewers and tile servers can read without this server.
+"""
+from pathlib import Path
+from threading import Lock
+from typing import Callable, List, Optional, Tuple
+
+import sqlite3
+
+import mercantile
+
+# Tiles written between commits
+COMMIT_EVERY = 256
+
+class MBTilesWriter:
+    """Adds tiles to an MBTiles 1.3 archive, creating it if it doesn't exist
+
+    Tiles are stored with TMS row numbering, as the specification requires.
+
+    :param path: Archive file
+    :param name: Name of the tileset
+    :param tile_format: ``png`` or ``webp``, as the archive's ``format`` metadata
+    :param min_zoom: Shallowest zoom in the archive
+    :param max_zoom: Deepest zoom in the archive
+    :param bounds: West, south, east and north of the tiles, if not the whole world
+    :param on_commit: Called with the tiles of each commit once they're in the archive
+    """
+    def __init__(
+        self,
+        path: Path,
+        name: str,
+        tile_format: str,
+        min_zoom: int,
+        max_zoom: int,
+        bounds: Optional[Tuple[float, float, float, float]] = None,
+        on_commit: Optional[Callable[[List[mercantile.Tile]], None]] = None,
+    ):
+        self.path = path
+        self.on_commit = on_commit
+        self._lock = Lock()
+        self._pending: List[mercantile.Tile] = []
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+            """
+        )
+        metadata = {
+            "name": name,
+            "format": tile_format,
+            "type": "overlay",
+            "version": "1.3",
+            "minzoom": str(min_zoom),
+            "maxzoom": str(max_zoom),
+        }
+
+        if bounds is not None:
+            metadata["bounds"] = ",".join(str(bound) for bound in bounds)
+
+        self._conn.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", metadata.items())
+        self._conn.commit()
+
+    def put(self, tile: mercantile.Tile, img: bytes) -> None:
+        """Add or replace a tile; safe to call from any thread"""
+        row = 2 ** tile.z - 1 - tile.y
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                (tile.z, tile.x, row, sqlite3.Binary(img)),
+            )
+            self._pending.append(tile)
+
+            if len(self._pending) >= COMMIT_EVERY:
+                self._commit()
+
+    def _commit(self) -> None:
+        self._conn.commit()
+        committed, self._pending = self._pending, []
+
+        if self.on_commit is not None and committed:
+            self.on_commit(committed)
+
+    def close(self) -> None:
+        with self._lock:
+            self._commit()
+            self._conn.close()
@@ -0,0 +1,114 @@
+"""
+metrics.py keeps the Prometheus metrics scraped from ``/metrics``: how long
+each stage of rendering a tile takes, and how tile requests were answered.
+
+Under gunicorn, set ``PROMETHEUS_MULTIPROC_DIR`` to a directory shared by the
+workers so a scrape reports all of them rather than whichever one answers it.
+"""
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Dict, Iterator, Optional
+
+from prometheus_client import Counter, Histogram
+
+# Highest zoom of each band of zoom levels stages are labelled with
+ZOOM_BANDS = (4, 8, 12, 16)
+
+STAGE_LABELS = ("render_mode", "geofield_type", "zoom_band")
+
+# Server-Timing entries of tile responses and the stages each adds up
+SERVER_TIMING_STAGES = {
+    "es": ("generated_params", "count", "categories", "aggregation_page", "scan"),
+    "convert": ("conversion",),
+    "shade": ("rasterize", "shading", "spreading"),
+    "encode": ("encode",),
+    "cache": ("cache_read", "cache_write"),
+}
+
+STAGE_SECONDS = Histogram(
+    "datashader_render_stage_seconds",
+    "Seconds spent in each stage of serving a tile",
+    ("stage",) + STAGE_LABELS,
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+CACHE_HITS = Counter("datashader_cache_hits", "Tiles served from the cache", ("freshness",))
+CACHE_MISSES = Counter("datashader_cache_misses", "Tile requests that weren't in the cache")
+PLACEHOLDER_WAITS = Counter(
+    "datashader_placeholder_waits",
+    "Renders not started because another request or process had claimed the tile",
+)
+REDIRECTS = Counter("datashader_redirects", "Tile requests told to come back after a Retry-After")
+ABORTED_TILES = Counter("datashader_aborted_tiles", "Tiles rendered from partial results after the query timeout", STAGE_LABELS)
+OVER_MAX_TILES = Counter("datashader_over_max_tiles", "Tiles rendered from the first of more documents than allowed", STAGE_LABELS)
+
+def zoom_band(z: int) -> str:
+    """Band of zoom levels such as ``5-8``, which keeps the number of label values small"""
+    low = 0
+
+    for high in ZOOM_BANDS:
+        if z <= high:
+            return f"{low}-{high}"
+
+        low = high + 1
+
+    return f"{low}+"
+
+def stage_labels(params: Dict[str, Any], z: int) -> Dict[str, str]:
+    return {
+        "render_mode": params.get("render_mode") or "points",
+        "geofield_type": params.get("geofield_type") or "geo_point",
+        "zoom_band": zoom_band(z),
+    }
+
+def server_timing(seconds: Dict[str, float]) -> str:
+    """``Server-Timing`` header value of the stages timed, in milliseconds"""
+    entries = []
+
+    for name, stages in SERVER_TIMING_STAGES.items():
+        if any(stage in seconds for stage in stages):
+            entries.append(f"{name};dur={1000 * sum(seconds.get(stage, 0.0) for stage in stages):.1f}")
+
+    return ", ".join(entries)
+
+class RenderStages:
+    """Times the stages of serving one tile into ``STAGE_SECONDS``, keeping
+    the total seconds of each stage in ``seconds``
+
+    :param params: Layer parameters, for the render mode and geofield type
+    :param z: Zoom level of the tile
+    """
+    def __init__(self, params: Dict[str, Any], z: int):
+        self.labels = stage_labels(params, z)
+        self.seconds: Dict[str, float] = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        STAGE_SECONDS.labels(stage=stage, **self.labels).observe(seconds)
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def __call__(self, stage: str, excluding: Optional[str] = None) -> Iterator[None]:
+        """Time the ``with`` block as ``stage``
+
+        :param excluding: Stage timed within the block whose time isn't counted,
+            such as aggregation pages fetched while converting their buckets
+        """
+        start = perf_counter()
+        excluded = self.seconds.get(excluding, 0.0) if excluding else 0.0
+
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+
+            if excluding:
+                elapsed = max(0.0, elapsed - (self.seconds.get(excluding, 0.0) - excluded))
+
+            self.observe(stage, elapsed)
+
+    def count_tile(self, metrics: Dict[str, Any]) -> None:
+        """Count a rendered tile that was cut short, from its render metrics"""
+        if metrics.get("aborted"):
+            ABORTED_TILES.labels(**self.labels).inc()
+
+        if metrics.get("over_max"):
+            OVER_MAX_TILES.labels(**self.labels).inc()
@@ -1,7 +1,9 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from hashlib import sha256
-from json import loads
-from time import sleep
+from json import dumps, loads
+from threading import Event, Lock
+from time import sleep, time
 from typing import Any, Dict, Optional, Tuple
 from urllib.parse import unquote
 
@@ -14,10 +16,13 @@ from elasticsearch.exceptions import NotFoundError, ConflictError
 from elasticsearch_dsl import Document
 from pydantic import BaseModel, Field
 
+from .cache_policy import QUANTIZE_INTERVAL, get_cache_policy
 from .config import config
+from .density import fetch_density
+from .drawing import TILE_FORMATS
 from .elastic import get_search_base, build_dsl_filter, hosts_url_to_nodeconfig
 from .logger import logger
-from .timeutil import quantize_time_range, convert_kibana_time
+from .timeutil import convert_kibana_time, is_relative_time, quantize_time_range
 
 
 class SearchParams(BaseModel):
@@ -34,6 +39,7 @@ class SearchParams(BaseModel):
     geofield_type: str = Field(default='geo_point')
     bucket_max: float = Field(default=100, ge=0, le=100)
     bucket_min: float  = Field(default=0, ge=0, le=1)
+    tile_format: Optional[str] = Field(default=None)
 
 def create_default_params() -> Dict[str, Any]:
     return {
@@ -69,7 +75,8 @@ def create_default_params() -> Dict[str, Any]:
         "bucket_min": 0,
         "bucket_max": 1,
         "timeOverlap": False,
-        "timeOverlapSize": "auto"
+        "timeOverlapSize": "auto",
+        "tile_format": config.tile_format,
     }
 
 
@@ -235,6 +242,20 @@ def get_category_field(category_field: Optional[str]) -> Optional[str]:
 
     return category_field
 
+def get_tile_format(tile_format: Optional[str], accept: Optional[str]) -> str:
+    """Pick the output format from the tile_format query parameter, falling back
+    to the Accept header when format negotiation is enabled"""
+    if tile_format is None or tile_format == "":
+        if config.negotiate_tile_format and accept and "image/webp" in accept:
+            return "webp"
+
+        return config.tile_format
+
+    if tile_format not in TILE_FORMATS:
+        raise ValueError(f"Invalid tile_format {tile_format}")
+
+    return tile_format
+
 def get_time_bounds(now: datetime, from_time: Optional[str], to_time: Optional[str]) -> Dict[str, datetime]:
     start_time = None
     stop_time = now
@@ -269,9 +290,60 @@ def get_parameter_hash(params: Dict[str, Any]) -> str:
 
     return parameter_hash.hexdigest()[0:30]
 
+PARSED_REQUEST_CACHE_SIZE = 256
+
+_parsed_requests: "OrderedDict[str, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+_parsed_requests_lock = Lock()
+
+def is_quantized(dt: Optional[datetime]) -> bool:
+    return dt is not None and dt.timestamp() % QUANTIZE_INTERVAL.total_seconds() == 0
+
 def extract_parameters(headers: Dict[Any, Any], query_params: Dict[Any, Any]) -> Tuple[str, Dict[str, Any]]:
     """
     Get the parameters from a request and return hash and dict of parameters
+
+    The tiles of a viewport share their parameters, so parsed requests are
+    reused until their relative time range moves to the next quantized window.
+    """
+    now = datetime.now(timezone.utc)
+    key = dumps(
+        [
+            headers.get("es-security-runas-user", None),
+            headers.get("accept"),
+            int(now.timestamp() // QUANTIZE_INTERVAL.total_seconds()),
+            sorted(query_params.items()),
+        ],
+        default=str,
+    )
+
+    with _parsed_requests_lock:
+        parsed = _parsed_requests.get(key)
+
+        if parsed is not None:
+            _parsed_requests.move_to_end(key)
+
+    if parsed is None:
+        parsed = parse_parameters(headers, query_params, now)
+        params = parsed[1]
+
+        # Windows too short to quantize still move with every request
+        if not params["time_relative"] or (is_quantized(params["start_time"]) and is_quantized(params["stop_time"])):
+            with _parsed_requests_lock:
+                _parsed_requests[key] = parsed
+
+                while len(_parsed_requests) > PARSED_REQUEST_CACHE_SIZE:
+                    _parsed_requests.popitem(last=False)
+
+    parameter_hash, params = parsed
+    return parameter_hash, dict(params)
+
+def parse_parameters(headers: Dict[Any, Any], query_params: Dict[Any, Any], now: datetime) -> Tuple[str, Dict[str, Any]]:
+    """Parse a request's parameters
+
+    :param headers: Request headers
+    :param query_params: Request query parameters
+    :param now: Time relative time ranges are relative to
+    :return: Parameter hash and parameters
     """
     params = create_default_params()
     unhashed_params = {}  # Some parameters aren't used to make the final hash
@@ -280,7 +352,6 @@ def extract_parameters(headers: Dict[Any, Any], query_params: Dict[Any, Any]) ->
     # There's a query parameter called "params"
     params_param = load_params_param(query_params.get("params"))
 
-    now = datetime.now(timezone.utc)
     from_time = get_from_time(params_param)
     to_time = get_to_time(params_param)
     render_mode = get_render_mode(query_params)
@@ -288,6 +359,9 @@ def extract_parameters(headers: Dict[Any, Any], query_params: Dict[Any, Any]) ->
 
     unhashed_params["mapZoom"] = params_param.get("zoom", None)
     unhashed_params["extent"] = params_param.get("extent", None)
+    # The same window of time renders the same tile however it was written,
+    # but only windows relative to now keep moving
+    unhashed_params["time_relative"] = is_relative_time(from_time) or is_relative_time(to_time)
 
     params["dsl_filter"] = get_dsl_filter(params_param)
     params.update(get_query(params_param))
@@ -315,6 +389,7 @@ def extract_parameters(headers: Dict[Any, Any], query_params: Dict[Any, Any]) ->
     params["timeOverlap"] = query_params.get("timeOverlap", "false") == "true"
     params["timeOverlapSize"] = query_params.get("timeOverlapSize", "auto")
     params["debug"] = query_params.get("debug", False) == 'true'
+    params["tile_format"] = get_tile_format(query_params.get("tile_format"), headers.get("accept"))
 
     if params["geofield_type"] == "undefined":
         params["geofield_type"] = "geo_point"
@@ -470,6 +545,12 @@ def generate_global_params(headers, params, idx):
     else:
         logger.debug("Skipping global query")
 
+    # Only summarize where the documents are once no more can arrive, otherwise
+    # tiles could be skipped as empty after data lands in them
+    density = None
+    if field_type == "geo_point" and get_cache_policy(params).time_class == "historical":
+        density = fetch_density(base_s, geopoint_field)
+
     # Return generated params dict
     generated_params = {
         "histogram_interval": histogram_interval,
@@ -477,14 +558,126 @@ def generate_global_params(headers, params, idx):
         "global_doc_cnt": global_doc_cnt,
         "global_bounds": global_bounds,
         "field_max": field_max,
-        "field_min": field_min
+        "field_min": field_min,
+        "density": density.encode() if density is not None else None,
     }
 
     return generated_params
 
 
-def merge_generated_parameters(headers, params, idx, param_hash):
-    layer_id = f"{param_hash}_{config.hostname}"
+# Parameters that change which documents or fields ``generate_global_params``
+# aggregates.  Style-only parameters like cmap and spread don't, so styling
+# variants of a query share generated parameters.
+GENERATED_PARAMS_KEYS = (
+    "geopoint_field",
+    "geofield_type",
+    "timestamp_field",
+    "start_time",
+    "stop_time",
+    "lucene_query",
+    "dsl_query",
+    "dsl_filter",
+    "user",
+    "category_field",
+    "category_type",
+    "category_histogram",
+    "render_mode",
+    "search_nautical_miles",
+    "ellipse_major",
+    "ellipse_minor",
+    "ellipse_units",
+)
+
+
+def get_layer_id(idx: str, params: Dict[str, Any]) -> str:
+    """Fingerprint of the data query behind a parameter set, which identifies
+    its generated parameters in ``.datashader_layers`` on every host
+
+    :param idx: Index pattern
+    :param params: Parameters from ``extract_parameters``
+    :return: Layer id
+    """
+    fingerprint = {name: params.get(name) for name in GENERATED_PARAMS_KEYS}
+
+    # Only auto span needs the document bounds and count, and only geo_shape
+    # layers aggregate at a resolution dependent precision
+    fingerprint["span_auto"] = params.get("span_range") in (None, "auto")
+    if params.get("geofield_type") == "geo_shape":
+        fingerprint["resolution"] = params.get("resolution")
+
+    return get_parameter_hash({"idx": idx, **fingerprint})
+
+
+# How long to wait for another process to generate a layer's parameters,
+# polling with exponential backoff between these intervals
+GENERATION_TIMEOUT = timedelta(seconds=45)
+GENERATION_POLL_MIN = 0.05
+GENERATION_POLL_MAX = 1.0
+
+
+class GeneratedParamsCache:
+    """Completed generated parameters by layer id, so only a worker's first
+    render of a layer reads ``.datashader_layers``
+
+    :param ttl: How long to keep a layer's parameters
+    """
+    def __init__(self, ttl: timedelta):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._loading: Dict[str, Event] = {}
+
+    def get(self, layer_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(layer_id)
+
+        if entry is None or entry[0] < time():
+            return None
+
+        return entry[1]
+
+    def put(self, layer_id: str, generated_params: Dict[str, Any]) -> None:
+        now = time()
+
+        with self._lock:
+            self._entries = {key: entry for key, entry in self._entries.items() if entry[0] >= now}
+            self._entries[layer_id] = (now + self.ttl.total_seconds(), generated_params)
+
+    def claim(self, layer_id: str) -> Optional[Event]:
+        """Claim loading a layer's parameters in this worker
+
+        :return: None if claimed, otherwise an event that is set once the
+            thread holding the claim releases it
+        """
+        with self._lock:
+            event = self._loading.get(layer_id)
+
+            if event is None:
+                self._loading[layer_id] = Event()
+
+            return event
+
+    def release(self, layer_id: str) -> None:
+        with self._lock:
+            event = self._loading.pop(layer_id, None)
+
+        if event is not None:
+            event.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+generated_params_cache = GeneratedParamsCache(config.cache_timeout)
+
+
+def fetch_generated_parameters(headers, params, idx, layer_id) -> Optional[Dict[str, Any]]:
+    """Read a layer's generated parameters from ``.datashader_layers``,
+    generating them if no other process is, or waiting for the one that is
+
+    :return: Generated parameters, which aren't complete if waiting timed out
+    """
     es = Elasticsearch(
         hosts_url_to_nodeconfig(config.elastic_hosts),
         verify_certs=False,
@@ -532,7 +725,8 @@ def merge_generated_parameters(headers, params, idx, param_hash):
             logger.debug("Abandoned resetting parameters due to conflict, other process has completed.")
 
     # Loop-check if the generated params are in missing/in-process/complete
-    timeout_at = datetime.now(timezone.utc)+timedelta(seconds=45)
+    timeout_at = datetime.now(timezone.utc)+GENERATION_TIMEOUT
+    poll_interval = GENERATION_POLL_MIN
 
     while doc.to_dict().get("generated_params", {}).get("complete", False) is False:
         if datetime.now(timezone.utc) > timeout_at:
@@ -578,9 +772,36 @@ def merge_generated_parameters(headers, params, idx, param_hash):
             )
             break
 
-        sleep(1)
+        sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, GENERATION_POLL_MAX)
         doc = Document.get(id=layer_id, using=es, index=".datashader_layers")
 
+    return doc.to_dict().get("generated_params")
+
+
+def merge_generated_parameters(headers, params, idx):
+    layer_id = get_layer_id(idx, params)
+    generated_params = generated_params_cache.get(layer_id)
+
+    if generated_params is None:
+        # Only one thread per worker reads or generates a layer's parameters,
+        # the rest wait for it to finish
+        event = generated_params_cache.claim(layer_id)
+
+        if event is not None:
+            event.wait(GENERATION_TIMEOUT.total_seconds())
+            generated_params = generated_params_cache.get(layer_id)
+
+        if generated_params is None:
+            try:
+                generated_params = fetch_generated_parameters(headers, params, idx, layer_id)
+
+                if (generated_params or {}).get("complete", False):
+                    generated_params_cache.put(layer_id, generated_params)
+            finally:
+                if event is None:
+                    generated_params_cache.release(layer_id)
+
     # We now have params so use them
-    params["generated_params"] = doc.to_dict().get("generated_params")
+    params["generated_params"] = generated_params
     return params
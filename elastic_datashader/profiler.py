@@ -0,0 +1,66 @@
+"""
+profiler.py samples where a render spends its time, for diagnosing slow tiles
+on production data without a profiler attached to the server.
+"""
+from collections import Counter
+from os.path import basename
+from threading import Event, Thread, get_ident
+from types import FrameType
+from typing import List, Optional
+
+import sys
+
+# Seconds between samples
+PROFILE_INTERVAL = 0.005
+
+def frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})"
+
+def stack_names(frame: Optional[FrameType]) -> List[str]:
+    """Names of a stack's frames, outermost first"""
+    names = []
+
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+
+    return names[::-1]
+
+class SamplingProfiler:
+    """Samples the stack of the thread that enters it from a second thread,
+    counting how often each stack is seen
+
+    ``folded()`` gives the counts in the collapsed stack format that
+    flamegraph.pl, inferno and speedscope draw flame graphs from.
+
+    :param interval: Seconds between samples
+    """
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._thread_id: Optional[int] = None
+        self._stop = Event()
+        self._sampler: Optional[Thread] = None
+
+    def __enter__(self) -> "SamplingProfiler":
+        self._thread_id = get_ident()
+        self._stop.clear()
+        self._sampler = Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)  # pylint: disable=W0212
+
+            if frame is not None:
+                self.samples[";".join(stack_names(frame))] += 1
+
+    def folded(self) -> str:
+        """One ``outer;...;inner count`` line per stack, most sampled first"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
@@ -0,0 +1,203 @@
+"""
+query.py builds tile search bodies as plain JSON from a layer's base query,
+which is compiled once per parameter set, so rendering a tile only substitutes
+the bounding box, precision, size and ``after_key`` rather than building and
+serializing elasticsearch_dsl searches.
+"""
+from contextlib import nullcontext
+from functools import cached_property
+from typing import Any, Dict, Iterable, Optional, Tuple
+import time
+
+from elasticsearch import Elasticsearch
+from elasticsearch_dsl import AttrDict, Search
+from elasticsearch_dsl.response import Response
+
+from .config import config
+from .elastic import get_search_base, get_search_client, get_search_params, get_shared_base_query
+from .metrics import RenderStages
+
+class QueryTemplate:
+    """A layer's base query, split so tile filters can be appended without
+    copying it
+
+    :param base_query: Search body from ``build_base_query``, which is shared
+        and never modified
+    """
+    def __init__(self, base_query: Dict[str, Any]):
+        query = base_query.get("query")
+
+        if query is None:
+            self._bool = {}
+        elif list(query) == ["bool"]:
+            self._bool = query["bool"]
+        else:
+            self._bool = {"must": [query]}
+
+    def query(self, *filters: Dict[str, Any]) -> Dict[str, Any]:
+        """The base query with more filters appended, as ``Search.filter`` would"""
+        if not filters:
+            return {"bool": self._bool} if self._bool else {"match_all": {}}
+
+        return {"bool": {**self._bool, "filter": [*self._bool.get("filter", ()), *filters]}}
+
+def bbox_filter(geopoint_field: str, bb_dict: Dict[str, Any]) -> Dict[str, Any]:
+    return {"geo_bounding_box": {geopoint_field: bb_dict}}
+
+def geotile_grid_agg(geopoint_field: str, precision: int, size: Optional[int] = None, aggs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    grid = {"field": geopoint_field, "precision": precision}
+
+    if size is not None:
+        grid["size"] = size
+
+    agg = {"geotile_grid": grid}
+
+    if aggs:
+        agg["aggs"] = aggs
+
+    return agg
+
+def composite_agg(sources: Iterable[Tuple[str, Dict[str, Any]]], size: int, aggs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    agg = {"composite": {"sources": [{name: source} for name, source in sources], "size": size}}
+
+    if aggs:
+        agg["aggs"] = aggs
+
+    return agg
+
+def agg_body(query: Dict[str, Any], comp: Dict[str, Any]) -> Dict[str, Any]:
+    """Search body that only aggregates, under the name ``comp``"""
+    return {"query": query, "size": 0, "track_total_hits": False, "aggs": {"comp": comp}}
+
+class TileQuery:
+    """Runs compiled searches for one request against a layer
+
+    :param es: Client for the request
+    :param idx: Index pattern
+    :param template: The layer's compiled base query
+    :param search_params: URL parameters for every search
+    :param params: Parameters from ``extract_parameters``, for searches that
+        still need elasticsearch_dsl
+    :param headers: Request headers, for the same
+    """
+    def __init__(self, es: Elasticsearch, idx: str, template: QueryTemplate, search_params: Dict[str, Any], params: Dict[str, Any], headers=None):
+        self.es = es
+        self.idx = idx
+        self.template = template
+        self.search_params = search_params
+        self.params = params
+        self.headers = headers
+
+    @classmethod
+    def from_params(cls, headers, params: Dict[str, Any], idx: str) -> "TileQuery":
+        # The base query body is cached per parameter set, and splitting it
+        # doesn't copy it
+        template = QueryTemplate(get_shared_base_query(params))
+        es = get_search_client(config.elastic_hosts, headers, params)
+        return cls(es, idx, template, get_search_params(params), params, headers)
+
+    @cached_property
+    def base_search(self) -> Search:
+        """The base query as an elasticsearch_dsl search, for the less common
+        searches that aren't compiled"""
+        return get_search_base(config.elastic_hosts, self.headers, self.params, self.idx)
+
+    def tile_query(self, geopoint_field: str, bb_dict: Dict[str, Any]) -> Dict[str, Any]:
+        return self.template.query(bbox_filter(geopoint_field, bb_dict))
+
+    def count(self, query: Dict[str, Any]) -> int:
+        return self.es.count(index=self.idx, query=query, **self.search_params)["count"]
+
+    def search(self, body: Dict[str, Any], timeout_at: Optional[float] = None) -> Dict[str, Any]:
+        search_params = self.search_params
+
+        if timeout_at:
+            search_params = {**search_params, "timeout": f"{int(timeout_at - time.time())}s"}
+
+        return self.es.search(index=self.idx, body=body, **search_params).body
+
+class CompiledScan:
+    """Iterate over the buckets of a compiled search's ``comp`` aggregation,
+    paging through composite aggregations, like ``Scan`` and ``ScanAggs`` do
+    for elasticsearch_dsl searches
+
+    :param tile_query: Query to run the searches with
+    :param body: Search body from ``agg_body``
+    :param timeout: Seconds allowed for all pages
+    :param typed_response: Wrap responses like ``Search.execute`` does, so
+        bucket sub-aggregations can be iterated over
+    :param stages: Times each page as an ``aggregation_page`` stage
+    """
+    def __init__(
+        self,
+        tile_query: TileQuery,
+        body: Dict[str, Any],
+        timeout: Optional[float] = None,
+        typed_response: bool = False,
+        stages: Optional[RenderStages] = None,
+    ):
+        self.tile_query = tile_query
+        self.body = body
+        self.timeout = timeout
+        self.typed_response = typed_response
+        self.stages = stages
+        self.num_searches = 0
+        self.total_took = 0
+        self.total_shards = 0
+        self.total_skipped = 0
+        self.total_successful = 0
+        self.total_failed = 0
+        self.aborted = False
+
+    @cached_property
+    def _response_search(self) -> Search:
+        return Search().update_from_dict({"aggs": self.body["aggs"]})
+
+    def _run_search(self, after, timeout_at):
+        body = self.body
+
+        if after is not None:
+            comp = body["aggs"]["comp"]
+            body = {**body, "aggs": {"comp": {**comp, "composite": {**comp["composite"], "after": after}}}}
+
+        with self.stages("aggregation_page") if self.stages else nullcontext():
+            raw = self.tile_query.search(body, timeout_at)
+
+        response = Response(self._response_search, raw) if self.typed_response else AttrDict(raw)
+
+        self.num_searches += 1
+        self.total_took += response.took
+        self.total_shards += response._shards.total  # pylint: disable=W0212
+        self.total_skipped += response._shards.skipped  # pylint: disable=W0212
+        self.total_successful += response._shards.successful  # pylint: disable=W0212
+        self.total_failed += response._shards.failed  # pylint: disable=W0212
+        return response
+
+    def execute(self):
+        self.num_searches = 0
+        self.total_took = 0
+        self.aborted = False
+
+        timeout_at = None
+        if self.timeout:
+            timeout_at = time.time() + self.timeout
+
+        paged = "composite" in self.body["aggs"]["comp"]
+        response = self._run_search(None, timeout_at)
+
+        while response.aggregations.comp.buckets:
+            yield from response.aggregations.comp.buckets
+
+            if not paged:
+                break
+
+            if "after_key" in response.aggregations.comp:
+                after = response.aggregations.comp.after_key
+            else:
+                after = response.aggregations.comp.buckets[-1].key
+
+            if timeout_at and time.time() > timeout_at:
+                self.aborted = True
+                break
+
+            response = self._run_search(after.to_dict(), timeout_at)
@@ -0,0 +1,198 @@
+"""
+rolling.py caches per-tile aggregates for fixed slices of time, so a relative
+time window (``now-24h``) that moves forward only needs to query the slices
+it newly exposes rather than re-aggregate the whole window.
+"""
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+import zlib
+
+from datashader.utils import lnglat_to_meters
+from elasticsearch_dsl import A
+
+import numpy as np
+import pandas as pd
+
+from .config import config
+from .elastic import ScanAggs, geotile_bucket_to_lonlat
+from .logger import logger
+from .manifest import SQLiteConnections
+from .parameters import get_parameter_hash
+
+# Matches the 5 minute boundaries ``quantize_time_range`` aligns windows to
+SLICE = timedelta(minutes=5)
+
+# Parameters that change which documents are counted, and so which slices can be shared
+SLICE_KEY_PARAMS = ("geopoint_field", "timestamp_field", "lucene_query", "dsl_query", "dsl_filter", "user")
+
+SLICE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slices (
+    window_key TEXT NOT NULL,
+    zoom_level INTEGER NOT NULL,
+    tile_column INTEGER NOT NULL,
+    tile_row INTEGER NOT NULL,
+    precision INTEGER NOT NULL,
+    slice_start REAL NOT NULL,
+    points BLOB NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (window_key, zoom_level, tile_column, tile_row, precision, slice_start)
+);
+CREATE INDEX IF NOT EXISTS slices_accessed ON slices (accessed);
+"""
+
+SLICE_KEY = "window_key = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ? AND precision = ?"
+
+def is_slice_aligned(dt: datetime) -> bool:
+    return dt.timestamp() % SLICE.total_seconds() == 0
+
+def rolling_eligible(params: Dict[str, Any]) -> bool:
+    """Whether a tile's aggregation is a plain sum over time that can be
+    assembled from slices
+
+    Relative, quantized heat-mode windows of geo_point fields qualify.  Centroids,
+    categories, bucket filtering and time overlaps don't sum across slices.
+    """
+    start_time = params.get("start_time")
+    stop_time = params.get("stop_time")
+
+    return bool(
+        params.get("time_relative")
+        and params.get("timestamp_field")
+        and start_time is not None
+        and stop_time is not None
+        and start_time < stop_time
+        and is_slice_aligned(start_time)
+        and is_slice_aligned(stop_time)
+        and not params.get("category_field")
+        and params.get("geofield_type") == "geo_point"
+        and not params.get("use_centroid")
+        and not params.get("timeOverlap")
+        and params.get("bucket_min", 0) <= 0
+        and params.get("bucket_max", 1) >= 1
+    )
+
+def window_key(idx: str, params: Dict[str, Any]) -> str:
+    return get_parameter_hash({"idx": idx, **{name: params.get(name) for name in SLICE_KEY_PARAMS}})
+
+def slice_starts(start_time: datetime, stop_time: datetime) -> List[float]:
+    """Start times, in epoch seconds, of the slices making up ``[start_time, stop_time)``"""
+    step = SLICE.total_seconds()
+    start = start_time.timestamp()
+    return [start + i * step for i in range(int((stop_time.timestamp() - start) // step))]
+
+def encode_points(points: np.ndarray) -> bytes:
+    return zlib.compress(points.astype("<f8").tobytes(), 1)
+
+def decode_points(data: bytes) -> np.ndarray:
+    return np.frombuffer(zlib.decompress(data), dtype="<f8").reshape(-1, 3)
+
+class SliceStore:
+    """Per-tile ``(x, y, count)`` aggregates for each slice of time, kept in
+    ``.rolling.sqlite`` under the cache directory
+
+    :param cache_path: Cache directory
+    """
+    def __init__(self, cache_path: Path):
+        self.db_path = cache_path / ".rolling.sqlite"
+        self._connections = SQLiteConnections(SLICE_SCHEMA)
+
+    def _conn(self):
+        return self._connections.get(self.db_path)
+
+    def get_many(self, key: str, x: int, y: int, z: int, precision: int, start: float, stop: float) -> Dict[float, np.ndarray]:
+        """Cached slices starting within ``[start, stop)``, by start time"""
+        conn = self._conn()
+        args = (key, z, x, y, precision, start, stop)
+        rows = conn.execute(
+            f"SELECT slice_start, points FROM slices WHERE {SLICE_KEY} AND slice_start >= ? AND slice_start < ?",
+            args,
+        ).fetchall()
+
+        if rows:
+            conn.execute(f"UPDATE slices SET accessed = ? WHERE {SLICE_KEY} AND slice_start >= ? AND slice_start < ?", (time(), *args))
+
+        return {slice_start: decode_points(points) for slice_start, points in rows}
+
+    def put_many(self, key: str, x: int, y: int, z: int, precision: int, slices: Dict[float, np.ndarray]) -> None:
+        now = time()
+        conn = self._conn()
+
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR REPLACE INTO slices "
+                "(window_key, zoom_level, tile_column, tile_row, precision, slice_start, points, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(key, z, x, y, precision, slice_start, encode_points(points), now) for slice_start, points in slices.items()],
+            )
+
+    def prune(self, max_idle: timedelta) -> None:
+        """Remove slices no window has used for ``max_idle``"""
+        cursor = self._conn().execute("DELETE FROM slices WHERE accessed < ?", (time() - max_idle.total_seconds(),))
+
+        if cursor.rowcount > 0:
+            logger.info("Pruned %d idle time slices from %s", cursor.rowcount, self.db_path)
+            self._conn().execute("PRAGMA incremental_vacuum")
+
+slice_store = SliceStore(config.cache_path)
+
+def bucket_points(buckets: Iterable) -> Dict[float, List[Tuple[float, float, int]]]:
+    """Group composite ``grids``/``slice`` buckets into points per slice"""
+    points = {}
+
+    for bucket in buckets:
+        lon, lat = geotile_bucket_to_lonlat(bucket)
+        x, y = lnglat_to_meters(lon, lat)
+        points.setdefault(bucket.key.slice / 1000, []).append((x, y, bucket.doc_count))
+
+    return points
+
+def rolling_tile_points(tile_s, idx: str, x: int, y: int, z: int, params: Dict[str, Any], geotile_precision: int, size: int):
+    """Assemble a tile's heat-mode points from cached slices, querying only
+    slices that aren't cached or haven't settled yet
+
+    :param tile_s: Search already filtered to the tile and the time window
+    :param size: Composite aggregation page size
+    :return: Points dataframe with ``x``, ``y`` and ``c`` columns, and the ``ScanAggs``
+        that queried the remaining slices
+    """
+    timestamp_field = params["timestamp_field"]
+    stop_time = params["stop_time"]
+    starts = slice_starts(params["start_time"], stop_time)
+    key = window_key(idx, params)
+    cached = slice_store.get_many(key, x, y, z, geotile_precision, starts[0], starts[-1] + 1)
+    # Slices ending within the settle time may still be receiving data, so they're queried every time
+    settled_before = time() - config.rolling_settle_time.total_seconds() - SLICE.total_seconds()
+    missing = [start for start in starts if start not in cached or start > settled_before]
+
+    # The window only ever moves forward, so query from the first gap to the end
+    query_start = missing[0] if missing else starts[-1]
+    logger.info("Rolling window has %d of %d slices cached, querying from %s", len(starts) - len(missing), len(starts), query_start)
+
+    query_s = tile_s.filter(
+        "range",
+        **{timestamp_field: {
+            "gte": datetime.fromtimestamp(query_start, timezone.utc),
+            "lt": stop_time,
+            "format": "strict_date_optional_time_nanos",
+        }},
+    )
+    sources = [
+        {"grids": A("geotile_grid", field=params["geopoint_field"], precision=geotile_precision)},
+        {"slice": A("date_histogram", field=timestamp_field, fixed_interval=f"{int(SLICE.total_seconds())}s")},
+    ]
+    resp = ScanAggs(query_s, sources, size=size, timeout=config.query_timeout_seconds)
+    queried = {start: np.array(points, dtype="<f8").reshape(-1, 3) for start, points in bucket_points(resp.execute()).items()}
+
+    # Cache the settled slices, including empty ones, unless the query gave up part way
+    if not resp.aborted:
+        empty = np.empty((0, 3), dtype="<f8")
+        settled = {start: queried.get(start, empty) for start in starts if query_start <= start <= settled_before}
+        slice_store.put_many(key, x, y, z, geotile_precision, settled)
+
+    slices = [points for start, points in cached.items() if start < query_start] + list(queried.values())
+    points = np.concatenate(slices) if slices else np.empty((0, 3))
+    return pd.DataFrame(points, columns=["x", "y", "c"]), resp
@@ -3,19 +3,19 @@ from typing import Optional
 
 from fastapi import APIRouter, Request
 from fastapi.responses import RedirectResponse
+from starlette.concurrency import run_in_threadpool
 
-from ..cache import age_off_cache, clear_hash_cache
-from ..config import config
+from ..cache_backends import tile_cache
 
 router = APIRouter()
 
 @router.get("/clear_cache")
-async def clear_cache(name: str, param_hash: Optional[str], request: Request):
-    clear_hash_cache(config.cache_path, name, param_hash)
+async def clear_cache(name: str, request: Request, param_hash: Optional[str] = None):
+    await run_in_threadpool(tile_cache.clear, name, param_hash)
     return RedirectResponse(request.headers.get('Referer', '/'))
 
 @router.get("/age_cache")
 async def age_cache(name: str, age: int, request: Request):
     age_td = timedelta(seconds=age)
-    age_off_cache(config.cache_path, name, age_td)
+    await run_in_threadpool(tile_cache.evict, name, age_td)
     return RedirectResponse(request.headers.get('Referer', '/'))
@@ -2,9 +2,10 @@ from os.path import dirname
 
 from fastapi import APIRouter, Request
 from fastapi.templating import Jinja2Templates
+from humanize import naturalsize
+from starlette.concurrency import run_in_threadpool
 
-from ..cache import du, build_layer_info
-from ..config import config
+from ..cache_backends import tile_cache
 
 current_dir = dirname(__file__)
 
@@ -14,12 +15,15 @@ templates = Jinja2Templates(directory=f"{current_dir}/../templates")
 @router.get("/")
 @router.get("/index")
 async def index(request: Request):
+    cache_size = await run_in_threadpool(tile_cache.size)
+    layer_info = await run_in_threadpool(tile_cache.stats)
+
     return templates.TemplateResponse(
         "index.html",
         {
             "request": request,  # required when using templates
             "title": "Elastic Datashader Server",
-            "cache_size": du(config.cache_path),
-            "layer_info": build_layer_info(config.cache_path),
+            "cache_size": naturalsize(cache_size, gnu=True),
+            "layer_info": layer_info,
         }
     )
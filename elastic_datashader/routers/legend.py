@@ -4,6 +4,7 @@ from typing import Optional
 
 from fastapi import APIRouter, Request, Response
 from georgio import line_of_bearing  # pylint: disable=no-name-in-module
+from starlette.concurrency import run_in_threadpool
 
 import mercantile
 import pynumeral
@@ -82,7 +83,7 @@ async def provide_legend(idx: str, field_name: str, request: Request):  # pylint
         logger.exception("Error while extracting parameters")
         return legend_response("[]", e)
 
-    params = merge_generated_parameters(request.headers, params, idx, parameter_hash)
+    params = await run_in_threadpool(merge_generated_parameters, request.headers, params, idx)
 
     # Assign param value to legacy keyword values
     geopoint_field = params["geopoint_field"]
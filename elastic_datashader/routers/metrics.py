@@ -0,0 +1,18 @@
+from os import environ
+
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+
+router = APIRouter()
+
+@router.get("/metrics")
+async def get_metrics():
+    # Gunicorn workers each write their metrics to the shared directory
+    if "PROMETHEUS_MULTIPROC_DIR" in environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
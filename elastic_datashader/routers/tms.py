@@ -1,39 +1,45 @@
+from concurrent.futures import Future
 from datetime import datetime, timezone
 from os import getpid
-from typing import Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+import asyncio
 import time
 import uuid
 import json
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
 from elasticsearch_dsl import Document
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, Response
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
 from starlette.datastructures import URL
 
-from ..cache import (
-    cache_entry_exists,
-    cache_placeholder_exists,
-    check_cache_dir,
-    claim_cache_placeholder,
-    get_cache,
-    set_cache,
-    release_cache_placeholder,
-    rendering_tile_name,
-    tile_id,
-    tile_name,
-)
+import mercantile
+
+from ..cache import rendering_tile_name, tile_id, tile_name
+from ..cache_backends import tile_cache
+from ..cache_policy import get_cache_policy
 from ..config import config
-from ..drawing import generate_x_tile
-from ..elastic import get_es_headers, get_search_base, hosts_url_to_nodeconfig
+from ..drawing import TILE_FORMATS, generate_x_tile
+from ..elastic import get_es_headers, get_shared_base_query, hosts_url_to_nodeconfig
 from ..logger import logger
-from ..parameters import extract_parameters, merge_generated_parameters, SearchParams
+from ..metrics import CACHE_HITS, CACHE_MISSES, PLACEHOLDER_WAITS, REDIRECTS, RenderStages, server_timing
+from ..parameters import extract_parameters, get_tile_format, merge_generated_parameters, SearchParams
+from ..profiler import SamplingProfiler
 from ..tilegen import (
     TILE_HEIGHT_PX,
     TILE_WIDTH_PX,
     generate_nonaggregated_tile,
     generate_tile,
 )
+from ..scheduler import PRIORITY_PREFETCH, PRIORITY_TILE, prefetch_tiles, render_scheduler
+from ..viewport import prefetch_viewport, viewport_eligible, viewport_tiles
+from ..waiters import TileWaiter, tile_waiters
+
+# How often a waiting request checks the cache for tiles rendered by other processes
+TILE_POLL_INTERVAL = 1.0
+
+# Viewport renders streaming their progress as events
+_viewport_renders: Set[asyncio.Task] = set()
 
 router = APIRouter(
     prefix="/tms",
@@ -41,20 +47,28 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-def error_tile_response(ex: Exception) -> Response:
-    img = generate_x_tile(TILE_HEIGHT_PX, TILE_WIDTH_PX)
+def error_tile_response(ex: Exception, tile_format: str = "png") -> Response:
+    """An X tile in the format the request asked for, with the error in its ``Error`` header"""
+    img = generate_x_tile(TILE_HEIGHT_PX, TILE_WIDTH_PX, tile_format=tile_format)
 
     return Response(
         img,
         status_code=200,
         headers={
             "Cache-Control": "max-age=60",
-            "Content-Type": "image/png",
+            "Content-Type": TILE_FORMATS[tile_format],
             "Access-Control-Allow-Origin": "*",
             "Error": str(ex),
         }
     )
 
+def request_tile_format(request: Request, post_params: Optional[Dict[str, Any]] = None) -> str:
+    """Format a request's tiles are served in, even if its other parameters are invalid"""
+    try:
+        return get_tile_format({**request.query_params, **(post_params or {})}.get("tile_format"), request.headers.get("accept"))
+    except ValueError:
+        return "png"
+
 def get_next_wait(already_waited: int) -> int:
     if already_waited <= 0:
         return 2
@@ -82,6 +96,7 @@ def retry_after(url: URL, idx: str, x: int, y: int, z: int, already_waited: int)
     next_wait = get_next_wait(already_waited)
     next_url = make_next_wait_url(idx, x, y, z, already_waited==0, next_wait) + url_params_str(url)
     logger.debug('Redirecting to %s', next_url)
+    REDIRECTS.inc()
 
     return RedirectResponse(
         next_url,
@@ -119,68 +134,152 @@ def create_datashader_tiles_entry(es, **kwargs) -> None:
     doc = Document(**doc_info)
     doc.save(using=es, index=".datashader_tiles")
 
-def make_image_response(img: bytes, user: str, parameter_hash: str, cache_max_seconds: int) -> Response:
-    return Response(
-        img,
-        status_code=200,
-        headers={
-            "Cache-Control": f"max-age={cache_max_seconds}",
-            "Content-Type": "image/png",
-            "Access-Control-Allow-Origin": "*",
-            "Datashader-Parameter-Hash": parameter_hash,
-            "Datashader-RunAs-User": user,
-         }
-    )
-
-def cached_response(es, idx, x, y, z, params, parameter_hash) -> Optional[Response]:
-    # First check to see if the tile is still being rendered.
-    if cache_placeholder_exists(config.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash)):
-        logger.debug(
-            "Could not get tile from cache because it is still rendering: %s",
-            rendering_tile_name(idx, x, y, z, parameter_hash)
-        )
-        return None
+def make_image_response(
+    img: bytes,
+    user: str,
+    parameter_hash: str,
+    cache_max_seconds: int,
+    tile_format: str = "png",
+    stale_while_revalidate: int = 0,
+    immutable: bool = False,
+    timing: Optional[str] = None,
+) -> Response:
+    cache_control = f"max-age={cache_max_seconds}"
+
+    # Tiles of closed time windows never change, so clients needn't revalidate them
+    if immutable:
+        cache_control += ", immutable"
+    # Let browsers and proxies keep showing the tile while they fetch a fresh one
+    elif stale_while_revalidate > 0:
+        cache_control += f", stale-while-revalidate={stale_while_revalidate}"
+
+    headers = {
+        "Cache-Control": cache_control,
+        "Content-Type": TILE_FORMATS[tile_format],
+        "Access-Control-Allow-Origin": "*",
+        "Datashader-Parameter-Hash": parameter_hash,
+        "Datashader-RunAs-User": user,
+    }
 
+    # The format can depend on the Accept header so shared caches must key on it
+    if config.negotiate_tile_format:
+        headers["Vary"] = "Accept"
+
+    # Browsers only show other origins' Server-Timing to pages they allow
+    if timing:
+        headers["Server-Timing"] = timing
+        headers["Timing-Allow-Origin"] = "*"
+
+    return Response(img, status_code=200, headers=headers)
+
+def cached_response(
+    es,
+    idx,
+    x,
+    y,
+    z,
+    params,
+    parameter_hash,
+    request: Optional[Request] = None,
+    refresh: bool = False,
+    count_hit: bool = True,
+    render_seconds: Optional[Dict[str, float]] = None,
+) -> Optional[Response]:
+    """Respond with the cached tile, if there is one that is fresh under the
+    parameters' cache policy or within the stale grace period after that
+
+    A stale tile is served as is, and if ``refresh`` is set a refresh is
+    queued behind the renders requests are waiting on, unless one is
+    already rendering.
+
+    :param count_hit: Count a cached tile as a cache hit, in the metrics and
+        its ``.datashader_tiles`` entry, which tiles a request waited on the render of aren't
+    :param render_seconds: Stage seconds of the render the request waited on,
+        reported in the ``Server-Timing`` header along with the cache read
+    """
     # Try to get the image from the cache.
-    img = get_cache(config.cache_path, tile_name(idx, x, y, z, parameter_hash))
+    stages = RenderStages(params, z)
+
+    with stages("cache_read"):
+        img = tile_cache.get(idx, x, y, z, parameter_hash)
+    policy = get_cache_policy(params)
+    timeout = policy.ttl
+    grace = config.cache_stale_grace.total_seconds()
 
     if img is not None:
-        logger.info("Found tile in cache: %s", tile_name(idx, x, y, z, parameter_hash))
-
-        try:
-            es.update(  # pylint: disable=E1123
-                index=".datashader_tiles",
-                id=tile_id(idx, x, y, z, parameter_hash),
-                body={"script" : {"source": "ctx._source.cache_hits++"}},
-                retry_on_conflict=5,
+        now = time.time()
+        age = now - (tile_cache.created(idx, x, y, z, parameter_hash) or 0)
+
+        if age > timeout + grace:
+            logger.debug("Cached tile is past its stale grace period: %s", tile_name(idx, x, y, z, parameter_hash))
+            return None
+
+        stale = age > timeout
+        logger.info("Found %s tile in cache: %s", "stale" if stale else "fresh", tile_name(idx, x, y, z, parameter_hash))
+
+        if count_hit:
+            CACHE_HITS.labels("stale" if stale else "fresh").inc()
+
+        if stale and refresh and not tile_cache.is_claimed(idx, x, y, z, parameter_hash, timeout):
+            logger.debug("Scheduling refresh of stale tile %s", tile_name(idx, x, y, z, parameter_hash))
+            render_scheduler.submit(
+                PRIORITY_PREFETCH, render_tile_to_cache, idx, x, y, z, params, parameter_hash, request,
+                key=tile_name(idx, x, y, z, parameter_hash),
+                layer=(idx, parameter_hash),
+                user=params.get("user"),
+                tile=mercantile.Tile(x, y, z),
             )
-        except NotFoundError:
-            logger.warning("Unable to find cached tile entry in .datashader_tiles")
 
-        return make_image_response(img, params.get("user") or "", parameter_hash, config.cache_timeout.seconds)
+        if count_hit:
+            try:
+                es.update(  # pylint: disable=E1123
+                    index=".datashader_tiles",
+                    id=tile_id(idx, x, y, z, parameter_hash),
+                    body={"script" : {"source": "ctx._source.cache_hits++"}},
+                    retry_on_conflict=5,
+                )
+            except NotFoundError:
+                logger.warning("Unable to find cached tile entry in .datashader_tiles")
+
+        return make_image_response(
+            img,
+            params.get("user") or "",
+            parameter_hash,
+            0 if stale else policy.max_age(age, now),
+            params.get("tile_format", "png"),
+            int(timeout + grace - age) if stale else int(grace),
+            policy.immutable and not stale,
+            server_timing({**(render_seconds or {}), **stages.seconds}),
+        )
 
     logger.debug("Did not find image in cache: %s", tile_name(idx, x, y, z, parameter_hash))
     return None
 
-def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_hash: str, request: Request) -> None:
-    check_cache_dir(config.cache_path, idx)
+def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_hash: str, request: Request, prefetched=None) -> Optional[Dict[str, float]]:
+    """Render a tile into the cache, unless it's cached or another request or
+    process is already rendering it
+
+    :return: Seconds spent in each stage, if this rendered the tile
+    """
+    stages = RenderStages(params, z)
 
     # Before any heavy lifting, double-check that the cache entry doesn't already exist.
-    if cache_entry_exists(config.cache_path, tile_name(idx, x, y, z, parameter_hash)):
+    if tile_cache.exists(idx, x, y, z, parameter_hash, get_cache_policy(params).ttl):
         logger.debug(
             "Not generating tile because it already exists in the cache: %s",
             tile_name(idx, x, y, z, parameter_hash)
         )
-        return
+        return None
 
     # Try to set a placeholder, which claims the rendering task.
     # If the placeholder already exists then another process already claimed the task.
-    if not claim_cache_placeholder(config.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash)):
+    if not tile_cache.claim(idx, x, y, z, parameter_hash):
         logger.debug(
             "Not generating tile because the cache placeholder could not be claimed: %s",
             rendering_tile_name(idx, x, y, z, parameter_hash)
         )
-        return
+        PLACEHOLDER_WAITS.inc()
+        return None
 
     # Prepare rendering params.
     # If we fail, then make sure to remove the cache placeholder and unclaim the task.
@@ -192,7 +291,8 @@ def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_h
         logger.debug("Loaded elasticsearch headers %s", headers)
 
         # Get or generate extended parameters
-        params = merge_generated_parameters(request.headers, params, idx, parameter_hash)
+        with stages("generated_params"):
+            params = merge_generated_parameters(request.headers, params, idx)
         params = {**params, "x-opaque-id": x_opaque_id}
         base_tile_info = {
             'hash': parameter_hash,
@@ -211,7 +311,7 @@ def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_h
             str(ex)
         )
         logger.debug("Releasing cache placeholder %s", rendering_tile_name(idx, x, y, z, parameter_hash))
-        release_cache_placeholder(config.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash))
+        tile_cache.release(idx, x, y, z, parameter_hash)
         raise
 
     # Render the tile image.
@@ -221,9 +321,11 @@ def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_h
         render_time_start = datetime.now(timezone.utc)
 
         if params["render_mode"] in ("ellipses", "tracks"):
-            img, metrics = generate_nonaggregated_tile(idx, x, y, z, request.headers, params)
+            img, metrics = generate_nonaggregated_tile(idx, x, y, z, request.headers, params, stages=stages)
         else:
-            img, metrics = generate_tile(idx, x, y, z, request.headers, params)
+            img, metrics = generate_tile(idx, x, y, z, request.headers, params, prefetched=prefetched, stages=stages)
+
+        stages.count_tile(metrics)
 
     except Exception as ex:  # pylint: disable=W0703
         logger.error(
@@ -237,7 +339,7 @@ def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_h
             **error_info
         )
         logger.debug("Releasing cache placeholder %s", rendering_tile_name(idx, x, y, z, parameter_hash))
-        release_cache_placeholder(config.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash))
+        tile_cache.release(idx, x, y, z, parameter_hash)
         raise
 
     # Add tile info to ElasticSearch.
@@ -250,6 +352,7 @@ def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_h
             '_id': tile_id(idx, x, y, z, parameter_hash),
             'render_time': elapsed_time,
             'metrics': metrics,
+            'stage_seconds': stages.seconds,
             'cache_hits': 0,
         }
 
@@ -265,13 +368,18 @@ def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_h
             str(ex)
         )
         logger.debug("Releasing cache placeholder %s", rendering_tile_name(idx, x, y, z, parameter_hash))
-        release_cache_placeholder(config.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash))
+        tile_cache.release(idx, x, y, z, parameter_hash)
         raise
 
     # Finally, write the rendered tile to the cache.
     # Regardless of the outcome, make sure to remove the cache placeholder and unclaim the task.
     try:
-        set_cache(config.cache_path, tile_name(idx, x, y, z, parameter_hash), img)
+        # Tiles whose policy outlives the cache timeout are kept from the background age-off
+        policy = get_cache_policy(params)
+        keep_until = time.time() + policy.ttl + config.cache_stale_grace.total_seconds()
+
+        with stages("cache_write"):
+            tile_cache.put(idx, x, y, z, parameter_hash, img, elapsed_time, keep_until)
     except Exception as ex:  # pylint: disable=W0703
         logger.error(
             "Failed to cache tile %s: %s",
@@ -280,9 +388,50 @@ def generate_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_h
         )
     finally:
         logger.debug("Releasing cache placeholder %s", rendering_tile_name(idx, x, y, z, parameter_hash))
-        release_cache_placeholder(config.cache_path, rendering_tile_name(idx, x, y, z, parameter_hash))
+        tile_cache.release(idx, x, y, z, parameter_hash)
+
+    return stages.seconds
+
+def profile_tile(idx: str, x: int, y: int, z: int, params, parameter_hash: str, request: Request) -> Tuple[bytes, Dict[str, float]]:
+    """Render a tile under the sampling profiler, without caching it, and save
+    the profile in .datashader_tiles next to the tile's entry
+
+    :return: Tile image and the seconds spent in each stage
+    """
+    stages = RenderStages(params, z)
+    x_opaque_id = str(uuid.uuid4())
+
+    with stages("generated_params"):
+        params = merge_generated_parameters(request.headers, params, idx)
+
+    params = {**params, "x-opaque-id": x_opaque_id}
+    render_time_start = datetime.now(timezone.utc)
+
+    with SamplingProfiler() as profiler:
+        if params["render_mode"] in ("ellipses", "tracks"):
+            img, metrics = generate_nonaggregated_tile(idx, x, y, z, request.headers, params, stages=stages)
+        else:
+            img, metrics = generate_tile(idx, x, y, z, request.headers, params, stages=stages)
+
+    # The folded stacks can be drawn with flamegraph.pl, inferno or speedscope
+    create_datashader_tiles_entry(
+        Elasticsearch(hosts_url_to_nodeconfig(config.elastic_hosts), verify_certs=False, timeout=120),
+        _id=f"{tile_id(idx, x, y, z, parameter_hash)}-profile",
+        hash=parameter_hash,
+        idx=idx,
+        x=x,
+        y=y,
+        z=z,
+        url=str(request.url),
+        params=params,
+        render_time=(datetime.now(timezone.utc) - render_time_start).total_seconds(),
+        metrics=metrics,
+        stage_seconds=stages.seconds,
+        profile=profiler.folded(),
+    )
+    return img, stages.seconds
 
-async def fetch_or_render_tile(already_waited: int, idx: str, x: int, y: int, z: int, request: Request, background_tasks: BackgroundTasks, post_params=None):
+async def fetch_or_render_tile(already_waited: int, idx: str, x: int, y: int, z: int, request: Request, post_params=None):
     check_proxy_key(request.headers.get('tms-proxy-key'))
 
     es = Elasticsearch(
@@ -294,13 +443,13 @@ async def fetch_or_render_tile(already_waited: int, idx: str, x: int, y: int, z:
         post_params = {}
     # Get hash and parameters
     try:
-        print(request.query_params)
-        print(post_params)
+        params_start = time.perf_counter()
         parameter_hash, params = extract_parameters(request.headers, {**request.query_params, **post_params})
         # try to build the dsl object bad filters cause exceptions that are then retried.
         # underlying elasticsearch_dsl doesn't support the elasticsearch 8 api yet so this causes requests to thrash
         # If the filters are bad or elasticsearch_dsl cannot build the request will never be completed so serve X tile
-        get_search_base(config.elastic_hosts, request.headers, params, idx)
+        get_shared_base_query(params)
+        RenderStages(params, z).observe("params", time.perf_counter() - params_start)
     except Exception as ex:  # pylint: disable=W0703
         logger.exception("Error while extracting parameters")
         params = {"user": request.headers.get("es-security-runas-user", None)}
@@ -316,25 +465,46 @@ async def fetch_or_render_tile(already_waited: int, idx: str, x: int, y: int, z:
         }
 
         create_datashader_tiles_entry(es, **error_info)
-        return error_tile_response(ex)
-    # Try to use a cached response
-    if (response := cached_response(es, idx, x, y, z, params, parameter_hash)) is not None:
+        return error_tile_response(ex, request_tile_format(request, post_params))
+
+    # Profiled renders are only for those behind the reverse proxy
+    if request.query_params.get("profile") == "true":
+        if config.tms_key is not None:
+            return await profiled_response(idx, x, y, z, params, parameter_hash, request)
+
+        logger.warning("Ignoring profile request because DATASHADER_TMS_KEY isn't set")
+
+    # Rank this user's queued renders against what they're looking at now
+    render_scheduler.view(params.get("user"), (idx, parameter_hash), params.get("extent"), params.get("mapZoom"))
+
+    if config.prefetch:
+        schedule_prefetch(idx, x, y, z, params, parameter_hash, request)
+
+    # Try to use a cached response, refreshing it in the background if it's stale
+    if (response := cached_response(es, idx, x, y, z, params, parameter_hash, request, refresh=True)) is not None:
         return response
 
     # Cache miss.
-    # Generate the tile into the cache in the background.
-    background_tasks.add_task(generate_tile_to_cache, idx, x, y, z, params, parameter_hash, request)
-
-    # lets hold the connection open for the already_waited time then check the cache again
-    timeout = time.time() + already_waited
-    while time.time() < timeout:
-        time.sleep(0.1)
-        disconnected = await request.is_disconnected()
-        if disconnected:
-            logger.info("Client Disconnected before response was sent")
-            return None
-        if (response := cached_response(es, idx, x, y, z, params, parameter_hash)) is not None:
-            return response
+    CACHE_MISSES.inc()
+
+    # Start rendering the tile into the cache, then hold the connection open
+    # until it lands there.  Requests redirected after an earlier wait hold
+    # it for their already_waited time instead.
+    wait = already_waited or config.tile_wait.total_seconds()
+
+    # A client that gives up waiting comes back after its Retry-After, which
+    # queues the render again with a later deadline, but one that has
+    # panned away doesn't
+    deadline = time.time() + wait + get_next_wait(already_waited)
+
+    with tile_waiters.waiting(tile_name(idx, x, y, z, parameter_hash)) as waiter:
+        start_render(idx, x, y, z, params, parameter_hash, request, deadline)
+
+        if wait > 0:
+            response = await wait_for_tile(es, idx, x, y, z, params, parameter_hash, request, waiter, wait)
+
+            if response is not None or await request.is_disconnected():
+                return response
 
     # Tell the client to retry the request at a different URL after a certain
     # amount of time.  This may take multiple retries if the tile takes a
@@ -342,20 +512,307 @@ async def fetch_or_render_tile(already_waited: int, idx: str, x: int, y: int, z:
     return retry_after(request.url, idx, x, y, z, already_waited)
 
 @router.get("/{idx}/{z}/{x}/{y}.png")
-async def get_tms(idx: str, x: int, y: int, z: int, request: Request, background_tasks: BackgroundTasks):
-    return await fetch_or_render_tile(0, idx, x, y, z, request, background_tasks)
+async def get_tms(idx: str, x: int, y: int, z: int, request: Request):
+    return await fetch_or_render_tile(0, idx, x, y, z, request)
 
 @router.get("/{already_waited}/{idx}/{z}/{x}/{y}.png")
-async def get_tms_after_wait(already_waited: int, idx: str, x: int, y: int, z: int, request: Request, background_tasks: BackgroundTasks):
-    return await fetch_or_render_tile(already_waited, idx, x, y, z, request, background_tasks)
+async def get_tms_after_wait(already_waited: int, idx: str, x: int, y: int, z: int, request: Request):
+    return await fetch_or_render_tile(already_waited, idx, x, y, z, request)
+
+
+def render_tile_to_cache(idx: str, x: int, y: int, z: int, params, parameter_hash: str, request: Request, prefetched=None) -> None:
+    """``generate_tile_to_cache``, then wake the requests waiting on the tile"""
+    stage_seconds = None
+
+    try:
+        stage_seconds = generate_tile_to_cache(idx, x, y, z, params, parameter_hash, request, prefetched)
+    finally:
+        tile_waiters.notify(tile_name(idx, x, y, z, parameter_hash), stage_seconds)
 
+async def profiled_response(idx: str, x: int, y: int, z: int, params, parameter_hash: str, request: Request) -> Response:
+    """Respond with a tile rendered afresh under the profiler, ahead of prefetches"""
+    try:
+        img, stage_seconds = await asyncio.wrap_future(
+            render_scheduler.submit(
+                PRIORITY_TILE, profile_tile, idx, x, y, z, params, parameter_hash, request,
+                user=params.get("user"),
+                tile=mercantile.Tile(x, y, z),
+            )
+        )
+    except Exception as ex:  # pylint: disable=W0703
+        logger.exception("Failed to profile tile %s", request.url)
+        return error_tile_response(ex, params.get("tile_format", "png"))
+
+    return make_image_response(
+        img,
+        params.get("user") or "",
+        parameter_hash,
+        0,
+        params.get("tile_format", "png"),
+        timing=server_timing(stage_seconds),
+    )
+
+def start_render(
+    idx: str,
+    x: int,
+    y: int,
+    z: int,
+    params,
+    parameter_hash: str,
+    request: Request,
+    deadline: Optional[float] = None,
+    prefetched=None,
+) -> Future:
+    """Queue a tile render ahead of any prefetches, rather than once the
+    response has been sent like a background task
+
+    :param deadline: Time after which nothing will be waiting for the tile,
+        so it isn't worth starting the render
+    :param prefetched: The tile's points from a viewport aggregation
+    :return: Future of the render
+    """
+    return render_scheduler.submit(
+        PRIORITY_TILE, render_tile_to_cache, idx, x, y, z, params, parameter_hash, request, prefetched,
+        key=tile_name(idx, x, y, z, parameter_hash),
+        layer=(idx, parameter_hash),
+        user=params.get("user"),
+        tile=mercantile.Tile(x, y, z),
+        deadline=deadline,
+    )
+
+def schedule_prefetch(idx: str, x: int, y: int, z: int, params, parameter_hash: str, request: Request) -> None:
+    """Queue a job that finds the uncached tiles a user is likely to request
+    after this one, so the cache lookups stay off the event loop"""
+    render_scheduler.submit(
+        PRIORITY_PREFETCH, queue_prefetch_renders, idx, x, y, z, params, parameter_hash, request,
+        key=("prefetch", tile_name(idx, x, y, z, parameter_hash)),
+        layer=(idx, parameter_hash),
+        user=params.get("user"),
+        tile=mercantile.Tile(x, y, z),
+    )
+
+def queue_prefetch_renders(idx: str, x: int, y: int, z: int, params, parameter_hash: str, request: Request) -> None:
+    """Queue renders of the uncached tiles a user is likely to request after
+    this one, which are dropped if the layer's requests stop first"""
+    ttl = get_cache_policy(params).ttl
+
+    for tile in prefetch_tiles(x, y, z):
+        if not tile_cache.exists(idx, tile.x, tile.y, tile.z, parameter_hash, ttl):
+            render_scheduler.submit(
+                PRIORITY_PREFETCH, render_tile_to_cache, idx, tile.x, tile.y, tile.z, params, parameter_hash, request,
+                key=tile_name(idx, tile.x, tile.y, tile.z, parameter_hash),
+                layer=(idx, parameter_hash),
+                user=params.get("user"),
+                tile=tile,
+            )
+
+async def wait_for_tile(es, idx: str, x: int, y: int, z: int, params, parameter_hash: str, request: Request, waiter: TileWaiter, wait: float) -> Optional[Response]:
+    """Respond with the tile as soon as it is in the cache, waiting at most ``wait`` seconds
+
+    Renders in this process wake the request as they finish.  Renders in other
+    processes are noticed by checking the cache every ``TILE_POLL_INTERVAL``.
+    """
+    deadline = time.time() + wait
+    name = tile_name(idx, x, y, z, parameter_hash)
+
+    while (remaining := deadline - time.time()) > 0:
+        rendered = await waiter.wait(min(remaining, TILE_POLL_INTERVAL))
+
+        if await request.is_disconnected():
+            logger.info("Client Disconnected before response was sent")
+            return None
+
+        # A render in this process reports its stages in the Server-Timing header
+        response = cached_response(es, idx, x, y, z, params, parameter_hash, count_hit=False, render_seconds=waiter.stage_seconds.get(name))
+
+        if response is not None:
+            return response
+
+        # The render finished without caching the tile, and it isn't rendering
+        # anywhere else, so leave retrying it to the fallback.  Renders that
+        # couldn't claim the tile finish while its claimed render carries on.
+        if rendered and not tile_cache.is_claimed(idx, x, y, z, parameter_hash, get_cache_policy(params).ttl):
+            break
+
+    return None
+
+def prefetch_viewport_points(idx: str, tiles, params, request: Request) -> Dict[mercantile.Tile, Any]:
+    """Heat mode points of every tile in a viewport from one aggregation, or
+    none if the layer isn't eligible or the aggregation fails"""
+    if not viewport_eligible(params):
+        return {}
+
+    try:
+        params = merge_generated_parameters(request.headers, dict(params), idx)
+
+        # Only the generated parameters say whether the layer has a density pyramid
+        if not viewport_eligible(params):
+            return {}
+
+        return prefetch_viewport(request.headers, params, idx, tiles)
+    except Exception as ex:  # pylint: disable=W0703
+        logger.error("Failed to aggregate viewport of %d tiles, rendering them separately: %s", len(tiles), str(ex))
+        return {}
+
+async def render_viewport_to_cache(idx: str, tiles, params, parameter_hash: str, request: Request) -> None:
+    """Render the tiles of a viewport that aren't cached, each on its own
+    render thread, after aggregating heat mode points for all of them at once"""
+    prefetched = await asyncio.wrap_future(
+        render_scheduler.submit(PRIORITY_TILE, prefetch_viewport_points, idx, tiles, params, request, user=params.get("user"))
+    )
+    renders = [
+        asyncio.wrap_future(start_render(idx, tile.x, tile.y, tile.z, params, parameter_hash, request, prefetched=prefetched.get(tile)))
+        for tile in tiles
+    ]
+
+    # Failures are already logged, and the tiles left for their own requests to retry
+    await asyncio.gather(*renders, return_exceptions=True)
+
+def extract_viewport(request: Request, query_params: Dict[str, Any]) -> Tuple[str, Dict[str, Any], List[mercantile.Tile]]:
+    """Parameters of a viewport request and the tiles it covers
+
+    :raises HTTPException: 400 if the parameters are invalid
+    """
+    try:
+        parameter_hash, params = extract_parameters(request.headers, query_params)
+        get_shared_base_query(params)
+        tiles = viewport_tiles(params.get("extent"), params.get("mapZoom"))
+    except Exception as ex:  # pylint: disable=W0703
+        logger.exception("Error while extracting viewport parameters")
+        raise HTTPException(status_code=400, detail=str(ex)) from ex
+
+    return parameter_hash, params, tiles
+
+def tile_url(tile: mercantile.Tile) -> str:
+    """URL of a tile relative to the viewport endpoints"""
+    return f"{tile.z}/{tile.x}/{tile.y}.png"
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def viewport_events(idx: str, tiles: List[mercantile.Tile], params, parameter_hash: str, request: Request) -> AsyncIterator[str]:
+    """Render a viewport's missing tiles, yielding a ``ready`` event for each
+    tile once it is cached, or ``failed`` if it couldn't be rendered in time
+
+    The stream opens with a ``viewport`` event and closes with a ``done`` event.
+    """
+    yield sse_event("viewport", {"hash": parameter_hash, "tiles": len(tiles)})
+    ttl = get_cache_policy(params).ttl
+    missing = []
+
+    for tile in tiles:
+        if tile_cache.exists(idx, tile.x, tile.y, tile.z, parameter_hash, ttl):
+            yield sse_event("ready", {"x": tile.x, "y": tile.y, "z": tile.z, "url": tile_url(tile)})
+        else:
+            missing.append(tile)
+
+    deadline = time.time() + config.query_timeout_seconds
+    pending = {tile_name(idx, tile.x, tile.y, tile.z, parameter_hash): tile for tile in missing}
+    failed = 0
+
+    with tile_waiters.waiting(*pending) as waiter:
+        if pending:
+            render = asyncio.create_task(render_viewport_to_cache(idx, missing, params, parameter_hash, request))
+            # Kept referenced so the task isn't collected while it runs
+            _viewport_renders.add(render)
+            render.add_done_callback(_viewport_renders.discard)
+
+        while pending and (remaining := deadline - time.time()) > 0:
+            # Tiles rendering in other processes are only noticed by checking the cache
+            await waiter.wait(min(remaining, TILE_POLL_INTERVAL))
+
+            if await request.is_disconnected():
+                logger.info("Client disconnected from viewport events")
+                return
+
+            for name, tile in list(pending.items()):
+                if tile_cache.exists(idx, tile.x, tile.y, tile.z, parameter_hash, ttl):
+                    event = "ready"
+                elif name in waiter.notified and not tile_cache.is_claimed(idx, tile.x, tile.y, tile.z, parameter_hash, ttl):
+                    # Rendered here without being cached, and not rendering anywhere else
+                    event = "failed"
+                    failed += 1
+                else:
+                    continue
+
+                del pending[name]
+                yield sse_event(event, {"x": tile.x, "y": tile.y, "z": tile.z, "url": tile_url(tile)})
+
+    for tile in pending.values():
+        failed += 1
+        yield sse_event("failed", {"x": tile.x, "y": tile.y, "z": tile.z, "url": tile_url(tile)})
+
+    yield sse_event("done", {"ready": len(tiles) - failed, "failed": failed})
+
+@router.get("/{idx}/viewport/events")
+async def get_viewport_events(idx: str, request: Request):
+    """Stream Server-Sent Events as the tiles intersecting the ``extent`` and
+    ``zoom`` in the request's parameters land in the cache, rendering those
+    that aren't cached, so clients only request tiles that are ready
+
+    An optional ``hash`` query parameter is checked against the parameters'
+    hash, so clients know the tile URLs they'll request are the ones rendered.
+    """
+    check_proxy_key(request.headers.get('tms-proxy-key'))
+    query_params = dict(request.query_params)
+    expected_hash = query_params.pop("hash", None)
+    parameter_hash, params, tiles = extract_viewport(request, query_params)
+
+    if expected_hash is not None and expected_hash != parameter_hash:
+        raise HTTPException(status_code=400, detail=f"Parameters hash to {parameter_hash}, not {expected_hash}")
+
+    return StreamingResponse(
+        viewport_events(idx, tiles, params, parameter_hash, request),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Access-Control-Allow-Origin": "*",
+            # Keep proxies from buffering events
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+@router.post("/{idx}/viewport")
+async def post_viewport(idx: str, request: Request, params: SearchParams):
+    """Render every tile intersecting the ``extent`` and ``zoom`` in ``params``
+    into the cache, so the map's tile requests that follow are cache hits
+
+    Responds with the tiles' URLs relative to this endpoint, once they're cached.
+    """
+    check_proxy_key(request.headers.get('tms-proxy-key'))
+    post_params = params.dict()
+    post_params["params"] = json.dumps(post_params["params"])
+    parameter_hash, params, tiles = extract_viewport(request, {**request.query_params, **post_params})
+
+    ttl = get_cache_policy(params).ttl
+    missing = [tile for tile in tiles if not tile_cache.exists(idx, tile.x, tile.y, tile.z, parameter_hash, ttl)]
+    logger.info("Rendering %d of %d viewport tiles for %s", len(missing), len(tiles), parameter_hash)
+
+    if missing:
+        await render_viewport_to_cache(idx, missing, params, parameter_hash, request)
+
+    return JSONResponse(
+        content={
+            "hash": parameter_hash,
+            "tiles": [
+                {
+                    "x": tile.x,
+                    "y": tile.y,
+                    "z": tile.z,
+                    "url": tile_url(tile),
+                    "cached": tile_cache.exists(idx, tile.x, tile.y, tile.z, parameter_hash, ttl),
+                }
+                for tile in tiles
+            ],
+        },
+        headers={"Access-Control-Allow-Origin": "*"},
+    )
 
 @router.post("/{idx}/{z}/{x}/{y}.png")
-async def post_tile(already_waited: int, idx: str, x: int, y: int, z: int, request: Request, params: SearchParams, background_tasks: BackgroundTasks):
+async def post_tile(idx: str, x: int, y: int, z: int, request: Request, params: SearchParams):
     params = params.dict()
     params["params"] = json.dumps(params["params"])
-    response = await fetch_or_render_tile(0, idx, x, y, z, request, background_tasks, post_params=params)
+    response = await fetch_or_render_tile(0, idx, x, y, z, request, post_params=params)
     if isinstance(response, RedirectResponse):
-        print(already_waited)
         return JSONResponse(status_code=200, content={"retry-after": response.headers['retry-after']})
     return response
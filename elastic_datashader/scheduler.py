@@ -0,0 +1,303 @@
+"""
+scheduler.py runs tile renders on a fixed set of threads, taking them from a
+priority queue so renders a user is waiting on always go before speculative
+ones, such as prefetching the tiles around those a user just requested.
+
+Each user has their own queue, ordered by how close a tile is to what they're
+looking at now, and threads are shared out between users so one user's large
+dashboard can't hold up everyone else's tiles.
+"""
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from heapq import heapify, heappop, heappush
+from threading import Condition, Thread
+from time import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import mercantile
+
+from .config import config
+from .logger import logger
+
+# Renders a request is waiting on
+PRIORITY_TILE = 0
+# Renders nothing is waiting on yet
+PRIORITY_PREFETCH = 10
+
+# Seconds without requests after which a layer's queued prefetches are dropped
+PREFETCH_IDLE = 15.0
+
+# Queued prefetches beyond this are dropped rather than queued
+MAX_PREFETCH_QUEUE = 1024
+
+# Deepest zoom whose tiles are prefetched
+MAX_PREFETCH_ZOOM = 24
+
+# Rank of a zoom level away from the map's, in tiles from the viewport centre
+ZOOM_RANK = 4
+
+@dataclass
+class RenderJob:
+    priority: int
+    fn: Callable[..., Any]
+    args: Tuple[Any, ...]
+    key: Optional[Hashable]
+    layer: Optional[Hashable]
+    user: Optional[str]
+    tile: Optional[mercantile.Tile]
+    deadline: Optional[float]
+    future: Future = field(default_factory=Future)
+    taken: bool = False
+
+@dataclass
+class View:
+    """Centre and zoom of what a user last looked at in a layer"""
+    lon: float
+    lat: float
+    zoom: int
+
+def tile_rank(tile: mercantile.Tile, view: Optional[View]) -> int:
+    """How far a tile is from a view, in zoom levels and tiles from its centre"""
+    if view is None:
+        return 0
+
+    n = 2 ** tile.z
+    centre = mercantile.tile(view.lon, max(-85.0511, min(85.0511, view.lat)), tile.z)
+    dx = abs(tile.x - centre.x)
+    return ZOOM_RANK * abs(tile.z - view.zoom) + max(min(dx, n - dx), abs(tile.y - centre.y))
+
+class RenderScheduler:
+    """Priority queues of renders per user, run by ``threads`` worker threads
+    started on the first submission
+
+    Threads take the most urgent priority queued by any user, going to the
+    user with the fewest renders running.  Within a user's queue, renders of
+    tiles closer to their latest view of the layer go first.  Renders not
+    started by their deadline are dropped.
+
+    Jobs with the same key are only queued once, and a job queued again at
+    a higher priority moves up the queue.
+    """
+    def __init__(self, threads: int):
+        self.threads = threads
+        self._cond = Condition()
+        self._queues: Dict[Optional[str], List[Tuple[int, int, int, RenderJob]]] = {}
+        self._seq = 0
+        self._jobs: Dict[Hashable, RenderJob] = {}
+        self._layers: Dict[Hashable, float] = {}
+        self._views: Dict[Tuple[Optional[str], Hashable], View] = {}
+        self._running: Dict[Optional[str], int] = {}
+        self._served: Dict[Optional[str], int] = {}
+        self._prefetches = 0
+        self._workers: List[Thread] = []
+
+    def submit(
+        self,
+        priority: int,
+        fn: Callable[..., Any],
+        *args,
+        key: Optional[Hashable] = None,
+        layer: Optional[Hashable] = None,
+        user: Optional[str] = None,
+        tile: Optional[mercantile.Tile] = None,
+        deadline: Optional[float] = None,
+    ) -> Future:
+        """Queue ``fn(*args)``
+
+        :param priority: Lower runs first, ``PRIORITY_TILE`` or ``PRIORITY_PREFETCH``
+        :param key: Identifies the render, so it is only queued once
+        :param layer: Layer rendered, whose prefetches are dropped once it is idle
+        :param user: User the render is for
+        :param tile: Tile rendered, to rank it against the user's view of the layer
+        :param deadline: Time after which the render is dropped if it hasn't started
+        :return: Future of the result, shared by submissions with the same key
+        """
+        with self._cond:
+            job = self._jobs.get(key) if key is not None else None
+
+            if job is not None:
+                job.deadline = None if deadline is None or job.deadline is None else max(deadline, job.deadline)
+
+                if priority < job.priority:
+                    if job.priority >= PRIORITY_PREFETCH > priority:
+                        self._prefetches -= 1
+
+                    self._push(job, priority)
+
+                return job.future
+
+            if priority >= PRIORITY_PREFETCH and self._prefetches >= MAX_PREFETCH_QUEUE:
+                future: Future = Future()
+                future.cancel()
+                return future
+
+            job = RenderJob(priority, fn, args, key, layer, user, tile, deadline)
+
+            if key is not None:
+                self._jobs[key] = job
+
+            if priority >= PRIORITY_PREFETCH:
+                self._prefetches += 1
+
+            self._push(job, priority)
+            self._start_workers()
+            return job.future
+
+    def view(self, user: Optional[str], layer: Hashable, extent: Optional[Dict[str, float]] = None, zoom: Optional[float] = None) -> None:
+        """Record a request for ``layer``, keeping its prefetches queued, along
+        with the user's view of it, which their queued renders are ranked against
+
+        :param user: User making the request
+        :param layer: Layer requested
+        :param extent: ``minLon``, ``minLat``, ``maxLon`` and ``maxLat`` of the map
+        :param zoom: Map zoom level
+        """
+        now = time()
+
+        with self._cond:
+            self._layers[layer] = now
+
+            if len(self._layers) > MAX_PREFETCH_QUEUE:
+                self._layers = {key: seen for key, seen in self._layers.items() if now - seen <= PREFETCH_IDLE}
+                self._views = {key: view for key, view in self._views.items() if key[1] in self._layers}
+
+            if not extent or zoom is None:
+                return
+
+            view = View(
+                (extent["minLon"] + extent["maxLon"]) / 2,
+                (extent["minLat"] + extent["maxLat"]) / 2,
+                round(zoom),
+            )
+
+            if self._views.get((user, layer)) == view:
+                return
+
+            self._views[(user, layer)] = view
+
+            # Re-rank the user's queued renders of the layer against their new view
+            if user in self._queues:
+                self._queues[user] = [
+                    (priority, self._rank(job) if job.layer == layer else rank, seq, job)
+                    for priority, rank, seq, job in self._queues[user]
+                    if not job.taken
+                ]
+                heapify(self._queues[user])
+
+    def is_idle(self, layer: Hashable) -> bool:
+        """Whether ``layer`` has gone ``PREFETCH_IDLE`` seconds without requests"""
+        return time() - self._layers.get(layer, 0) > PREFETCH_IDLE
+
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._jobs)
+
+    def _rank(self, job: RenderJob) -> int:
+        if job.tile is None:
+            return 0
+
+        return tile_rank(job.tile, self._views.get((job.user, job.layer)))
+
+    def _push(self, job: RenderJob, priority: int) -> None:
+        # A job moved up the queue stays in the heap at its old priority
+        # too, and is skipped once it has been taken
+        job.priority = priority
+        self._seq += 1
+        heappush(self._queues.setdefault(job.user, []), (priority, self._rank(job), self._seq, job))
+        self._cond.notify()
+
+    def _start_workers(self) -> None:
+        while len(self._workers) < self.threads:
+            worker = Thread(target=self._work, name=f"render-{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _next_queue(self) -> Optional[Tuple[Optional[str], List[Tuple[int, int, int, RenderJob]]]]:
+        # The most urgent priority queued, then the user with the fewest
+        # renders running, then the one served longest ago
+        for user, queue in list(self._queues.items()):
+            while queue and queue[0][3].taken:
+                heappop(queue)
+
+            if not queue:
+                del self._queues[user]
+
+        if not self._queues:
+            return None
+
+        user = min(
+            self._queues,
+            key=lambda user: (self._queues[user][0][0], self._running.get(user, 0), self._served.get(user, 0)),
+        )
+        return user, self._queues[user]
+
+    def _take(self) -> RenderJob:
+        with self._cond:
+            while True:
+                if (next_queue := self._next_queue()) is None:
+                    self._cond.wait()
+                    continue
+
+                user, queue = next_queue
+                priority, _, _, job = heappop(queue)
+                job.taken = True
+
+                if job.key is not None:
+                    self._jobs.pop(job.key, None)
+
+                if priority >= PRIORITY_PREFETCH:
+                    self._prefetches -= 1
+
+                    if job.layer is not None and self.is_idle(job.layer):
+                        logger.debug("Dropping prefetch for idle layer %s", job.layer)
+                        job.future.cancel()
+                        continue
+
+                if job.deadline is not None and time() > job.deadline:
+                    logger.debug("Dropping render %s past its deadline", job.key)
+                    job.future.cancel()
+                    continue
+
+                self._seq += 1
+                self._served[user] = self._seq
+                self._running[user] = self._running.get(user, 0) + 1
+                return job
+
+    def _work(self) -> None:
+        while True:
+            job = self._take()
+
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    try:
+                        job.future.set_result(job.fn(*job.args))
+                    except BaseException as ex:  # pylint: disable=W0703
+                        job.future.set_exception(ex)
+            finally:
+                with self._cond:
+                    self._running[job.user] -= 1
+
+                    if not self._running[job.user]:
+                        del self._running[job.user]
+
+def prefetch_tiles(x: int, y: int, z: int) -> List[mercantile.Tile]:
+    """The ring of tiles around a tile and its four children, which users
+    are most likely to pan or zoom to next"""
+    n = 2 ** z
+    tiles = []
+
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            # Wrap around the antimeridian but not the poles
+            if (dx or dy) and 0 <= y + dy < n:
+                tile = mercantile.Tile((x + dx) % n, y + dy, z)
+
+                if tile not in tiles and tile != (x, y, z):
+                    tiles.append(tile)
+
+    if z < MAX_PREFETCH_ZOOM:
+        tiles.extend(mercantile.children(x, y, z))
+
+    return tiles
+
+render_scheduler = RenderScheduler(config.render_threads)
@@ -0,0 +1,371 @@
+"""
+shading.py contains numba kernels that replace the generic
+datashader shade/spread path for the fixed-size tiles we render
+"""
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from datashader.colors import rgb
+from numba import njit
+
+import colorcet as cc
+import numpy as np
+import pandas as pd
+
+@lru_cache(64)
+def colormap_lut(cmap: str) -> np.ndarray:
+    """Colour lookup table for a colorcet palette
+
+    :param cmap: Colorcet color-map name
+    :return: (N, 3) float64 array of the palette's RGB values
+    """
+    lut = np.array([rgb(color) for color in cc.palette[cmap]], dtype=np.float64)
+    lut.setflags(write=False)
+    return lut
+
+@lru_cache(16)
+def circle_mask(px: int) -> np.ndarray:
+    """Circular spread mask with a diameter of ``2 * px + 1``, as used by ``tf.spread``
+
+    :param px: Number of pixels to spread on all sides
+    :return: Boolean mask
+    """
+    offsets = np.arange(-px, px + 1, dtype=np.int32)
+    mask = np.sqrt(offsets**2 + offsets[:, None]**2) <= px + 0.5
+    mask.setflags(write=False)
+    return mask
+
+@njit(nogil=True)
+def _over(src: np.uint32, dst: np.uint32) -> np.uint32:
+    # Same arithmetic as datashader.composite.over so spread output is identical
+    sr = (src & 255) / 255
+    sg = ((src >> 8) & 255) / 255
+    sb = ((src >> 16) & 255) / 255
+    sa = ((src >> 24) & 255) / 255
+    dr = (dst & 255) / 255
+    dg = ((dst >> 8) & 255) / 255
+    db = ((dst >> 16) & 255) / 255
+    da = ((dst >> 24) & 255) / 255
+
+    factor = 1 - sa
+    a = sa + da * factor
+
+    if a == 0:
+        return np.uint32(0)
+
+    r2 = min(255, np.uint32((sr * sa + dr * da * factor) / a * 255))
+    g2 = min(255, np.uint32((sg * sa + dg * da * factor) / a * 255))
+    b2 = min(255, np.uint32((sb * sa + db * da * factor) / a * 255))
+    a2 = min(255, np.uint32(a * 255))
+    return np.uint32((a2 << 24) | (b2 << 16) | (g2 << 8) | r2)
+
+@njit(nogil=True)
+def _unpack_flipped(packed, offset, out):
+    # Unpack into RGBA with the first row at the top, ready for encoding
+    height, width = out.shape[0], out.shape[1]
+
+    for y in range(height):
+        row = height - 1 - y
+
+        for x in range(width):
+            el = packed[y + offset, x + offset]
+            out[row, x, 0] = el & 255
+            out[row, x, 1] = (el >> 8) & 255
+            out[row, x, 2] = (el >> 16) & 255
+            out[row, x, 3] = (el >> 24) & 255
+
+@njit(nogil=True)
+def _spread_over(packed, mask, out):
+    # Spread each non-transparent pixel over the mask, compositing with the 'over' operator
+    height, width = packed.shape
+    w = mask.shape[0]
+    extra = w // 2
+
+    if extra == 0:
+        _unpack_flipped(packed, 0, out)
+        return
+
+    spread = np.zeros((height + 2 * extra, width + 2 * extra), dtype=np.uint32)
+
+    for y in range(height):
+        for x in range(width):
+            el = packed[y, x]
+
+            if ((el >> 24) & 255) == 0:
+                continue
+
+            for i in range(w):
+                for j in range(w):
+                    if mask[i, j]:
+                        # an opaque source composited 'over' anything is the source itself
+                        if spread[i + y, j + x] == 0 or ((el >> 24) & 255) == 255:
+                            spread[i + y, j + x] = el
+                        else:
+                            spread[i + y, j + x] = _over(el, spread[i + y, j + x])
+
+    _unpack_flipped(spread, extra, out)
+
+@njit(nogil=True)
+def _shade_log_spread(data, lut, span_lo, span_hi, alpha, mask, out):
+    height, width = data.shape
+    num_colors = lut.shape[0]
+    norm_hi = np.log1p(span_hi - span_lo)
+    packed = np.zeros((height, width), dtype=np.uint32)
+
+    # Log-scale each populated bin over the span and interpolate it into the palette
+    for y in range(height):
+        for x in range(width):
+            v = data[y, x]
+
+            if np.isnan(v):
+                continue
+
+            v = np.log1p(min(max(v, span_lo), span_hi) - span_lo)
+
+            if norm_hi > 0:
+                t = v / norm_hi * (num_colors - 1)
+            else:
+                t = num_colors - 1.0
+
+            i = int(t)
+
+            if i >= num_colors - 1:
+                r, g, b = lut[num_colors - 1, 0], lut[num_colors - 1, 1], lut[num_colors - 1, 2]
+            else:
+                frac = t - i
+                r = lut[i, 0] + frac * (lut[i + 1, 0] - lut[i, 0])
+                g = lut[i, 1] + frac * (lut[i + 1, 1] - lut[i, 1])
+                b = lut[i, 2] + frac * (lut[i + 1, 2] - lut[i, 2])
+
+            packed[y, x] = (np.uint32(alpha) << 24) | (np.uint32(b) << 16) | (np.uint32(g) << 8) | np.uint32(r)
+
+    _spread_over(packed, mask, out)
+
+def shade_heatmap(data: np.ndarray, cmap: str, span: Optional[Sequence[float]], spread: int = 0, alpha: int = 255) -> np.ndarray:
+    """Log-shade and spread a heat-mode aggregate
+
+    Equivalent to ``tf.spread(tf.shade(agg, cmap=cc.palette[cmap], how="log", span=span), spread)``,
+    but without the xarray overhead.
+
+    :param data: 2D float aggregate as produced by ``ds.Canvas.points``, origin at the bottom
+    :param cmap: Colorcet color-map name
+    :param span: Lower and upper data bounds mapped across the palette (None for the data's range)
+    :param spread: Number of pixels to spread on all sides
+    :param alpha: Alpha value of populated pixels
+    :return: (H, W, 4) uint8 RGBA array with the first row at the top
+    """
+    data = np.asarray(data, dtype=np.float64)
+    out = np.zeros(data.shape + (4,), dtype=np.uint8)
+
+    if np.isnan(data).all():
+        return out
+
+    if span is None:
+        span = (np.nanmin(data), np.nanmax(data))
+
+    _shade_log_spread(data, colormap_lut(cmap), float(span[0]), float(span[1]), alpha, circle_mask(max(int(spread), 0)), out)
+    return out
+
+def category_colors(categories: Iterable[str], color_key: Dict[str, str]) -> np.ndarray:
+    """Colour table for categorical shading
+
+    :param categories: Categories in category-code order
+    :param color_key: Mapping from category to hex color as built by ``create_color_key``
+    :return: (C, 3) float64 array of RGB values
+    """
+    return np.array([rgb(color_key[c]) for c in categories], dtype=np.float64).reshape(-1, 3)
+
+@njit(nogil=True)
+def _accumulate_top_k(xs, ys, codes, weights, sx, tx, sy, ty, x_range, y_range, top_codes, top_counts, overflow):
+    height, width, k = top_codes.shape
+    xmin, xmax = x_range
+    ymin, ymax = y_range
+
+    for n in range(xs.shape[0]):
+        x = xs[n]
+        y = ys[n]
+        code = codes[n]
+
+        # Same point-to-pixel mapping as ds.Canvas.points
+        if code < 0 or not (xmin <= x <= xmax and ymin <= y <= ymax):
+            continue
+
+        xi = int(x * sx + tx)
+        yi = int(y * sy + ty)
+
+        if x == xmax:
+            xi -= 1
+
+        if y == ymax:
+            yi -= 1
+
+        if xi < 0 or xi >= width or yi < 0 or yi >= height:
+            continue
+
+        # Slots fill left to right, so the first empty slot ends the search
+        slot = -1
+        smallest = 0
+
+        for s in range(k):
+            c = top_codes[yi, xi, s]
+
+            if c == code or c == -1:  # pylint: disable=consider-using-in
+                slot = s
+                break
+
+            if top_counts[yi, xi, s] < top_counts[yi, xi, smallest]:
+                smallest = s
+
+        if slot >= 0:
+            top_codes[yi, xi, slot] = code
+            top_counts[yi, xi, slot] += weights[n]
+        elif top_counts[yi, xi, smallest] < weights[n]:
+            # Evict the lightest category into the overflow total
+            overflow[yi, xi] += top_counts[yi, xi, smallest]
+            top_codes[yi, xi, smallest] = code
+            top_counts[yi, xi, smallest] = weights[n]
+        else:
+            overflow[yi, xi] += weights[n]
+
+@njit(nogil=True)
+def _colorize_top_k(top_codes, top_counts, colors, baseline, alphas, mask, out):
+    height, width, k = top_codes.shape
+    packed = np.zeros((height, width), dtype=np.uint32)
+
+    for y in range(height):
+        for x in range(width):
+            if alphas[y, x] == 0:
+                continue
+
+            # Weighted average of the category colours, as datashader's _colorize does
+            r = 0.0
+            g = 0.0
+            b = 0.0
+            total = 0.0
+            present = 0
+
+            for s in range(k):
+                code = top_codes[y, x, s]
+
+                if code < 0:
+                    break
+
+                weight = top_counts[y, x, s] - baseline
+                r += weight * colors[code, 0]
+                g += weight * colors[code, 1]
+                b += weight * colors[code, 2]
+                total += weight
+                present += 1
+
+            if total > 0:
+                r /= total
+                g /= total
+                b /= total
+            elif present > 0:
+                # Every category is at the baseline so take the plain average colour
+                r = 0.0
+                g = 0.0
+                b = 0.0
+
+                for s in range(present):
+                    code = top_codes[y, x, s]
+                    r += colors[code, 0]
+                    g += colors[code, 1]
+                    b += colors[code, 2]
+
+                r /= present
+                g /= present
+                b /= present
+
+            packed[y, x] = (np.uint32(alphas[y, x]) << 24) | (np.uint32(b) << 16) | (np.uint32(g) << 8) | np.uint32(r)
+
+    _spread_over(packed, mask, out)
+
+def log_alpha(total: np.ndarray, span: Optional[Sequence[float]], min_alpha: int, alpha: int = 255) -> np.ndarray:
+    """Log-scaled alpha channel for per-pixel totals, as datashader's ``_interpolate_alpha``
+
+    :param total: 2D per-pixel totals, NaN where there is no data
+    :param span: Lower and upper total bounds mapped across the alpha range (None for the data's range)
+    :param min_alpha: Alpha value of the smallest total
+    :param alpha: Alpha value of the largest total
+    :return: 2D uint8 alpha values
+    """
+    mask = np.isnan(total)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if span is None:
+            scaled = np.log1p(total - np.nanmin(total))
+            norm_span = [np.nanmin(scaled), np.nanmax(scaled)]
+        else:
+            scaled = np.log1p(np.where(mask, np.nan, np.clip(total, span[0], span[1])) - span[0])
+            norm_span = [0.0, np.log1p(span[1] - span[0])]
+
+        alphas = np.interp(scaled, norm_span, [min_alpha, alpha], left=0, right=255)
+
+    return np.nan_to_num(alphas, copy=False).astype(np.uint8)
+
+def shade_categories(
+    df: pd.DataFrame,
+    colors: np.ndarray,
+    x_range: Tuple[float, float],
+    y_range: Tuple[float, float],
+    width: int,
+    height: int,
+    span: Optional[Sequence[float]],
+    min_alpha: int,
+    spread: int = 0,
+    top_k: int = 16,
+) -> np.ndarray:
+    """Aggregate and shade categorical points keeping only the top-K categories per pixel
+
+    Equivalent to shading ``ds.Canvas.points(df, "x", "y", agg=ds.by("t", ds.sum("c")))`` with
+    ``tf.shade(how="log", color_key=...)`` and spreading, but memory is O(H x W x K) rather than
+    O(H x W x categories).  Categories beyond the K heaviest in a pixel still count towards its
+    alpha, but no longer towards its colour.
+
+    :param df: Points with "x", "y" (meters), "c" (count) and categorical "t" columns
+    :param colors: (C, 3) RGB values indexed by the category codes of "t"
+    :param x_range: Tile x bounds in meters
+    :param y_range: Tile y bounds in meters
+    :param width: Tile width in pixels
+    :param height: Tile height in pixels
+    :param span: Lower and upper count bounds mapped across the alpha range (None for the data's range)
+    :param min_alpha: Alpha value of the least dense pixels
+    :param spread: Number of pixels to spread on all sides
+    :param top_k: Number of categories kept per pixel
+    :return: (H, W, 4) uint8 RGBA array with the first row at the top
+    """
+    top_codes = np.full((height, width, top_k), -1, dtype=np.int32)
+    top_counts = np.zeros((height, width, top_k), dtype=np.float64)
+    overflow = np.zeros((height, width), dtype=np.float64)
+
+    sx = width / (x_range[1] - x_range[0])
+    sy = height / (y_range[1] - y_range[0])
+
+    _accumulate_top_k(
+        df["x"].to_numpy(dtype=np.float64),
+        df["y"].to_numpy(dtype=np.float64),
+        df["t"].cat.codes.to_numpy(dtype=np.int32),
+        df["c"].to_numpy(dtype=np.float64),
+        sx,
+        -x_range[0] * sx,
+        sy,
+        -y_range[0] * sy,
+        (float(x_range[0]), float(x_range[1])),
+        (float(y_range[0]), float(y_range[1])),
+        top_codes,
+        top_counts,
+        overflow,
+    )
+
+    out = np.zeros((height, width, 4), dtype=np.uint8)
+    populated = top_codes[:, :, 0] >= 0
+
+    if not populated.any():
+        return out
+
+    total = np.where(populated, top_counts.sum(axis=2) + overflow, np.nan)
+    baseline = max(float(top_counts[top_codes >= 0].min()), 0.0)
+
+    _colorize_top_k(top_codes, top_counts, colors, baseline, log_alpha(total, span, min_alpha), circle_mask(max(int(spread), 0)), out)
+    return out
@@ -26,10 +26,11 @@ from .drawing import (
     create_color_key,
     ellipse_planar_points,
     ellipse_spheroid_points,
-    gen_debug_overlay,
+    apply_overlays,
+    encode_tile,
     gen_empty,
-    gen_overlay,
 )
+from .density import DensityPyramid, load_density
 from .elastic import (
     parse_duration_interval,
     get_search_base,
@@ -38,16 +39,20 @@ from .elastic import (
     get_nested_field_from_hit,
     to_32bit_float,
     Scan,
-    ScanAggs,
     get_tile_categories,
     scan
 )
 from .logger import logger
+from .metrics import RenderStages
 from .pandas_util import simplify_categories
+from .query import CompiledScan, TileQuery, agg_body, composite_agg, geotile_grid_agg
+from .rolling import rolling_eligible, rolling_tile_points
+from .shading import category_colors, shade_categories, shade_heatmap
 
 NAN_LINE = {"x": None, "y": None, "c": "None"}
 TILE_HEIGHT_PX = 256
 TILE_WIDTH_PX = 256
+OVERLAY_COLOR = (128, 128, 128, 128)
 
 @dataclass
 class EllipseFieldNames:
@@ -495,14 +500,24 @@ def create_datashader_tracks_from_search(
 
             metrics["locations"] += 1
 
-def get_estimated_points_per_tile(span_range: Optional[str], global_bounds, zoom_level: int, global_doc_count: int) -> int:
+def get_estimated_points_per_tile(
+    span_range: Optional[str],
+    global_bounds,
+    zoom_level: int,
+    global_doc_count: int,
+    density: Optional[DensityPyramid] = None,
+) -> int:
     '''
-    Estimate the number of points per tile assuming uniform density
+    Estimate the number of points per tile from the layer's densest tile if
+    its density pyramid is known, otherwise assuming uniform density
     '''
     estimated_points_per_tile = None
 
     if span_range == "auto" or span_range is None:
-        if global_bounds:
+        if density is not None:
+            estimated_points_per_tile = density.max_tile_count(zoom_level)
+            logger.debug("Densest tile at zoom %s has %s points", zoom_level, estimated_points_per_tile)
+        elif global_bounds:
             num_tiles_at_level = mu.num_tiles(*global_bounds, zoom_level)
             estimated_points_per_tile = global_doc_count / num_tiles_at_level
             logger.debug(
@@ -566,8 +581,35 @@ def get_min_alpha(span_range: str, span_upper_bound: Optional[float]) -> int:
     alpha_span = int(span_upper_bound) * 25
     return 255 - min(alpha_span, 225)
 
+def finish_tile(
+    rgba: Optional[np.ndarray],
+    tile_width_px: int,
+    tile_height_px: int,
+    tile_format: str = "png",
+    hatch: bool = False,
+    debug_text: Optional[str] = None,
+) -> bytes:
+    """Apply the tile's overlays to the raster and encode it once
+
+    :param rgba: (H, W, 4) uint8 array with the first row at the top (None for an empty tile)
+    :param tile_width_px: Tile width in pixels
+    :param tile_height_px: Tile height in pixels
+    :param tile_format: Output format, one of ``TILE_FORMATS``
+    :param hatch: Hatch the tile to show it is incomplete (over max, aborted or partial)
+    :param debug_text: Text for the debug frame (None for no debug frame)
+    :return: Image bytes
+    """
+    if rgba is None:
+        if not hatch and debug_text is None and tile_format == "png":
+            return gen_empty(tile_width_px, tile_height_px)
+
+        rgba = np.zeros((tile_height_px, tile_width_px, 4), dtype=np.uint8)
+
+    rgba = apply_overlays(rgba, OVERLAY_COLOR if hatch else None, debug_text)
+    return encode_tile(rgba, tile_format, config.png_compress_level, config.png_compress_type)
+
 def generate_nonaggregated_tile(
-    idx, x, y, z, headers, params, tile_height_px=256, tile_width_px=256
+    idx, x, y, z, headers, params, tile_height_px=256, tile_width_px=256, stages=None
 ):
     # Handle legacy parameters
     geopoint_field = params["geopoint_field"]
@@ -591,6 +633,9 @@ def generate_nonaggregated_tile(
     field_min = params.get("generated_params", {}).get("field_min", None)
     render_mode = params["render_mode"]
 
+    if stages is None:
+        stages = RenderStages(params, z)
+
     logger.info(
         "Generating non-aggegated (%s) tile for: %s - %s/%s/%s.png, geopoint:%s timestamp:%s category:%s start:%s stop:%s",
         render_mode,
@@ -638,7 +683,7 @@ def generate_nonaggregated_tile(
 
         if render_mode == "ellipses":
             if z < config.ellipse_render_min_zoom:
-                img = gen_overlay(gen_empty(tile_width_px, tile_height_px), color=(128, 128, 128, 128))
+                img = finish_tile(None, tile_width_px, tile_height_px, params["tile_format"], hatch=True)
                 return img, metrics
             field_names = get_ellipse_field_names(params)
             count_s = count_s.source(includes=populated_field_names(field_names))
@@ -729,21 +774,15 @@ def generate_nonaggregated_tile(
             metrics.get("hits", 0),
         )
         metrics["query_time"] = s2 - s1
+        # Documents are scrolled through as they're turned into shapes
+        stages.observe("scan", s2 - s1)
 
         estimated_points_per_tile = get_estimated_points_per_tile(span_range, global_bounds, z, global_doc_cnt)
 
         # If count is zero then return a null image
         if len(df) == 0:
             logger.debug("No points in bounding box")
-            img = gen_empty(tile_width_px, tile_height_px)
-
-            if metrics.get("over_max"):
-                img = gen_overlay(img, color=(128, 128, 128, 128))
-            elif metrics.get("aborted"):
-                img = gen_overlay(img, color=(128, 128, 128, 128))
-
-            if params.get("debug"):
-                img = gen_debug_overlay(img, f"{z}/{x}/{y}")
+            rgba = None
         else:
             categories = [x for x in df["c"].unique() if x is not None]
             metrics["categories"] = json.dumps(categories)
@@ -768,12 +807,13 @@ def generate_nonaggregated_tile(
             )
 
             x_range, y_range = xy_ranges(x, y, z)
-            agg = ds.Canvas(
-                plot_width=tile_width_px,
-                plot_height=tile_height_px,
-                x_range=x_range,
-                y_range=y_range,
-            ).line(df, "x", "y", agg=rd.count_cat("c"))
+            with stages("rasterize"):
+                agg = ds.Canvas(
+                    plot_width=tile_width_px,
+                    plot_height=tile_height_px,
+                    x_range=x_range,
+                    y_range=y_range,
+                ).line(df, "x", "y", agg=rd.count_cat("c"))
 
             # now for the points as well
             points_agg = None
@@ -787,60 +827,67 @@ def generate_nonaggregated_tile(
                     color_key,
                     inplace=True,
                 )
-                points_agg = ds.Canvas(
-                    plot_width=tile_width_px,
-                    plot_height=tile_height_px,
-                    x_range=x_range,
-                    y_range=y_range,
-                ).points(df_points, "x", "y", agg=rd.count_cat("c"))
+                with stages("rasterize"):
+                    points_agg = ds.Canvas(
+                        plot_width=tile_width_px,
+                        plot_height=tile_height_px,
+                        x_range=x_range,
+                        y_range=y_range,
+                    ).points(df_points, "x", "y", agg=rd.count_cat("c"))
 
             span_upper_bound = get_span_upper_bound(span_range, estimated_points_per_tile)
             span = get_span_none(span_upper_bound)
             min_alpha = get_min_alpha(span_range, span_upper_bound)
 
-            img = tf.shade(
-                agg,
-                cmap=cc.palette[cmap],
-                color_key=color_key,
-                min_alpha=min_alpha,
-                how="log",
-                span=span,
-            )
-
-            # spread ellipse/tracks (i.e. make lines thicker)
-            if spread is not None and spread > 0:
-                img = tf.spread(img, spread)
-
-            if points_agg is not None:
-                points_img = tf.shade(
-                    points_agg,
+            with stages("shading"):
+                img = tf.shade(
+                    agg,
                     cmap=cc.palette[cmap],
-                    color_key=points_color_key,
+                    color_key=color_key,
                     min_alpha=min_alpha,
                     how="log",
                     span=span,
                 )
 
-                if (spread is not None) and (spread > 0):
-                    # Spread squares x3
-                    points_img = tf.spread(points_img, spread*3, shape='square')
-                else:
-                    points_img = tf.spread(points_img, 2, shape='square')
+            # spread ellipse/tracks (i.e. make lines thicker)
+            if spread is not None and spread > 0:
+                with stages("spreading"):
+                    img = tf.spread(img, spread)
 
-                # Stack end markers onto the tracks
-                img = tf.stack(img, points_img)
+            if points_agg is not None:
+                with stages("shading"):
+                    points_img = tf.shade(
+                        points_agg,
+                        cmap=cc.palette[cmap],
+                        color_key=points_color_key,
+                        min_alpha=min_alpha,
+                        how="log",
+                        span=span,
+                    )
 
-            img = img.to_bytesio().read()
+                with stages("spreading"):
+                    if (spread is not None) and (spread > 0):
+                        # Spread squares x3
+                        points_img = tf.spread(points_img, spread*3, shape='square')
+                    else:
+                        points_img = tf.spread(points_img, 2, shape='square')
 
-            if metrics.get("over_max"):
-                # Put hashing on image to indicate that it is over maximum
-                logger.info("Generating overlay for tile")
-                img = gen_overlay(img, color=(128, 128, 128, 128))
-            elif metrics.get("aborted"):
-                img = gen_overlay(img, color=(128, 128, 128, 128))
+                # Stack end markers onto the tracks
+                img = tf.stack(img, points_img)
 
-        if params.get("debug"):
-            img = gen_debug_overlay(img, f"{z}/{x}/{y}")
+            rgba = np.asarray(img.to_pil())
+
+        # Put hashing on image to indicate that it is over maximum
+        hatch = bool(metrics.get("over_max") or metrics.get("aborted"))
+        with stages("encode"):
+            img = finish_tile(
+                rgba,
+                tile_width_px,
+                tile_height_px,
+                params["tile_format"],
+                hatch=hatch,
+                debug_text=f"{z}/{x}/{y}" if params.get("debug") else None,
+            )
         # Set headers and return data
         return img, metrics
     except Exception:
@@ -923,12 +970,68 @@ def create_bounding_box_for_ellipses(x: int, y: int, z: int, search_meters: floa
         },
     }
 
-def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_px=256):
+MAXIMUM_PRECISION = 29
+
+def get_agg_zooms(resolution, category_field, max_bins, doc_cnt, tile_width_px=TILE_WIDTH_PX, tile_height_px=TILE_HEIGHT_PX) -> Tuple[int, int]:
+    '''
+    How many zoom levels deeper than a tile to aggregate at, at most and for
+    the requested resolution
+    '''
+    # Find number of pixels in required image
+    total_tile_pixel_count = tile_height_px * tile_width_px
+
+    # Calculate the geo precision that ensure we have at most one bin per 'pixel'.
+    # Every zoom level halves the number of pixels per bin assuming a square tile.
+    max_agg_zooms = math.ceil(math.log(total_tile_pixel_count, 4))
+    agg_zooms = max_agg_zooms
+
+    # TODO consider adding 'grid resolution' coarse, fine, finest (pixel-lock)
+    # In category-mode, zoom out if max_bins has not been increased
+
+    if category_field and max_bins < total_tile_pixel_count:
+        agg_zooms -= 1
+
+    if resolution == "coarse":
+        agg_zooms -= 2
+    elif resolution == "fine":
+        agg_zooms -= 1
+    elif resolution == "finest":
+        if category_field:
+            if doc_cnt > 5e3:
+                agg_zooms -= 2
+            elif doc_cnt > 1e6:
+                agg_zooms -= 3
+            elif doc_cnt > 5e6:
+                agg_zooms -= 4
+    else:
+        raise ValueError("invalid resolution value")
+
+    return max_agg_zooms, agg_zooms
+
+def get_density_agg_zooms(density: DensityPyramid, x: int, y: int, z: int, agg_zooms: int, max_bins: int, doc_cnt: int) -> int:
+    '''
+    Aggregate fewer zoom levels deeper for tiles whose documents are spread
+    over more geotiles than the max_bins buckets a grid aggregation returns,
+    which would otherwise drop the tile's sparsest cells
+    '''
+    while agg_zooms > 0 and min(doc_cnt, density.occupied_cells(x, y, z, z + agg_zooms)) > max_bins:
+        agg_zooms -= 1
+
+    return agg_zooms
+
+def get_geotile_precision(zoom: int, agg_zooms: int) -> int:
+    # don't allow geotile precision to be any worse than current zoom
+    return min(max(zoom, zoom + agg_zooms), MAXIMUM_PRECISION)
+
+def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_px=256, prefetched=None, stages=None):
     '''
     idx: ElasticSearch index to search
     x, y: TMS tile coordinates
     z: Zoom level
     params: HTTP request parameters
+    prefetched: Heat mode points, the scan that found them and the tile's
+        document count, from an aggregation shared with neighbouring tiles
+    stages: Times the stages of the render
     '''
 
     # Handle legacy keywords
@@ -952,6 +1055,10 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
     global_bounds = params.get("generated_params", {}).get("global_bounds")
     field_max = params.get("generated_params", {}).get("field_max", None)
     field_min = params.get("generated_params", {}).get("field_min", None)
+    density = load_density(params.get("generated_params", {}).get("density"))
+
+    if stages is None:
+        stages = RenderStages(params, z)
 
     metrics = {}
 
@@ -970,66 +1077,45 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
     try:
         bb_dict = create_bounding_box_for_tile(x, y, z)
 
-        # Create base search
-        base_s = get_search_base(config.elastic_hosts, headers, params, idx)
-        # base_s = base_s[0:0]
-        # Now find out how many documents
-        count_s = copy.copy(base_s)[0:0] # slice of array sets from/size since we are aggregating the data we don't need the hits
-        count_s = count_s.filter("geo_bounding_box", **{geopoint_field: bb_dict})
-        doc_cnt = count_s.count()
-        logger.info("Document Count: %s", doc_cnt)
-        metrics['doc_cnt'] = doc_cnt
+        # Compile the tile's query from the layer's base query
+        tile_query = TileQuery.from_params(headers, params, idx)
+        tile_q = tile_query.tile_query(geopoint_field, bb_dict)
+        rolling_window = prefetched is None and config.rolling_windows and rolling_eligible(params)
+        # Now find out how many documents, which the density pyramid already
+        # knows for coarse tiles and tiles in empty regions
+        if prefetched is not None:
+            doc_cnt = prefetched[2]
+        elif density is not None and (density.is_exact(z) or density.tile_count(x, y, z) == 0):
+            doc_cnt = density.tile_count(x, y, z)
+        elif rolling_window:
+            # Counted from the window's slices once they're assembled
+            doc_cnt = None
+        else:
+            with stages("count"):
+                doc_cnt = tile_query.count(tile_q)
+        if doc_cnt is not None:
+            logger.info("Document Count: %s", doc_cnt)
+            metrics['doc_cnt'] = doc_cnt
 
         # If count is zero then return a null image
         if doc_cnt == 0:
             logger.debug("No points in bounding box")
-            img = gen_empty(tile_width_px, tile_height_px)
-            if metrics.get("aborted"):
-                img = gen_overlay(img, color=(128, 128, 128, 128))
-            if params.get("debug"):
-                img = gen_debug_overlay(img, f"{z}/{x}/{y}")
+            with stages("encode"):
+                img = finish_tile(
+                    None,
+                    tile_width_px,
+                    tile_height_px,
+                    params["tile_format"],
+                    debug_text=f"{z}/{x}/{y}" if params.get("debug") else None,
+                )
             return img, metrics
 
-        # Find number of pixels in required image
-        total_tile_pixel_count = tile_height_px * tile_width_px
-
         current_zoom = z
-
-        # Calculate the geo precision that ensure we have at most one bin per 'pixel'.
-        # Every zoom level halves the number of pixels per bin assuming a square tile.
-        max_agg_zooms = math.ceil(math.log(total_tile_pixel_count, 4))
-        agg_zooms = max_agg_zooms
-
-        # TODO consider adding 'grid resolution' coarse, fine, finest (pixel-lock)
-        # In category-mode, zoom out if max_bins has not been increased
-
-        if category_field and max_bins < total_tile_pixel_count:
-            agg_zooms -= 1
-
-        if resolution == "coarse":
-            agg_zooms -= 2
-        elif resolution == "fine":
-            agg_zooms -= 1
-        elif resolution == "finest":
-            if category_field:
-                if doc_cnt > 5e3:
-                    agg_zooms -= 2
-                elif doc_cnt > 1e6:
-                    agg_zooms -= 3
-                elif doc_cnt > 5e6:
-                    agg_zooms -= 4
-        else:
-            raise ValueError("invalid resolution value")
-
-        # don't allow geotile precision to be any worse than current zoom
-        MAXIMUM_PERCISION = 29
-        geotile_precision = min(max(current_zoom, current_zoom + agg_zooms), MAXIMUM_PERCISION)
-
-        tile_s = copy.copy(base_s)
-        tile_s = tile_s.params(track_total_hits=False)
-        tile_s = tile_s.filter(
-            "geo_bounding_box", **{geopoint_field: bb_dict}
-        )
+        max_agg_zooms, agg_zooms = get_agg_zooms(resolution, category_field, max_bins, doc_cnt, tile_width_px, tile_height_px)
+        if density is not None and prefetched is None and not category_field and not rolling_window:
+            # Category modes and rolling windows page through every bucket, but a plain grid returns at most max_bins
+            agg_zooms = get_density_agg_zooms(density, x, y, z, agg_zooms, max_bins, doc_cnt)
+        geotile_precision = get_geotile_precision(current_zoom, agg_zooms)
 
         s1 = time.time()
 
@@ -1044,15 +1130,16 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
             if category_tile.z > int(params.get("mapZoom")):
                 category_tile = mercantile.parent(category_tile, zoom=int(params["mapZoom"]))
 
-            category_filters, _category_legend = get_tile_categories(
-                base_s,
-                category_tile.x,
-                category_tile.y,
-                category_tile.z,
-                geopoint_field,
-                category_field,
-                config.max_legend_items_per_tile,
-            )
+            with stages("categories"):
+                category_filters, _category_legend = get_tile_categories(
+                    tile_query.base_search,
+                    category_tile.x,
+                    category_tile.y,
+                    category_tile.z,
+                    geopoint_field,
+                    category_field,
+                    config.max_legend_items_per_tile,
+                )
 
             if len(category_filters) >= config.max_legend_items_per_tile:
                 agg_zooms -= 1
@@ -1106,12 +1193,13 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
         partial_data = False # TODO can we get partial data?
         span = None
         if field_type == "geo_point":
-            geo_tile_grid = A("geotile_grid", field=geopoint_field, precision=geotile_precision, size=max_bins)
+            inner_agg_dicts = {agg_name: agg.to_dict() for agg_name, agg in inner_aggs.items()}
+            grid_aggs = dict(inner_agg_dicts)
 
             if params['bucket_min']>0 or params['bucket_max']<1:
                 if global_doc_cnt is None or global_doc_cnt  == 0:
                     # this isn't good we need a real number so lets query the max aggregation ammount
-                    max_value_s = copy.copy(base_s)
+                    max_value_s = copy.copy(tile_query.base_search)
                     bucket = max_value_s.aggs.bucket("comp", "geotile_grid", field=geopoint_field, precision=geotile_precision, size=1)
                     if category_field:
                         bucket.metric("sum", "sum", field=category_field, missing=0)
@@ -1123,29 +1211,45 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
 
                 min_bucket = math.floor(math.exp(math.log(global_doc_cnt)*params['bucket_min']))
                 max_bucket = math.ceil(math.exp(math.log(global_doc_cnt)*params['bucket_max']))
-                geo_tile_grid.pipeline("selector", "bucket_selector", buckets_path={"doc_count": "_count"}, script=f"params.doc_count >= {min_bucket} && params.doc_count <= {max_bucket}")
-            if category_field:
-                geo_tile_grid = A("geotile_grid", field=geopoint_field, precision=geotile_precision)
-                resp = ScanAggs(tile_s, {"grids": geo_tile_grid}, inner_aggs, size=composite_agg_size, timeout=config.query_timeout_seconds)
+                selector = {
+                    "buckets_path": {"doc_count": "_count"},
+                    "script": f"params.doc_count >= {min_bucket} && params.doc_count <= {max_bucket}",
+                }
+                grid_aggs["selector"] = {"bucket_selector": selector}
+            df = None
+            if prefetched is not None:
+                df, resp, _ = prefetched
+            elif category_field:
+                sources = [("grids", geotile_grid_agg(geopoint_field, geotile_precision))]
+                body = agg_body(tile_q, composite_agg(sources, composite_agg_size, inner_agg_dicts))
+                resp = CompiledScan(tile_query, body, timeout=config.query_timeout_seconds, typed_response=True, stages=stages)
+            elif rolling_window:
+                # Sum cached per-slice aggregates and only query the newly exposed slices
+                tile_s = tile_query.base_search.params(track_total_hits=False).filter("geo_bounding_box", **{geopoint_field: bb_dict})
+                df, resp = rolling_tile_points(tile_s, idx, x, y, z, params, geotile_precision, composite_agg_size)
+                doc_cnt = int(df["c"].sum())
+                logger.info("Document Count: %s", doc_cnt)
+                metrics['doc_cnt'] = doc_cnt
             else:
-                if inner_aggs is not None:
-                    for agg_name, agg in inner_aggs.items():
-                        geo_tile_grid.aggs[agg_name] = agg
-                tile_s.aggs["comp"] = geo_tile_grid
-                resp = Scan([tile_s], timeout=config.query_timeout_seconds)
-            estimated_points_per_tile = get_estimated_points_per_tile(span_range, global_bounds, z, global_doc_cnt)
-            df = pd.DataFrame(
-                convert_composite(
-                    resp.execute(),
-                    (category_field is not None),
-                    bool(category_filters),
-                    histogram_interval,
-                    category_type,
-                    category_format
-                )
-            )
+                body = agg_body(tile_q, geotile_grid_agg(geopoint_field, geotile_precision, max_bins, grid_aggs))
+                resp = CompiledScan(tile_query, body, timeout=config.query_timeout_seconds, stages=stages)
+            estimated_points_per_tile = get_estimated_points_per_tile(span_range, global_bounds, z, global_doc_cnt, density)
+            if df is None:
+                # Pages are fetched as their buckets are converted
+                with stages("conversion", excluding="aggregation_page"):
+                    df = pd.DataFrame(
+                        convert_composite(
+                            resp.execute(),
+                            (category_field is not None),
+                            bool(category_filters),
+                            histogram_interval,
+                            category_type,
+                            category_format
+                        )
+                    )
 
         elif field_type == "geo_shape":
+            base_s = tile_query.base_search
             zoom = 0
             if resolution == "coarse":
                 zoom = 5
@@ -1156,7 +1260,7 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
             elif resolution == "finest":
                 zoom = 7
                 spread = 1
-            geotile_precision = min(current_zoom+zoom, MAXIMUM_PERCISION)
+            geotile_precision = min(current_zoom+zoom, MAXIMUM_PRECISION)
             searches = []
 
             if params.get("generated_params", {}).get('complete', False):
@@ -1227,17 +1331,18 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
                 logger.info("CREATING TIMEBUCKETS %s", interval)
                 searches = create_time_interval_searches(base_s, subtile_bb_dict, start_time, stop_time, timestamp_field, geopoint_field, geotile_precision, composite_agg_size, category_field, interval)
 
-            resp = Scan(searches, timeout=config.query_timeout_seconds, bucket_callback=bucket_callback)
-            df = pd.DataFrame(
-                convert_composite(
-                    resp.execute(),
-                    False, # we don't need categorical, because ES doesn't support composite buckets for geo_shapes we calculate that with a secondary search in the bucket_callback
-                    False, # we dont need filter_buckets, because ES doesn't support composite buckets for geo_shapes we calculate that with a secondary search in the bucket_callback
-                    histogram_interval,
-                    category_type,
-                    category_format
+            resp = Scan(searches, timeout=config.query_timeout_seconds, bucket_callback=bucket_callback, stages=stages)
+            with stages("conversion", excluding="aggregation_page"):
+                df = pd.DataFrame(
+                    convert_composite(
+                        resp.execute(),
+                        False, # we don't need categorical, because ES doesn't support composite buckets for geo_shapes we calculate that with a secondary search in the bucket_callback
+                        False, # we dont need filter_buckets, because ES doesn't support composite buckets for geo_shapes we calculate that with a secondary search in the bucket_callback
+                        histogram_interval,
+                        category_type,
+                        category_format
+                    )
                 )
-            )
             if len(df)/resp.num_searches == composite_agg_size:
                 logger.warning("clipping on tile %s", [x, y, z])
 
@@ -1255,13 +1360,19 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
 
 
         if len(df.index) == 0:
-            img = gen_empty(tile_width_px, tile_height_px)
-            if metrics.get("aborted"):
-                img = gen_overlay(img, color=(128, 128, 128, 128))
-            if params.get("debug"):
-                img = gen_debug_overlay(img, f"{z}/{x}/{y}")
+            with stages("encode"):
+                img = finish_tile(
+                    None,
+                    tile_width_px,
+                    tile_height_px,
+                    params["tile_format"],
+                    hatch=bool(metrics.get("aborted")),
+                    debug_text=f"{z}/{x}/{y}" if params.get("debug") else None,
+                )
             return img, metrics
 
+        spread = spread or calculate_pixel_spread(max_agg_zooms, agg_zooms)
+
         ###############################################################
         # Category Mode
         if category_field and field_type != "geo_shape":
@@ -1278,17 +1389,6 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
             cat_dtype = pd.api.types.CategoricalDtype(categories=categories, ordered=True)
             df["t"] = df["t"].astype(cat_dtype)
 
-            # When the number of categories exceeds the number of colors, we can simply
-            # replaced the category name with the desired color (i.e. use the color as the category)
-            # field.  This is especially important in highly categorical data where the number of
-            # categories can be very large and thus cause huge memory allocations in `_colorize`
-            #   _, color_key = simplify_categories(
-            #       df,
-            #       "t",
-            #       create_color_key(df["t"].cat.categories, cmap=cmap, highlight=highlight),
-            #       inplace=True,
-            #   )
-
             color_key=create_color_key(
                 df["t"].cat.categories,
                 cmap=cmap,
@@ -1298,38 +1398,40 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
                 histogram_interval=histogram_interval
             )
 
-            x_range, y_range = xy_ranges(x, y, z)
-            agg = ds.Canvas(
-                plot_width=tile_width_px,
-                plot_height=tile_height_px,
-                x_range=x_range,
-                y_range=y_range,
-            ).points(df, "x", "y", agg=ds.by("t", ds.sum("c")))
-
             span_upper_bound = get_span_upper_bound(span_range, estimated_points_per_tile)
             span = get_span_none(span_upper_bound)
             min_alpha = get_min_alpha(span_range, span_upper_bound)
 
+            # Only the heaviest categories in each pixel contribute to its colour,
+            # which keeps memory bounded for highly categorical data
             logger.debug("MinAlpha:%s Span:%s", min_alpha, span)
-            img = tf.shade(
-                agg,
-                cmap=cc.palette[cmap],
-                color_key=color_key,
-                min_alpha=min_alpha,
-                how="log",
-                span=span,
-            )
+            x_range, y_range = xy_ranges(x, y, z)
+            # Shading spreads pixels in the same pass
+            with stages("shading"):
+                rgba = shade_categories(
+                    df,
+                    category_colors(df["t"].cat.categories, color_key),
+                    x_range,
+                    y_range,
+                    tile_width_px,
+                    tile_height_px,
+                    span,
+                    min_alpha,
+                    spread,
+                    config.category_top_k,
+                )
 
         ###############################################################
         # Heat Mode
         else:
             x_range, y_range = xy_ranges(x, y, z)
-            agg = ds.Canvas(
-                plot_width=tile_width_px,
-                plot_height=tile_height_px,
-                x_range=x_range,
-                y_range=y_range,
-            ).points(df, "x", "y", agg=ds.sum("c"))
+            with stages("rasterize"):
+                agg = ds.Canvas(
+                    plot_width=tile_width_px,
+                    plot_height=tile_height_px,
+                    x_range=x_range,
+                    y_range=y_range,
+                ).points(df, "x", "y", agg=ds.sum("c"))
 
             # Handle span range, the span applies the color map across
             # the span range, so for example, if span is narrow, any
@@ -1340,26 +1442,26 @@ def generate_tile(idx, x, y, z, headers, params, tile_width_px=256, tile_height_
                 span = get_span_zero(span_upper_bound)
             logger.info("Span %s %s", span, span_range)
             logger.info("aggs min:%s max:%s", float(agg.min()), float(agg.max()))
-            img = tf.shade(agg, cmap=cc.palette[cmap], how="log", span=span)
+            with stages("shading"):
+                rgba = shade_heatmap(agg.data, cmap, span, spread)
 
         ###############################################################
         # Common
-        spread = spread or calculate_pixel_spread(max_agg_zooms, agg_zooms)
-        img = apply_spread(img, spread)
-        img = img.to_bytesio().read()
 
         if partial_data:
             logger.info(
                 "Generating overlay for tile due to partial category data"
             )
-            img = gen_overlay(img, color=(128, 128, 128, 128))
-        elif metrics.get("aborted"):
-            img = gen_overlay(img, color=(128, 128, 128, 128))
-
-        if params.get("debug"):
-            img = gen_debug_overlay(img, f"{z}/{x}/{y}")
-        elif metrics.get("aborted"):
-            img = gen_overlay(img, color=(128, 128, 128, 128))
+
+        with stages("encode"):
+            img = finish_tile(
+                rgba,
+                tile_width_px,
+                tile_height_px,
+                params["tile_format"],
+                hatch=bool(partial_data or metrics.get("aborted")),
+                debug_text=f"{z}/{x}/{y}" if params.get("debug") else None,
+            )
 
         # Set headers and return data
         return img, metrics
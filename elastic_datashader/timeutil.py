@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Tuple
+from typing import Optional, Tuple
 
 import math
 
@@ -42,6 +42,21 @@ def quantize_time_range(
     return truncated_start_time, truncated_stop_time
 
 
+def is_relative_time(time_string: Optional[str]) -> bool:
+    """Whether Kibana/ES date math depends on the current time
+
+    :param time_string: Date math, or None
+    :return: True if ``time_string`` is relative to ``now``
+
+    :Examples:
+    >>> is_relative_time("now-15m")
+    True
+    >>> is_relative_time("2024-01-01T00:00:00Z")
+    False
+    """
+    return time_string is not None and time_string.startswith("now")
+
+
 def convert_kibana_time(time_string: str, current_time: datetime, round_direction='down'):
     """
     Convert Kibana/ES date math into Python datetimes
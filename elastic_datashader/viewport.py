@@ -0,0 +1,118 @@
+"""
+viewport.py renders every tile of a map viewport together, so they share one
+parameter parse, one generated parameters lookup and, for heat mode points,
+one aggregation over the whole viewport.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from datashader.utils import lnglat_to_meters
+
+import mercantile
+import pandas as pd
+
+from .config import config
+from .elastic import geotile_bucket_to_lonlat
+from .logger import logger
+from .query import CompiledScan, TileQuery, agg_body, composite_agg, geotile_grid_agg
+from .rolling import rolling_eligible
+from .tilegen import create_bounding_box_for_tile, get_agg_zooms, get_geotile_precision
+
+# More tiles than a large screen shows at once, to bound the work one request can ask for
+MAX_VIEWPORT_TILES = 64
+
+def viewport_tiles(extent: Optional[Dict[str, float]], zoom: Optional[int]) -> List[mercantile.Tile]:
+    """Tiles intersecting a Kibana map extent
+
+    :param extent: ``minLon``, ``minLat``, ``maxLon`` and ``maxLat`` of the viewport
+    :param zoom: Map zoom level
+    :return: Tiles at ``zoom`` covering the extent
+    :raises ValueError: if the extent or zoom is missing, or covers too many tiles
+    """
+    if not extent or zoom is None:
+        raise ValueError("params must include the map extent and zoom")
+
+    tiles = list(mercantile.tiles(
+        max(-180.0, extent["minLon"]),
+        max(-85.051129, extent["minLat"]),
+        min(180.0, extent["maxLon"]),
+        min(85.051129, extent["maxLat"]),
+        int(zoom),
+    ))
+
+    if len(tiles) > MAX_VIEWPORT_TILES:
+        raise ValueError(f"viewport covers {len(tiles)} tiles, more than the {MAX_VIEWPORT_TILES} allowed")
+
+    return tiles
+
+def viewport_eligible(params: Dict[str, Any]) -> bool:
+    """Whether a layer's tiles are plain heat mode points, which can be
+    aggregated for a whole viewport and split up between tiles
+
+    Layers with a density pyramid aren't, since each of their tiles picks its
+    precision from its own density, which one shared aggregation can't.
+    """
+    return bool(
+        params.get("geofield_type") == "geo_point"
+        and not params.get("generated_params", {}).get("density")
+        and params.get("render_mode") not in ("ellipses", "tracks")
+        and not params.get("category_field")
+        and params.get("bucket_min", 0) <= 0
+        and params.get("bucket_max", 1) >= 1
+        and not (config.rolling_windows and rolling_eligible(params))
+    )
+
+def prefetch_viewport(headers, params: Dict[str, Any], idx: str, tiles: List[mercantile.Tile]) -> Dict[mercantile.Tile, Tuple[pd.DataFrame, CompiledScan]]:
+    """Aggregate the points of every tile in a viewport with one composite
+    aggregation, at the precision ``generate_tile`` would use for each tile
+
+    :param headers: Request headers
+    :param params: Parameters including generated parameters
+    :param idx: Index pattern
+    :param tiles: Tiles of one zoom level
+    :return: Points for ``generate_tile``'s ``prefetched`` argument, by tile,
+        with the scan that found them and the tile's document count
+    """
+    z = tiles[0].z
+    geopoint_field = params["geopoint_field"]
+    max_bins = params["max_bins"]
+    _, agg_zooms = get_agg_zooms(params["resolution"], None, max_bins, 0)
+    precision = get_geotile_precision(z, agg_zooms)
+
+    top_left = create_bounding_box_for_tile(min(tile.x for tile in tiles), min(tile.y for tile in tiles), z)["top_left"]
+    bottom_right = create_bounding_box_for_tile(max(tile.x for tile in tiles), max(tile.y for tile in tiles), z)["bottom_right"]
+
+    tile_query = TileQuery.from_params(headers, params, idx)
+    inner_aggs = {"centroid": {"geo_centroid": {"field": geopoint_field}}} if params.get("use_centroid") else None
+    body = agg_body(
+        tile_query.tile_query(geopoint_field, {"top_left": top_left, "bottom_right": bottom_right}),
+        composite_agg([("grids", geotile_grid_agg(geopoint_field, precision))], max_bins - 1, inner_aggs),
+    )
+    resp = CompiledScan(tile_query, body, timeout=config.query_timeout_seconds)
+
+    points = {tile: [] for tile in tiles}
+    shift = precision - z
+
+    for bucket in resp.execute():
+        _, bucket_x, bucket_y = (int(part) for part in bucket.key.grids.split("/"))
+        tile = mercantile.Tile(bucket_x >> shift, bucket_y >> shift, z)
+
+        if tile in points:
+            lon, lat = geotile_bucket_to_lonlat(bucket)
+            x, y = lnglat_to_meters(lon, lat)
+            points[tile].append({"lon": lon, "lat": lat, "x": x, "y": y, "c": bucket.doc_count})
+
+    logger.info("Viewport aggregation found %d points for %d tiles in %d searches", sum(map(len, points.values())), len(tiles), resp.num_searches)
+
+    prefetched = {}
+
+    for tile, tile_points in points.items():
+        df = pd.DataFrame(tile_points, columns=["lon", "lat", "x", "y", "c"])
+        doc_cnt = int(df["c"].sum())
+
+        # Each tile's own geotile_grid would only have returned its densest max_bins cells
+        if len(df.index) > max_bins:
+            df = df.nlargest(max_bins, "c")
+
+        prefetched[tile] = (df, resp, doc_cnt)
+
+    return prefetched
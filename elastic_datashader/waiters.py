@@ -0,0 +1,91 @@
+"""
+waiters.py lets tile requests wait for a render in this process to finish,
+rather than polling the cache on a fixed schedule.
+"""
+from asyncio import Event, TimeoutError as AsyncTimeoutError, get_running_loop, wait_for
+from contextlib import contextmanager, suppress
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Set
+
+class TileWaiter:
+    """Tiles a request is waiting on, and those whose renders have finished
+
+    :param names: Tile names
+    """
+    def __init__(self, names: Set[str]):
+        self.names = names
+        self.notified: Set[str] = set()
+        # Seconds spent in each stage of the renders that finished
+        self.stage_seconds: Dict[str, Dict[str, float]] = {}
+        self.loop = get_running_loop()
+        self._event = Event()
+
+    def mark(self, name: str, stage_seconds: Optional[Dict[str, float]] = None) -> None:
+        """Record a finished render; only call from ``loop``"""
+        self.notified.add(name)
+
+        if stage_seconds is not None:
+            self.stage_seconds[name] = stage_seconds
+
+        self._event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait for a render to finish, since the last wait returned
+
+        :param timeout: Seconds to wait at most
+        :return: True if a render finished, False if the wait timed out
+        """
+        try:
+            await wait_for(self._event.wait(), timeout)
+        except AsyncTimeoutError:
+            return False
+
+        self._event.clear()
+        return True
+
+class TileWaiters:
+    """Requests waiting on tiles by name, woken from the render's thread once
+    it finishes, whether or not it succeeded"""
+    def __init__(self):
+        self._lock = Lock()
+        self._waiters: Dict[str, List[TileWaiter]] = {}
+
+    @contextmanager
+    def waiting(self, *names: str) -> Iterator[TileWaiter]:
+        """Wait on renders of the named tiles within the context
+
+        Enter it before starting the renders, so none finish unnoticed.
+        """
+        waiter = TileWaiter(set(names))
+
+        with self._lock:
+            for name in waiter.names:
+                self._waiters.setdefault(name, []).append(waiter)
+
+        try:
+            yield waiter
+        finally:
+            with self._lock:
+                for name in waiter.names:
+                    waiters = self._waiters.get(name, [])
+
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+
+                    if not waiters:
+                        self._waiters.pop(name, None)
+
+    def notify(self, name: str, stage_seconds: Optional[Dict[str, float]] = None) -> None:
+        """Wake everything waiting on ``name``; safe to call from any thread
+
+        :param stage_seconds: Seconds the render spent in each stage, if it rendered
+        """
+        with self._lock:
+            waiters = list(self._waiters.get(name, ()))
+
+        for waiter in waiters:
+            # The loop may have shut down since the request started waiting
+            with suppress(RuntimeError):
+                waiter.loop.call_soon_threadsafe(waiter.mark, name, stage_seconds)
+
+tile_waiters = TileWaiters()
@@ -0,0 +1,355 @@
+"""
+warm.py fills the tile cache ahead of users, requesting or rendering only the
+tiles of a zoom range that intersect an area of interest, in parallel, with
+progress checkpointed so an interrupted run can pick up where it stopped.
+"""
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import cached_property
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.error import HTTPError
+from urllib.parse import parse_qsl, urljoin
+
+import time
+import urllib.request
+import uuid
+
+from starlette.requests import Request
+
+import mercantile
+import numpy as np
+
+from . import mercantile_util as mu
+from .cache_backends import tile_cache
+from .cache_policy import get_cache_policy
+from .config import config
+from .density import DensityPyramid, load_density
+from .logger import logger
+from .parameters import extract_parameters, merge_generated_parameters
+from .routers.tms import generate_tile_to_cache
+from .tilegen import generate_nonaggregated_tile, generate_tile
+
+# west, south, east, north
+BBox = Tuple[float, float, float, float]
+
+WORLD: BBox = (-180.0, -85.051129, 180.0, 85.051129)
+
+# Redirects followed for one tile before giving up on it
+MAX_RETRIES = 20
+
+def geometry_coordinates(geometry: Dict[str, Any]) -> Iterator[Tuple[float, float]]:
+    """Every position of a GeoJSON geometry"""
+    if geometry["type"] == "GeometryCollection":
+        for member in geometry["geometries"]:
+            yield from geometry_coordinates(member)
+        return
+
+    def walk(coords):
+        if coords and isinstance(coords[0], (int, float)):
+            yield coords[0], coords[1]
+        else:
+            for child in coords:
+                yield from walk(child)
+
+    yield from walk(geometry["coordinates"])
+
+def geojson_bboxes(geojson: Dict[str, Any]) -> List[BBox]:
+    """Bounding box of each geometry in a GeoJSON feature collection, feature or geometry"""
+    if geojson["type"] == "FeatureCollection":
+        return [bbox for feature in geojson["features"] for bbox in geojson_bboxes(feature)]
+
+    geometry = geojson["geometry"] if geojson["type"] == "Feature" else geojson
+
+    if not geometry:
+        return []
+
+    lons, lats = zip(*geometry_coordinates(geometry))
+    return [(min(lons), min(lats), max(lons), max(lats))]
+
+def split_antimeridian(bbox: BBox) -> List[BBox]:
+    """A bounding box whose west is east of its east as the two boxes either
+    side of the antimeridian"""
+    west, south, east, north = bbox
+
+    if west > east:
+        return [(west, south, 180.0, north), (-180.0, south, east, north)]
+
+    return [bbox]
+
+def intersect_bbox(a: BBox, b: BBox) -> List[BBox]:
+    """Parts of ``a`` within ``b``, either of which may cross the antimeridian"""
+    parts = []
+
+    for a_part in split_antimeridian(a):
+        for b_part in split_antimeridian(b):
+            west, south = max(a_part[0], b_part[0]), max(a_part[1], b_part[1])
+            east, north = min(a_part[2], b_part[2]), min(a_part[3], b_part[3])
+
+            if west <= east and south <= north:
+                parts.append((west, south, east, north))
+
+    return parts
+
+def bbox_tiles(bbox: BBox, zoom: int) -> Iterator[mercantile.Tile]:
+    """Tiles intersecting a bounding box"""
+    for west, south, east, north in mu.tiles_bounds(*bbox, zoom):
+        x, y, _ = mu.tile((west + east) / 2, (south + north) / 2, zoom)
+        yield mercantile.Tile(x, y, zoom)
+
+def enumerate_tiles(
+    bboxes: Iterable[BBox],
+    min_zoom: int,
+    max_zoom: int,
+    data_bounds: Optional[BBox] = None,
+    density: Optional[DensityPyramid] = None,
+) -> Iterator[mercantile.Tile]:
+    """Tiles of a zoom range intersecting any of ``bboxes``, by zoom level
+
+    :param bboxes: Areas to warm
+    :param min_zoom: Shallowest zoom
+    :param max_zoom: Deepest zoom
+    :param data_bounds: Bounds of the layer's data, outside which tiles are skipped
+    :param density: The layer's density pyramid, whose empty tiles are skipped
+    """
+    if data_bounds is not None:
+        bboxes = [clipped for bbox in bboxes for clipped in intersect_bbox(bbox, data_bounds)]
+    else:
+        bboxes = list(bboxes)
+
+    for zoom in range(min_zoom, max_zoom + 1):
+        seen: Set[mercantile.Tile] = set()
+
+        for bbox in bboxes:
+            for tile in bbox_tiles(bbox, zoom):
+                if tile in seen:
+                    continue
+
+                seen.add(tile)
+
+                if density is None or density.tile_count(tile.x, tile.y, tile.z) > 0:
+                    yield tile
+
+class Checkpoint:
+    """Tiles already warmed, appended to a file as they finish
+
+    The file's first line records which layer its tiles belong to, so a rerun
+    with different parameters doesn't skip tiles it never warmed.
+
+    :param path: Checkpoint file, which is created if it doesn't exist
+    :param layer: Identifies the layer being warmed, such as its parameter hash
+    :raises ValueError: If the file was written while warming a different layer
+    """
+    def __init__(self, path: Path, layer: str):
+        self.path = path
+        self.layer = layer
+        self._lock = Lock()
+        self.done: Set[str] = set()
+        lines = path.read_text(encoding="utf-8").splitlines() if path.exists() else []
+
+        if lines and lines[0] != f"# {layer}":
+            raise ValueError(f"checkpoint '{path}' was written while warming a different layer than {layer}")
+
+        self.done = set(lines[1:])
+        self._file = path.open("a", encoding="utf-8")
+
+        if not lines:
+            self._file.write(f"# {layer}\n")
+            self._file.flush()
+
+    def __contains__(self, tile: mercantile.Tile) -> bool:
+        return f"{tile.z}/{tile.x}/{tile.y}" in self.done
+
+    def record(self, *tiles: mercantile.Tile) -> None:
+        with self._lock:
+            for tile in tiles:
+                self.done.add(f"{tile.z}/{tile.x}/{tile.y}")
+                self._file.write(f"{tile.z}/{tile.x}/{tile.y}\n")
+
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+@dataclass
+class WarmStats:
+    """Outcome of a warming run"""
+    warmed: int = 0
+    failed: int = 0
+    skipped: int = 0
+    elapsed: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+
+    def percentile(self, q: float) -> float:
+        return float(np.percentile(self.latencies, q)) if self.latencies else 0.0
+
+    def summary(self) -> str:
+        rate = self.warmed / self.elapsed if self.elapsed else 0.0
+        return (
+            f"Warmed {self.warmed} tiles in {self.elapsed:.1f}s ({rate:.2f} tiles/s), "
+            f"{self.failed} failed, {self.skipped} already done; "
+            f"latency p50 {self.percentile(50):.2f}s p90 {self.percentile(90):.2f}s "
+            f"p99 {self.percentile(99):.2f}s max {max(self.latencies, default=0.0):.2f}s"
+        )
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+def fetch_tile(base_url: str, query: str, tile: mercantile.Tile, timeout: float) -> bool:
+    """Request a tile from a server, waiting out each ``Retry-After`` before
+    following its redirect, so the render isn't requested more than it needs to be
+
+    :param base_url: URL of the layer's index, such as ``http://localhost:6002/tms/my-index``
+    :param query: Layer parameters as a query string
+    :param tile: Tile to request
+    :param timeout: Seconds to wait for the tile
+    :return: True if the server responded with a rendered tile
+    """
+    url = f"{base_url.rstrip('/')}/{tile.z}/{tile.x}/{tile.y}.png" + (f"?{query}" if query else "")
+    deadline = time.time() + timeout
+
+    for _ in range(MAX_RETRIES):
+        try:
+            with _opener.open(url, timeout=max(1.0, deadline - time.time())) as response:
+                response.read()
+                # Bad parameters are answered with an error tile
+                return response.headers.get("Error") is None
+        except HTTPError as ex:
+            ex.close()
+
+            if ex.code not in (301, 302, 303, 307, 308):
+                return False
+
+            retry_after = float(ex.headers.get("Retry-After", 1))
+
+            if time.time() + retry_after > deadline:
+                return False
+
+            time.sleep(retry_after)
+            url = urljoin(url, ex.headers["Location"])
+
+    return False
+
+def warm_tiles(
+    tiles: Iterable[mercantile.Tile],
+    warm_tile: Callable[[mercantile.Tile], bool],
+    concurrency: int,
+    checkpoint: Optional[Checkpoint] = None,
+    progress: Optional[Callable[[mercantile.Tile, bool, float], None]] = None,
+    record: bool = True,
+) -> WarmStats:
+    """Warm tiles on ``concurrency`` threads
+
+    :param tiles: Tiles to warm
+    :param warm_tile: Requests or renders a tile, returning whether it succeeded
+    :param concurrency: Tiles warmed at once
+    :param checkpoint: Tiles already warmed, which are skipped, and that
+        successfully warmed tiles are added to
+    :param progress: Called with each tile, whether it succeeded and how long it took
+    :param record: Add warmed tiles to ``checkpoint``; False when the caller
+        records them itself once they're safely stored
+    :return: Counts and latencies
+    """
+    stats = WarmStats()
+    start = time.time()
+
+    def timed(tile: mercantile.Tile) -> Tuple[mercantile.Tile, bool, float]:
+        tile_start = time.time()
+
+        try:
+            ok = warm_tile(tile)
+        except Exception as ex:  # pylint: disable=W0703
+            logger.warning("Failed to warm tile %s/%s/%s: %s", tile.z, tile.x, tile.y, ex)
+            ok = False
+
+        return tile, ok, time.time() - tile_start
+
+    def finish(futures: Set[Future]) -> None:
+        for future in futures:
+            tile, ok, latency = future.result()
+            stats.latencies.append(latency)
+
+            if ok:
+                stats.warmed += 1
+
+                if checkpoint is not None and record:
+                    checkpoint.record(tile)
+            else:
+                stats.failed += 1
+
+            if progress is not None:
+                progress(tile, ok, latency)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending: Set[Future] = set()
+
+        for tile in tiles:
+            if checkpoint is not None and tile in checkpoint:
+                stats.skipped += 1
+                continue
+
+            # Keep the enumeration lazy, with at most two tiles queued per thread
+            if len(pending) >= 2 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                finish(done)
+
+            pending.add(executor.submit(timed, tile))
+
+        finish(wait(pending).done)
+
+    stats.elapsed = time.time() - start
+    return stats
+
+class TileRenderer:
+    """Renders a layer's tiles in this process, into the cache as the server
+    would or for the caller to store
+
+    :param idx: Index pattern
+    :param query: Layer parameters as a query string
+    :param headers: Request headers, such as ``es-security-runas-user``
+    """
+    def __init__(self, idx: str, query: str, headers: Optional[Dict[str, str]] = None):
+        self.idx = idx
+        self.request = Request({
+            "type": "http",
+            "method": "GET",
+            "scheme": "http",
+            "server": (config.hostname, 80),
+            "path": f"/tms/{idx}",
+            "query_string": query.encode(),
+            "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        })
+        self.parameter_hash, self.params = extract_parameters(self.request.headers, dict(parse_qsl(query, keep_blank_values=True)))
+
+    @cached_property
+    def layer_params(self) -> Dict[str, Any]:
+        """Parameters including generated parameters"""
+        return merge_generated_parameters(self.request.headers, dict(self.params), self.idx)
+
+    def data_bounds(self) -> Optional[BBox]:
+        """Bounds of the layer's documents, if they're known"""
+        bounds = self.layer_params["generated_params"].get("global_bounds")
+        return tuple(bounds) if bounds else None
+
+    def density(self) -> Optional[DensityPyramid]:
+        return load_density(self.layer_params["generated_params"].get("density"))
+
+    def render(self, tile: mercantile.Tile) -> Tuple[bytes, Dict[str, Any]]:
+        """Render a tile without caching it
+
+        :return: Tile image and render metrics
+        """
+        params = {**self.layer_params, "x-opaque-id": str(uuid.uuid4())}
+
+        if params["render_mode"] in ("ellipses", "tracks"):
+            return generate_nonaggregated_tile(self.idx, tile.x, tile.y, tile.z, self.request.headers, params)
+
+        return generate_tile(self.idx, tile.x, tile.y, tile.z, self.request.headers, params)
+
+    def __call__(self, tile: mercantile.Tile) -> bool:
+        generate_tile_to_cache(self.idx, tile.x, tile.y, tile.z, self.params, self.parameter_hash, self.request)
+        return tile_cache.exists(self.idx, tile.x, tile.y, tile.z, self.parameter_hash, get_cache_policy(self.params).ttl)
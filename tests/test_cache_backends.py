@@ -0,0 +1,202 @@
+from datetime import timedelta
+from time import sleep
+
+import sqlite3
+
+import pytest
+
+from elastic_datashader import cache, cache_backends
+from elastic_datashader.cache import get_index_hash
+from elastic_datashader.hotcache import HotTileCache
+
+@pytest.fixture(params=["filesystem", "sqlite"])
+def tile_cache(request, tmp_path):
+    if request.param == "sqlite":
+        return cache_backends.SQLiteTileCache(tmp_path, timedelta(seconds=60), timedelta(seconds=30))
+
+    return cache_backends.FilesystemTileCache(tmp_path)
+
+def test_put_get(tile_cache):
+    assert tile_cache.get("foo", 1, 2, 3, "somehash") is None
+    assert not tile_cache.exists("foo", 1, 2, 3, "somehash")
+
+    tile_cache.put("foo", 1, 2, 3, "somehash", b"helloworld")
+    assert tile_cache.get("foo", 1, 2, 3, "somehash") == b"helloworld"
+    assert tile_cache.exists("foo", 1, 2, 3, "somehash")
+    assert tile_cache.get("foo", 2, 1, 3, "somehash") is None
+    assert tile_cache.get("foo", 1, 2, 3, "otherhash") is None
+
+    tile_cache.put("foo", 1, 2, 3, "somehash", b"replaced")
+    assert tile_cache.get("foo", 1, 2, 3, "somehash") == b"replaced"
+
+def test_exists_max_age(tile_cache):
+    tile_cache.put("foo", 1, 2, 3, "somehash", b"helloworld")
+    sleep(0.01)
+
+    # Freshness follows the tile's cache policy rather than the cache timeout
+    assert not tile_cache.exists("foo", 1, 2, 3, "somehash", max_age=0)
+    assert tile_cache.exists("foo", 1, 2, 3, "somehash", max_age=7 * 24 * 60 * 60)
+
+def test_put_many(tile_cache):
+    tile_cache.put_many([
+        ("foo", 0, 0, 1, "somehash", b"a"),
+        ("foo", 1, 0, 1, "somehash", b"b"),
+        ("bar", 0, 0, 0, "somehash", b"c"),
+    ])
+    assert tile_cache.get("foo", 0, 0, 1, "somehash") == b"a"
+    assert tile_cache.get("foo", 1, 0, 1, "somehash") == b"b"
+    assert tile_cache.get("bar", 0, 0, 0, "somehash") == b"c"
+    assert set(tile_cache.index_names()) == {get_index_hash("foo"), get_index_hash("bar")}
+
+def test_claim_release(tile_cache):
+    assert not tile_cache.is_claimed("foo", 1, 2, 3, "somehash")
+    assert tile_cache.claim("foo", 1, 2, 3, "somehash")
+    assert tile_cache.is_claimed("foo", 1, 2, 3, "somehash")
+    assert not tile_cache.claim("foo", 1, 2, 3, "somehash")
+    assert tile_cache.claim("foo", 1, 2, 3, "otherhash")
+
+    tile_cache.release("foo", 1, 2, 3, "somehash")
+    assert not tile_cache.is_claimed("foo", 1, 2, 3, "somehash")
+    assert tile_cache.claim("foo", 1, 2, 3, "somehash")
+
+def test_clear(tile_cache):
+    tile_cache.put("foo", 1, 2, 3, "somehash", b"a")
+    tile_cache.put("foo", 1, 2, 3, "otherhash", b"b")
+    idx_name = get_index_hash("foo")
+
+    tile_cache.clear(idx_name, "somehash")
+    assert tile_cache.get("foo", 1, 2, 3, "somehash") is None
+    assert tile_cache.get("foo", 1, 2, 3, "otherhash") == b"b"
+
+    tile_cache.clear(idx_name)
+    assert tile_cache.get("foo", 1, 2, 3, "otherhash") is None
+
+    # clearing an unknown index is a no-op
+    tile_cache.clear("unknown")
+
+def test_evict(tile_cache):
+    tile_cache.put("foo", 1, 2, 3, "somehash", b"old")
+    sleep(2)
+    tile_cache.put("foo", 2, 2, 3, "somehash", b"new")
+
+    tile_cache.evict(get_index_hash("foo"), timedelta(seconds=1))
+    assert tile_cache.get("foo", 1, 2, 3, "somehash") is None
+    assert tile_cache.get("foo", 2, 2, 3, "somehash") == b"new"
+
+def test_stats_and_size(tile_cache):
+    tile_cache.put("foo", 1, 2, 3, "somehash", b"the quick brown fox")
+    tile_cache.put("foo", 1, 2, 3, "otherhash", b"jumps over the lazy dog")
+
+    stats = tile_cache.stats()
+    assert list(stats) == [get_index_hash("foo")]
+    assert set(stats[get_index_hash("foo")]) == {"somehash", "otherhash"}
+    assert "B" in stats[get_index_hash("foo")]["somehash"]["size"]
+    assert tile_cache.size() > 0
+
+def test_sqlite_stale_claim(tmp_path):
+    tile_cache = cache_backends.SQLiteTileCache(tmp_path, timedelta(seconds=60), timedelta(seconds=0))
+    assert tile_cache.claim("foo", 1, 2, 3, "somehash")
+    sleep(0.01)
+    assert tile_cache.claim("foo", 1, 2, 3, "somehash")
+
+def test_sqlite_tms_rows(tmp_path):
+    tile_cache = cache_backends.SQLiteTileCache(tmp_path, timedelta(seconds=60), timedelta(seconds=30))
+    tile_cache.put("foo", 1, 0, 2, "somehash", b"a")
+    conn = tile_cache._connect(get_index_hash("foo"))  # pylint: disable=W0212
+    assert conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles").fetchall() == [(2, 1, 3)]
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+def test_sqlite_reads_during_write(tmp_path):
+    tile_cache = cache_backends.SQLiteTileCache(tmp_path, timedelta(seconds=60), timedelta(seconds=30))
+    tile_cache.put("foo", 1, 0, 2, "somehash", b"a")
+    conn = tile_cache._connect(get_index_hash("foo"))  # pylint: disable=W0212
+    assert dict(conn.execute("SELECT name, value FROM metadata")) == {"name": get_index_hash("foo"), "format": "png"}
+
+    # Reads don't write, so they don't wait on another connection's write transaction
+    writer = sqlite3.connect(tile_cache.db_path(get_index_hash("foo")), isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+
+    try:
+        assert tile_cache.get("foo", 1, 0, 2, "somehash") == b"a"
+        assert tile_cache.exists("foo", 1, 0, 2, "somehash")
+        assert not tile_cache.is_claimed("foo", 1, 0, 2, "somehash")
+    finally:
+        writer.rollback()
+        writer.close()
+
+def test_hot_cache_layer(tmp_path):
+    store = cache_backends.FilesystemTileCache(tmp_path)
+    hot = HotTileCache(tmp_path / ".hot_cache", 1 << 18, set_bytes=1 << 16, ways=8)
+    layer = cache_backends.HotTileCacheLayer(store, hot, timedelta(seconds=60))
+
+    # renders write through to both layers
+    layer.put("foo", 1, 2, 3, "somehash", b"rendered")
+    assert hot.get(cache.tile_name("foo", 1, 2, 3, "somehash")) == b"rendered"
+
+    # tiles read from the store are promoted
+    store.put("foo", 2, 2, 3, "somehash", b"stored")
+    assert layer.get("foo", 2, 2, 3, "somehash") == b"stored"
+    (tmp_path / cache.tile_name("foo", 2, 2, 3, "somehash")).unlink()
+    assert layer.get("foo", 2, 2, 3, "somehash") == b"stored"
+    assert layer.exists("foo", 2, 2, 3, "somehash")
+    assert not layer.is_claimed("foo", 2, 2, 3, "somehash")
+
+    # hits read the creation time from the hot cache, not the store
+    created = store.created("foo", 1, 2, 3, "somehash")
+    (tmp_path / cache.tile_name("foo", 1, 2, 3, "somehash")).unlink()
+    assert abs(layer.created("foo", 1, 2, 3, "somehash") - created) < 1
+    assert layer.created("foo", 3, 2, 3, "somehash") is None
+
+    # hot entries older than the tile's TTL defer to the store
+    sleep(0.01)
+    assert not layer.exists("foo", 2, 2, 3, "somehash", max_age=0)
+    assert layer.claim("foo", 2, 2, 3, "somehash")
+    assert layer.is_claimed("foo", 2, 2, 3, "somehash", max_age=0)
+    layer.release("foo", 2, 2, 3, "somehash")
+
+    layer.clear(cache.get_index_hash("foo"), "somehash")
+    assert layer.get("foo", 1, 2, 3, "somehash") is None
+    assert layer.get("foo", 2, 2, 3, "somehash") is None
+
+@pytest.mark.parametrize("policy", ["lru", "lfu", "cost"])
+def test_enforce_capacity(tile_cache, policy):
+    tile_cache.put("foo", 0, 0, 1, "somehash", b"x" * 100, render_time=5.0)
+    tile_cache.put("foo", 1, 0, 1, "somehash", b"x" * 100, render_time=0.1)
+    tile_cache.put("bar", 0, 0, 1, "somehash", b"x" * 100, render_time=0.1)
+    sleep(0.01)
+
+    # the first tile is the most recently used, most hit and most expensive
+    tile_cache.get("foo", 0, 0, 1, "somehash")
+    tile_cache.get("foo", 0, 0, 1, "somehash")
+
+    tile_cache.enforce_capacity(0, 150, policy)
+    assert tile_cache.exists("foo", 0, 0, 1, "somehash")
+    assert not tile_cache.exists("foo", 1, 0, 1, "somehash")
+    assert tile_cache.exists("bar", 0, 0, 1, "somehash")
+
+    tile_cache.enforce_capacity(150, 0, policy)
+    assert tile_cache.exists("foo", 0, 0, 1, "somehash")
+    assert not tile_cache.exists("bar", 0, 0, 1, "somehash")
+
+    # no limits
+    tile_cache.enforce_capacity(0, 0, policy)
+    assert tile_cache.exists("foo", 0, 0, 1, "somehash")
+
+def test_filesystem_put_failures(tmp_path, monkeypatch):
+    tile_cache = cache_backends.FilesystemTileCache(tmp_path)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    # A tile that couldn't be written isn't left in the manifest
+    monkeypatch.setattr(cache_backends, "set_cache", fail)
+    with pytest.raises(OSError):
+        tile_cache.put("foo", 1, 2, 3, "somehash", b"helloworld")
+    assert tile_cache.size() == 0
+    monkeypatch.undo()
+
+    # Nor is a tile written that the manifest couldn't record
+    monkeypatch.setattr(tile_cache.manifest, "record_put", fail)
+    with pytest.raises(OSError):
+        tile_cache.put("foo", 1, 2, 3, "somehash", b"helloworld")
+    assert not tile_cache.exists("foo", 1, 2, 3, "somehash")
@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta, timezone
+
+from elastic_datashader.cache_policy import get_cache_policy
+from elastic_datashader.config import config
+
+NOW = datetime(2024, 3, 1, 12, 7, tzinfo=timezone.utc)
+
+def test_relative_policy():
+    params = {
+        "time_relative": True,
+        "start_time": datetime(2024, 3, 1, 11, 50, tzinfo=timezone.utc),
+        "stop_time": datetime(2024, 3, 1, 12, 5, tzinfo=timezone.utc),
+    }
+    policy = get_cache_policy(params, NOW)
+    assert policy.time_class == "relative"
+    assert policy.ttl == config.cache_timeout.total_seconds()
+    assert not policy.immutable
+
+    # the window moves on at 12:10
+    assert policy.max_age(0, NOW.timestamp()) == 180
+    assert policy.max_age(0, NOW.timestamp() + 600) == 0
+
+def test_historical_policy():
+    params = {
+        "time_relative": False,
+        "start_time": datetime(2024, 1, 1, tzinfo=timezone.utc),
+        "stop_time": datetime(2024, 2, 1, tzinfo=timezone.utc),
+    }
+    policy = get_cache_policy(params, NOW)
+    assert policy.time_class == "historical"
+    assert policy.ttl == config.cache_historical_timeout.total_seconds()
+    assert policy.immutable
+    assert policy.max_age(60, NOW.timestamp()) == int(policy.ttl) - 60
+
+def test_open_policy():
+    params = {
+        "time_relative": False,
+        "start_time": datetime(2024, 1, 1, tzinfo=timezone.utc),
+        "stop_time": NOW + timedelta(days=1),
+    }
+    policy = get_cache_policy(params, NOW)
+    assert policy.time_class == "open"
+    assert policy.ttl == config.cache_timeout.total_seconds()
+    assert not policy.immutable
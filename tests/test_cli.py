@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+
+import pytest
+
+from elastic_datashader import cli
+
+class FakeRenderer:
+    def __init__(self, idx, query, headers):
+        self.idx = idx
+        self.query = query
+        self.headers = headers
+        self.parameter_hash = "hash"
+        self.params = {"tile_format": "png8"}
+
+    def data_bounds(self):
+        return (0.0, 0.0, 10.0, 10.0)
+
+    def density(self):
+        return None
+
+    def render(self, tile):
+        return f"{tile.z}/{tile.x}/{tile.y}".encode(), {}
+
+class InlineExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers, mp_context=None, initializer=None, initargs=()):  # pylint: disable=W0613
+        super().__init__(max_workers, initializer=initializer, initargs=initargs)
+
+def test_parse_headers():
+    assert cli.parse_headers(["es-security-runas-user: analyst"]) == {"es-security-runas-user": "analyst"}
+
+    with pytest.raises(ValueError):
+        cli.parse_headers(["no separator"])
+
+def test_render_mbtiles(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(cli, "TileRenderer", FakeRenderer)
+    monkeypatch.setattr(cli, "ProcessPoolExecutor", InlineExecutor)
+    path = tmp_path / "layer.mbtiles"
+
+    assert cli.main(["render", "idx", "-s", "1", "-l", "2", "-p", "2", "-o", str(path), "--checkpoint", str(tmp_path / "done")]) == 0
+    assert "Warmed 2 tiles" in capsys.readouterr().out
+
+    # Only tiles intersecting the data are rendered
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY zoom_level").fetchall() == [
+        (1, 1, 1, b"1/1/0"),
+        (2, 2, 2, b"2/2/1"),
+    ]
+    # The format is the image type rather than the encoder
+    assert conn.execute("SELECT value FROM metadata WHERE name = 'format'").fetchone() == ("png",)
+    conn.close()
+
+    # Tiles are checkpointed once committed to the archive
+    assert (tmp_path / "done").read_text(encoding="utf-8").splitlines()[0] == "# idx hash"
+    assert sorted((tmp_path / "done").read_text(encoding="utf-8").splitlines()[1:]) == ["1/1/0", "2/2/1"]
+
+def test_render_mbtiles_checkpoints_committed_tiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, "TileRenderer", FakeRenderer)
+    monkeypatch.setattr(cli, "ProcessPoolExecutor", InlineExecutor)
+    checkpoint = tmp_path / "done"
+
+    def commit_fails(self):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    # Tiles that never made it into the archive aren't recorded as done
+    monkeypatch.setattr(cli.MBTilesWriter, "_commit", commit_fails)
+
+    with pytest.raises(sqlite3.OperationalError):
+        cli.main(["render", "idx", "-s", "1", "-l", "2", "-p", "1", "-o", str(tmp_path / "layer.mbtiles"), "--checkpoint", str(checkpoint)])
+
+    assert checkpoint.read_text(encoding="utf-8") == "# idx hash\n"
@@ -4,6 +4,7 @@ from pathlib import Path
 
 import os
 import socket
+import zlib
 
 import pytest
 
@@ -21,6 +22,24 @@ def test_config_defaults():
     assert cfg.max_ellipses_per_tile == 100000
     assert cfg.allowlist_headers is None
     assert cfg.query_timeout_seconds == 900
+    assert cfg.category_top_k == 16
+    assert cfg.cache_backend == "filesystem"
+    assert cfg.hot_cache_bytes == 0
+    assert cfg.hot_cache_path is None
+    assert cfg.png_compress_level == 6
+    assert cfg.png_compress_type == zlib.Z_DEFAULT_STRATEGY
+    assert cfg.tile_format == "png"
+    assert cfg.negotiate_tile_format is False
+    assert cfg.cache_max_bytes == 0
+    assert cfg.cache_max_bytes_per_index == 0
+    assert cfg.cache_eviction_policy == "lru"
+    assert cfg.cache_stale_grace == timedelta(seconds=300)
+    assert cfg.cache_historical_timeout == timedelta(days=7)
+    assert cfg.rolling_settle_time == timedelta(minutes=5)
+    assert cfg.rolling_windows is False
+    assert cfg.tile_wait == timedelta(seconds=30)
+    assert cfg.prefetch is False
+    assert cfg.render_threads == 8
     assert cfg.hostname == socket.getfqdn()
 
 
@@ -46,6 +65,24 @@ def test_config_env():
         "DATASHADER_ALLOWLIST_HEADERS": "blah",
         "DATASHADER_DEBUG_TILES": "True",
         "DATASHADER_QUERY_TIMEOUT": "1",
+        "DATASHADER_CATEGORY_TOP_K": "4",
+        "DATASHADER_CACHE_BACKEND": "sqlite",
+        "DATASHADER_HOT_CACHE_BYTES": "1048576",
+        "DATASHADER_HOT_CACHE_PATH": "/tmp/hot",
+        "DATASHADER_PNG_COMPRESS_LEVEL": "1",
+        "DATASHADER_PNG_COMPRESS_TYPE": "RLE",
+        "DATASHADER_TILE_FORMAT": "webp",
+        "DATASHADER_NEGOTIATE_TILE_FORMAT": "true",
+        "DATASHADER_CACHE_MAX_BYTES": "1000000",
+        "DATASHADER_CACHE_MAX_BYTES_PER_INDEX": "1000",
+        "DATASHADER_CACHE_EVICTION_POLICY": "COST",
+        "DATASHADER_CACHE_STALE_GRACE": "0",
+        "DATASHADER_CACHE_HISTORICAL_TIMEOUT": "86400",
+        "DATASHADER_ROLLING_SETTLE_TIME": "60",
+        "DATASHADER_ROLLING_WINDOWS": "true",
+        "DATASHADER_TILE_WAIT": "0",
+        "DATASHADER_PREFETCH": "true",
+        "DATASHADER_RENDER_THREADS": "2",
     }
 
     cfg = config.config_from_env(env)
@@ -60,12 +97,37 @@ def test_config_env():
     assert cfg.max_ellipses_per_tile == 100000
     assert cfg.allowlist_headers == "blah"
     assert cfg.query_timeout_seconds == 1
+    assert cfg.category_top_k == 4
+    assert cfg.cache_backend == "sqlite"
+    assert cfg.hot_cache_bytes == 1048576
+    assert cfg.hot_cache_path == Path("/tmp/hot")
+    assert cfg.png_compress_level == 1
+    assert cfg.png_compress_type == zlib.Z_RLE
+    assert cfg.tile_format == "webp"
+    assert cfg.negotiate_tile_format is True
+    assert cfg.cache_max_bytes == 1000000
+    assert cfg.cache_max_bytes_per_index == 1000
+    assert cfg.cache_eviction_policy == "cost"
+    assert cfg.cache_stale_grace == timedelta(0)
+    assert cfg.cache_historical_timeout == timedelta(days=1)
+    assert cfg.rolling_settle_time == timedelta(minutes=1)
+    assert cfg.rolling_windows is True
+    assert cfg.tile_wait == timedelta(0)
+    assert cfg.prefetch is True
+    assert cfg.render_threads == 2
     assert cfg.hostname == socket.getfqdn()
 
 def test_get_log_level():
     with pytest.raises(Exception):
         config.get_log_level("foo")
 
+def test_get_png_compress_type():
+    assert config.get_png_compress_type(None) == zlib.Z_DEFAULT_STRATEGY
+    assert config.get_png_compress_type("filtered") == zlib.Z_FILTERED
+
+    with pytest.raises(ValueError):
+        config.get_png_compress_type("foo")
+
 def test_true_if_none():
     assert config.true_if_none(None) == True
     assert config.true_if_none("off") == False
@@ -0,0 +1,75 @@
+from elasticsearch_dsl import AttrDict
+
+import pytest
+
+from elastic_datashader import density, tilegen
+
+def make_pyramid():
+    buckets = [
+        AttrDict({"key": "8/0/0", "doc_count": 5}),
+        AttrDict({"key": "8/1/1", "doc_count": 3}),
+        AttrDict({"key": "8/255/255", "doc_count": 40}),
+    ]
+    return density.DensityPyramid.from_buckets(buckets)
+
+def test_tile_count():
+    pyramid = make_pyramid()
+
+    assert pyramid.tile_count(0, 0, 0) == 48
+    assert pyramid.tile_count(0, 0, 1) == 8
+    assert pyramid.tile_count(1, 1, 1) == 40
+    assert pyramid.tile_count(1, 0, 1) == 0
+    assert pyramid.tile_count(1, 1, 8) == 3
+    assert pyramid.tile_count(2, 2, 8) == 0
+
+    # Deeper tiles report their ancestor's count
+    assert pyramid.is_exact(8)
+    assert not pyramid.is_exact(9)
+    assert pyramid.tile_count(3, 2, 9) == 3
+    assert pyramid.tile_count(4, 4, 9) == 0
+
+def test_max_tile_count():
+    pyramid = make_pyramid()
+
+    assert pyramid.max_tile_count(0) == 48
+    assert pyramid.max_tile_count(8) == 40
+    assert pyramid.max_tile_count(9) == 10
+    assert density.DensityPyramid.from_buckets([]).max_tile_count(3) == 0
+
+def test_encode_roundtrip():
+    pyramid = make_pyramid()
+    loaded = density.load_density(pyramid.encode())
+
+    assert loaded.precision == 8
+    assert loaded.tile_count(0, 0, 0) == 48
+    assert loaded.tile_count(255, 255, 8) == 40
+    assert density.load_density(None) is None
+
+def test_estimated_points_per_tile_uses_density():
+    pyramid = make_pyramid()
+
+    assert tilegen.get_estimated_points_per_tile("auto", [-180, -90, 180, 90], 1, 48, pyramid) == 40
+    assert tilegen.get_estimated_points_per_tile("normal", [-180, -90, 180, 90], 1, 48, pyramid) is None
+    assert tilegen.get_estimated_points_per_tile("auto", [-180, -90, 180, 90], 1, 48) == pytest.approx(12)
+
+def test_occupied_cells():
+    pyramid = make_pyramid()
+
+    assert pyramid.occupied_cells(0, 0, 0, 8) == 3
+    assert pyramid.occupied_cells(0, 0, 1, 8) == 2
+    assert pyramid.occupied_cells(0, 0, 1, 7) == 1
+    assert pyramid.occupied_cells(0, 0, 0, 10) == 48
+    assert pyramid.occupied_cells(1, 0, 1, 8) == 0
+
+    # Deeper tiles are assumed to be filled by their ancestor's cell
+    assert pyramid.occupied_cells(2, 2, 9, 12) == 64
+    assert pyramid.occupied_cells(4, 4, 9, 12) == 0
+
+def test_density_agg_zooms():
+    pyramid = make_pyramid()
+
+    # Three occupied cells at precision 8 become 3 * 4**2 at precision 10
+    assert tilegen.get_density_agg_zooms(pyramid, 0, 0, 0, 10, 1000, 48) == 10
+    assert tilegen.get_density_agg_zooms(pyramid, 0, 0, 0, 10, 20, 1000) == 9
+    assert tilegen.get_density_agg_zooms(pyramid, 0, 0, 0, 10, 2, 1000) == 7
+    assert tilegen.get_density_agg_zooms(pyramid, 0, 0, 0, 10, 0, 1000) == 0
@@ -1,5 +1,8 @@
 from pathlib import Path
 
+import io
+import zlib
+
 from PIL import Image
 
 import numpy as np
@@ -57,11 +60,51 @@ def test_gen_debug_overlay():
     actual = drawing.gen_debug_overlay(img, "hello, world!")
     # assert expected == actual # Pillow updates cause text rendering to differ
 
+def test_apply_overlays_matches_gen_overlay():
+    rng = np.random.default_rng(3)
+    rgba = rng.integers(0, 256, (256, 256, 4), dtype=np.uint8)
+    color = (128, 128, 128, 128)
+    expected = drawing.gen_debug_overlay(drawing.gen_overlay(drawing.encode_png(rgba), color=color), "1/2/3")
+    actual = drawing.apply_overlays(rgba, color, "1/2/3")
+    np.testing.assert_array_equal(actual, np.asarray(Image.open(io.BytesIO(expected))))
+
+def test_apply_overlays_none():
+    rgba = np.zeros((4, 4, 4), dtype=np.uint8)
+    assert drawing.apply_overlays(rgba) is rgba
+
+@pytest.mark.parametrize("compress_level, compress_type", ((0, zlib.Z_DEFAULT_STRATEGY), (9, zlib.Z_RLE)))
+def test_encode_png(compress_level, compress_type):
+    rgba = np.zeros((16, 16, 4), dtype=np.uint8)
+    rgba[4:8, 2:6] = (255, 0, 0, 255)
+    actual = drawing.encode_png(rgba, compress_level, compress_type)
+    np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(actual))), rgba)
+
+@pytest.mark.parametrize("tile_format, lossless", (("png", True), ("png-fast", True), ("png8", False), ("webp", True)))
+def test_encode_tile(tile_format, lossless):
+    rgba = np.zeros((16, 16, 4), dtype=np.uint8)
+    rgba[4:8, 2:6] = (255, 0, 0, 255)
+    rgba[8:12, 2:6] = (0, 0, 255, 128)
+    actual = Image.open(io.BytesIO(drawing.encode_tile(rgba, tile_format)))
+    assert Image.MIME[actual.format] == drawing.TILE_FORMATS[tile_format]
+    decoded = np.asarray(actual.convert("RGBA"))
+
+    if lossless:
+        np.testing.assert_array_equal(decoded, rgba)
+    else:
+        np.testing.assert_array_equal(decoded[:, :, 3], rgba[:, :, 3])
+
+def test_encode_tile_invalid():
+    with pytest.raises(ValueError):
+        drawing.encode_tile(np.zeros((4, 4, 4), dtype=np.uint8), "gif")
+
 def test_generate_x_tile():
     expected = Path("./tests/dat/gen_error.txt").read_bytes()
     actual = drawing.generate_x_tile(256, 256, 5)
     assert expected == actual
 
+def test_generate_x_tile_format():
+    assert drawing.generate_x_tile(256, 256, 5, tile_format="webp")[8:12] == b"WEBP"
+
 def test_gen_empty():
     expected = Path("./tests/dat/gen_empty.txt").read_bytes()
     actual = drawing.gen_empty(256, 256)
@@ -1,4 +1,5 @@
 from datetime import datetime, timezone
+from elasticsearch_dsl.exceptions import UnknownDslObject
 import pytest
 
 from elastic_datashader import elastic
@@ -32,6 +33,39 @@ def test_get_search_base():
     assert range_filter[params["timestamp_field"]]["gte"] == params["start_time"]
     assert range_filter[params["timestamp_field"]]["lte"] == params["stop_time"]
 
+def test_get_base_query():
+    params = {
+        "dsl_filter": {"filter": [{"match_all": {}}], "must_not": [{"term": {"foo": "bar"}}]},
+        "dsl_query": {"term": {"baz": 1}},
+        "lucene_query": "qux:*",
+        "start_time": datetime(2022, 6, 15, 12, 30, 0, tzinfo=timezone.utc),
+        "stop_time": datetime(2022, 6, 15, 12, 35, 0, tzinfo=timezone.utc),
+        "timestamp_field": "footime",
+    }
+
+    base_dict = elastic.get_base_query(params)
+    assert base_dict["query"]["bool"]["filter"][1:] == [
+        {"query_string": {"query": "qux:*"}},
+        {"term": {"baz": 1}},
+        {"match_all": {}},
+    ]
+    assert base_dict["query"]["bool"]["must_not"] == [{"term": {"foo": "bar"}}]
+
+    # Reused bodies can't be changed by callers
+    base_dict["query"]["bool"]["filter"].clear()
+    assert elastic.get_base_query(params) == elastic.build_base_query(params)
+
+    # DSL that elasticsearch_dsl can't parse is rejected, and not kept
+    bad_params = {**params, "dsl_query": {"not_a_real_query": {}}}
+    with pytest.raises(UnknownDslObject):
+        elastic.get_shared_base_query(bad_params)
+    with pytest.raises(UnknownDslObject):
+        elastic.get_shared_base_query(bad_params)
+
+    base_s = elastic.get_search_base("http://localhost:9200", {}, {**params, "user": "someone"}, "foo")
+    assert base_s.to_dict() == elastic.build_base_query(params)
+    assert base_s._params == {"ignore_unavailable": True, "preference": "someone"}  # pylint: disable=W0212
+
 def test_build_dsl_filter():
     meta = {"disabled":False,"negate":False,"alias":None}
     # geo_distance with query key (built when you create a filter from the map)
@@ -0,0 +1,97 @@
+from multiprocessing import get_context
+from threading import Thread
+from time import sleep, time
+
+from elastic_datashader import hotcache
+
+def test_put_get(tmp_path):
+    hot = hotcache.HotTileCache(tmp_path / "hot", 1 << 20, set_bytes=1 << 16, ways=8)
+    assert hot.get("foo/a/1/2/3.png") is None
+    assert hot.put("foo/a/1/2/3.png", b"helloworld")
+    assert hot.get("foo/a/1/2/3.png") == b"helloworld"
+
+    assert hot.put("foo/a/1/2/3.png", b"replaced")
+    assert hot.get("foo/a/1/2/3.png") == b"replaced"
+    assert hot.stats()[0] == 1
+
+def test_too_large(tmp_path):
+    hot = hotcache.HotTileCache(tmp_path / "hot", 1 << 16, set_bytes=1 << 16, ways=8)
+    assert not hot.put("big", b"x" * (1 << 16))
+    assert hot.get("big") is None
+
+def test_max_age(tmp_path):
+    hot = hotcache.HotTileCache(tmp_path / "hot", 1 << 16, set_bytes=1 << 16, ways=8)
+    hot.put("old", b"a", created=time() - 100)
+    assert hot.get("old") == b"a"
+    assert hot.get("old", max_age=10) is None
+    assert 99 < time() - hot.created("old") < 101
+    assert hot.created("missing") is None
+
+def test_lru_eviction(tmp_path):
+    # a single set of 4 ways
+    hot = hotcache.HotTileCache(tmp_path / "hot", 4096, set_bytes=4096, ways=4)
+
+    for i in range(4):
+        hot.put(f"key{i}", bytes([i]) * 100)
+
+    # touch key0 so key1 is the least recently used
+    assert hot.get("key0") is not None
+    hot.put("key4", b"e" * 100)
+
+    assert hot.get("key1") is None
+    for i in (0, 2, 3, 4):
+        assert hot.get(f"key{i}") is not None
+
+    # filling the data area evicts by recency and compacts the survivors
+    hot.put("key5", b"f" * 800)
+    assert hot.get("key5") == b"f" * 800
+    assert hot.stats()[1] <= hot.data_bytes
+
+def test_invalidate(tmp_path):
+    hot = hotcache.HotTileCache(tmp_path / "hot", 1 << 18, set_bytes=1 << 16, ways=8)
+    hot.put("foo/a/1/2/3.png", b"1", created=time() - 100)
+    hot.put("foo/b/1/2/3.png", b"2")
+    hot.put("bar/a/1/2/3.png", b"3")
+
+    assert hot.invalidate("foo/", older_than=time() - 10) == 1
+    assert hot.get("foo/a/1/2/3.png") is None
+    assert hot.invalidate("foo/") == 1
+    assert hot.get("foo/b/1/2/3.png") is None
+    assert hot.get("bar/a/1/2/3.png") == b"3"
+
+def put_in_child(path):
+    hot = hotcache.HotTileCache(path, 1 << 18, set_bytes=1 << 16, ways=8)
+    hot.put("shared", b"from child")
+
+def test_shared_between_processes(tmp_path):
+    # A forked child of a process with the app and numba loaded can hang at exit
+    hot = hotcache.HotTileCache(tmp_path / "hot", 1 << 18, set_bytes=1 << 16, ways=8)
+    assert hot.get("shared") is None
+
+    process = get_context("spawn").Process(target=put_in_child, args=(tmp_path / "hot",))
+    process.start()
+    process.join()
+
+    assert hot.get("shared") == b"from child"
+
+def test_open_once_per_process(tmp_path, monkeypatch):
+    hot = hotcache.HotTileCache(tmp_path / "hot", 1 << 18, set_bytes=1 << 16, ways=8)
+    maps = []
+    map_arena = hot._map  # pylint: disable=W0212
+
+    def slow_map():
+        maps.append(1)
+        sleep(0.05)
+        map_arena()
+
+    monkeypatch.setattr(hot, "_map", slow_map)
+    threads = [Thread(target=hot.put, args=(f"key{i}", b"value")) for i in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert len(maps) == 1
+    assert all(hot.get(f"key{i}") == b"value" for i in range(8))
@@ -0,0 +1,75 @@
+from time import time
+
+from elastic_datashader import cache
+from elastic_datashader.manifest import EVICTION_ORDER, CacheManifest, HitCounter, remove_tile_files
+
+def test_hit_counter():
+    counter = HitCounter(max_pending=2, max_delay=60)
+    assert not counter.add(("a",))
+    assert not counter.add(("a",))
+    assert counter.add(("b",))
+
+    drained = sorted(counter.drain(), key=lambda hit: hit[2])
+    assert [(hits, key) for hits, _, key in drained] == [(2, ("a",)), (1, ("b",))]
+    assert counter.drain() == []
+
+def test_manifest_put_hit_expire(tmp_path):
+    manifest = CacheManifest(tmp_path)
+    manifest.record_put("idx/somehash/3/1/2.png", 10, created=time() - 100)
+    manifest.record_put("idx/otherhash/3/1/2.png", 20)
+    manifest.record_put("other/somehash/3/1/2.png", 30, created=time() - 100)
+
+    manifest.record_hit("idx/somehash/3/1/2.png")
+    manifest.record_hit("idx/somehash/3/1/2.png")
+    manifest.flush_hits()
+    assert manifest._conn().execute("SELECT hits FROM tiles WHERE key = 'idx/somehash/3/1/2.png'").fetchone() == (2,)  # pylint: disable=W0212
+
+    assert sorted(manifest.index_names()) == ["idx", "other"]
+    assert manifest.total_size() == 60
+    assert manifest.expired("idx", time() - 50) == ["idx/somehash/3/1/2.png"]
+
+    stats = manifest.stats()
+    assert list(stats["idx"]) == ["otherhash", "somehash"]
+
+    manifest.remove(["idx/somehash/3/1/2.png"])
+    manifest.remove_prefix("other")
+    assert manifest.index_names() == ["idx"]
+    assert manifest.total_size() == 20
+
+def test_manifest_build(tmp_path):
+    cache.set_cache(tmp_path, "idx/somehash/3/1/2.png", b"helloworld")
+    cache.set_cache(tmp_path, "idx/somehash/3/1/3.png", b"hello")
+
+    manifest = CacheManifest(tmp_path)
+    assert not manifest.is_built()
+    manifest.build()
+    assert manifest.is_built()
+    assert manifest.total_size() == 15
+
+def test_remove_tile_files(tmp_path):
+    cache.set_cache(tmp_path, "idx/somehash/3/1/2.png", b"a")
+    cache.set_cache(tmp_path, "idx/somehash/4/1/2.png", b"b")
+
+    remove_tile_files(tmp_path, ["idx/somehash/3/1/2.png"])
+    assert not (tmp_path / "idx/somehash/3").exists()
+    assert (tmp_path / "idx/somehash/4/1/2.png").exists()
+
+    remove_tile_files(tmp_path, ["idx/somehash/4/1/2.png"])
+    assert not (tmp_path / "idx/somehash").exists()
+    assert (tmp_path / "idx").exists()
+
+def test_eviction_candidates_use_indexes(tmp_path):
+    manifest = CacheManifest(tmp_path)
+    manifest.record_put("idx/somehash/3/1/2.png", 10, created=time() - 100)
+    manifest.record_put("idx/somehash/3/1/3.png", 20)
+    assert [row[-1] for row in manifest.eviction_candidates("lru", "idx")] == ["idx/somehash/3/1/2.png", "idx/somehash/3/1/3.png"]
+
+    for policy in ("lru", "lfu"):
+        order = EVICTION_ORDER[policy]
+
+        for sql, args in (
+            (f"SELECT {order}, size, key FROM tiles ORDER BY {order}", ()),
+            (f"SELECT {order}, size, key FROM tiles WHERE idx_name = ? ORDER BY {order}", ("idx",)),
+        ):
+            plan = " ".join(row[-1] for row in manifest._conn().execute(f"EXPLAIN QUERY PLAN {sql}", args))  # pylint: disable=W0212
+            assert "TEMP B-TREE" not in plan
@@ -0,0 +1,37 @@
+import sqlite3
+
+import mercantile
+
+from elastic_datashader.mbtiles import MBTilesWriter
+
+def test_mbtiles_writer(tmp_path):
+    path = tmp_path / "layer.mbtiles"
+    writer = MBTilesWriter(path, "layer", "png", 0, 2, (-10.0, -5.0, 10.0, 5.0))
+    writer.put(mercantile.Tile(1, 0, 2), b"a")
+    writer.put(mercantile.Tile(1, 0, 2), b"b")
+    writer.close()
+
+    conn = sqlite3.connect(path)
+    metadata = dict(conn.execute("SELECT name, value FROM metadata"))
+    assert metadata["format"] == "png"
+    assert metadata["minzoom"] == "0"
+    assert metadata["maxzoom"] == "2"
+    assert metadata["bounds"] == "-10.0,-5.0,10.0,5.0"
+
+    # Rows count from the south
+    assert conn.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles").fetchall() == [(2, 1, 3, b"b")]
+    conn.close()
+
+def test_mbtiles_writer_on_commit(tmp_path, monkeypatch):
+    monkeypatch.setattr("elastic_datashader.mbtiles.COMMIT_EVERY", 2)
+    committed = []
+    writer = MBTilesWriter(tmp_path / "layer.mbtiles", "layer", "png", 0, 2, on_commit=committed.append)
+    writer.put(mercantile.Tile(0, 0, 1), b"a")
+    assert not committed
+
+    # Tiles are reported once they're committed, including at close
+    writer.put(mercantile.Tile(1, 0, 1), b"b")
+    assert committed == [[mercantile.Tile(0, 0, 1), mercantile.Tile(1, 0, 1)]]
+    writer.put(mercantile.Tile(0, 1, 1), b"c")
+    writer.close()
+    assert committed[1:] == [[mercantile.Tile(0, 1, 1)]]
@@ -0,0 +1,69 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+import pytest
+
+from elastic_datashader.metrics import RenderStages, server_timing, stage_labels, zoom_band
+from elastic_datashader.routers import metrics
+
+@pytest.mark.parametrize(
+    "z, band",
+    (
+        (0, "0-4"),
+        (4, "0-4"),
+        (5, "5-8"),
+        (12, "9-12"),
+        (16, "13-16"),
+        (17, "17+"),
+        (24, "17+"),
+    )
+)
+def test_zoom_band(z, band):
+    assert zoom_band(z) == band
+
+def test_stage_labels():
+    assert stage_labels({"render_mode": "tracks", "geofield_type": "geo_shape"}, 3) == {
+        "render_mode": "tracks",
+        "geofield_type": "geo_shape",
+        "zoom_band": "0-4",
+    }
+    # Aggregated modes leave render_mode unset
+    assert stage_labels({"render_mode": None}, 9)["render_mode"] == "points"
+
+def test_render_stages():
+    stages = RenderStages({"render_mode": "ellipses"}, 20)
+    labels = {"stage": "conversion", "render_mode": "ellipses", "geofield_type": "geo_point", "zoom_band": "17+"}
+    before = REGISTRY.get_sample_value("datashader_render_stage_seconds_count", labels) or 0
+
+    with stages("conversion", excluding="aggregation_page"):
+        stages.observe("aggregation_page", 5.0)
+        stages.observe("aggregation_page", 5.0)
+
+    # Pages fetched during the conversion aren't counted as conversion
+    assert stages.seconds["aggregation_page"] == 10.0
+    assert stages.seconds["conversion"] == 0.0
+    assert REGISTRY.get_sample_value("datashader_render_stage_seconds_count", labels) == before + 1
+
+def test_render_stages_count_tile():
+    stages = RenderStages({"render_mode": "tracks"}, 6)
+    before = REGISTRY.get_sample_value("datashader_over_max_tiles_total", stages.labels) or 0
+
+    stages.count_tile({"over_max": True, "aborted": False})
+    stages.count_tile({})
+
+    assert REGISTRY.get_sample_value("datashader_over_max_tiles_total", stages.labels) == before + 1
+
+def test_server_timing():
+    seconds = {"count": 0.25, "aggregation_page": 0.5, "shading": 0.125, "spreading": 0.125, "cache_write": 0.001}
+    assert server_timing(seconds) == "es;dur=750.0, shade;dur=250.0, cache;dur=1.0"
+    assert server_timing({}) == ""
+
+def test_get_metrics():
+    app = FastAPI()
+    app.include_router(metrics.router)
+
+    response = TestClient(app).get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert "datashader_cache_misses_total" in response.text
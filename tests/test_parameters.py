@@ -118,6 +118,15 @@ def test_get_category_field():
     assert parameters.get_category_field(None) is None
     assert parameters.get_category_field("banana") == "banana"
 
+def test_get_tile_format():
+    assert parameters.get_tile_format(None, None) == "png"
+    assert parameters.get_tile_format("", "image/webp,*/*") == "png"
+    assert parameters.get_tile_format("webp", None) == "webp"
+    assert parameters.get_tile_format("png8", "image/webp") == "png8"
+
+    with pytest.raises(ValueError):
+        parameters.get_tile_format("gif", None)
+
 def test_get_parameter_hash():
     assert parameters.get_parameter_hash({"foo": "bar", "baz": 1}) == "a6488297eb1cdaa23e196800b1c399"
     assert parameters.get_parameter_hash({"foo": "bar", "baz": 1, "abc": datetime(2022, 2, 17, 11, 0, 0, tzinfo=timezone.utc)}) == "88ade56886a8099e6fd3c25525a0fb"
@@ -152,3 +161,96 @@ def test_get_time_bounds_no_to():
     # quantization because stop_time is auto-populated
     assert time_bounds["start_time"] == datetime(2022, 6, 14, 12, 10, 0, tzinfo=timezone.utc)
     assert time_bounds["stop_time"] == now
+
+def test_generated_params_cache():
+    cache = parameters.GeneratedParamsCache(timedelta(seconds=60))
+    assert cache.get("layer") is None
+
+    cache.put("layer", {"complete": True})
+    assert cache.get("layer") == {"complete": True}
+
+    expired = parameters.GeneratedParamsCache(timedelta(seconds=-1))
+    expired.put("layer", {"complete": True})
+    assert expired.get("layer") is None
+
+def test_generated_params_cache_claim():
+    cache = parameters.GeneratedParamsCache(timedelta(seconds=60))
+    assert cache.claim("layer") is None
+
+    event = cache.claim("layer")
+    assert event is not None and not event.is_set()
+
+    cache.release("layer")
+    assert event.is_set()
+    assert cache.claim("layer") is None
+
+def test_merge_generated_parameters_cached(monkeypatch):
+    calls = []
+
+    def fetch(headers, params, idx, layer_id):
+        calls.append(layer_id)
+        return {"complete": len(calls) > 1}
+
+    monkeypatch.setattr(parameters, "fetch_generated_parameters", fetch)
+    monkeypatch.setattr(parameters, "generated_params_cache", parameters.GeneratedParamsCache(timedelta(seconds=60)))
+
+    # Incomplete parameters aren't cached
+    assert parameters.merge_generated_parameters({}, {}, "idx")["generated_params"] == {"complete": False}
+    assert parameters.merge_generated_parameters({}, {}, "idx")["generated_params"] == {"complete": True}
+    assert parameters.merge_generated_parameters({}, {}, "idx")["generated_params"] == {"complete": True}
+    assert len(calls) == 2
+
+def test_get_layer_id():
+    params = {
+        "geopoint_field": "location",
+        "geofield_type": "geo_point",
+        "start_time": datetime(2024, 1, 1, tzinfo=timezone.utc),
+        "stop_time": datetime(2024, 1, 2, tzinfo=timezone.utc),
+        "lucene_query": "foo:bar",
+        "span_range": "auto",
+        "resolution": "finest",
+        "cmap": "bmy",
+        "spread": 1,
+    }
+    layer_id = parameters.get_layer_id("idx", params)
+
+    # Styling doesn't change the layer
+    assert parameters.get_layer_id("idx", {**params, "cmap": "fire", "spread": 3, "resolution": "coarse"}) == layer_id
+    assert parameters.get_layer_id("idx", {**params, "span_range": None}) == layer_id
+
+    # The documents aggregated do
+    assert parameters.get_layer_id("other", params) != layer_id
+    assert parameters.get_layer_id("idx", {**params, "lucene_query": "foo:baz"}) != layer_id
+    assert parameters.get_layer_id("idx", {**params, "span_range": "wide"}) != layer_id
+    assert parameters.get_layer_id("idx", {**params, "geofield_type": "geo_shape"}) != parameters.get_layer_id(
+        "idx", {**params, "geofield_type": "geo_shape", "resolution": "coarse"}
+    )
+
+def test_extract_parameters_reuses_parse(monkeypatch):
+    calls = []
+    parse_parameters = parameters.parse_parameters
+
+    def counting_parse(*args):
+        calls.append(args)
+        return parse_parameters(*args)
+
+    monkeypatch.setattr(parameters, "parse_parameters", counting_parse)
+    monkeypatch.setattr(parameters, "_parsed_requests", parameters.OrderedDict())
+
+    query_params = {
+        "geopoint_field": "location",
+        "params": '{"timeFilters": {"from": "2022-06-15T12:00:00Z", "to": "2022-06-15T13:00:00Z"}}',
+    }
+    parameter_hash, params = parameters.extract_parameters({}, query_params)
+    params["generated_params"] = {"complete": True}
+
+    reused_hash, reused_params = parameters.extract_parameters({}, query_params)
+    assert reused_hash == parameter_hash
+    assert "generated_params" not in reused_params
+    assert len(calls) == 1
+
+    # Relative windows that can't be quantized are parsed every time
+    query_params = {"geopoint_field": "location", "params": '{"timeFilters": {"to": "now"}}'}
+    parameters.extract_parameters({}, query_params)
+    parameters.extract_parameters({}, query_params)
+    assert len(calls) == 3
@@ -0,0 +1,26 @@
+import sys
+import time
+
+from elastic_datashader.profiler import SamplingProfiler, stack_names
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+
+    while time.perf_counter() < end:
+        pass
+
+def test_stack_names():
+    names = stack_names(sys._getframe())  # pylint: disable=W0212
+    assert names[-1].startswith("test_stack_names (test_profiler.py:")
+
+def test_sampling_profiler():
+    with SamplingProfiler(interval=0.001) as profiler:
+        spin(0.1)
+
+    assert sum(profiler.samples.values()) > 0
+
+    lines = profiler.folded().splitlines()
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert "test_sampling_profiler (test_profiler.py:" in stack
+    assert stack.split(";")[-1].startswith("spin (test_profiler.py:")
@@ -0,0 +1,113 @@
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+
+from elasticsearch_dsl import A
+
+import pytest
+
+from elastic_datashader import elastic, query
+
+BB_DICT = {"top_left": {"lat": 10, "lon": -10}, "bottom_right": {"lat": -10, "lon": 10}}
+
+def make_params(**kwargs):
+    return {
+        "dsl_filter": None,
+        "dsl_query": None,
+        "lucene_query": None,
+        "start_time": datetime(2022, 6, 15, 12, 30, 0, tzinfo=timezone.utc),
+        "stop_time": datetime(2022, 6, 15, 12, 35, 0, tzinfo=timezone.utc),
+        "timestamp_field": "footime",
+        **kwargs,
+    }
+
+def dsl_body(search):
+    # The compiled bodies don't page through hits at all, rather than from 0
+    body = search.to_dict()
+    del body["from"]
+    return {**body, "track_total_hits": False}
+
+def make_tile_query(params):
+    return query.TileQuery(MagicMock(), "foo", query.QueryTemplate(elastic.build_base_query(params)), elastic.get_search_params(params), params)
+
+@pytest.mark.parametrize("params", [
+    make_params(),
+    make_params(lucene_query="qux:*", user="someone"),
+    make_params(
+        timestamp_field=None,
+        dsl_query={"term": {"baz": 1}},
+        dsl_filter={"filter": [{"match_all": {}}], "must_not": [{"term": {"foo": "bar"}}]},
+    ),
+])
+def test_matches_dsl(params):
+    tile_query = make_tile_query(params)
+    base_s = elastic.get_search_base("http://localhost:9200", {}, params, "foo")
+
+    # Heatmap grid with a centroid
+    tile_s = base_s.params(track_total_hits=False).filter("geo_bounding_box", location=BB_DICT)[0:0]
+    grid = A("geotile_grid", field="location", precision=12, size=1000)
+    grid.aggs["centroid"] = A("geo_centroid", field="location")
+    tile_s.aggs["comp"] = grid
+
+    body = query.agg_body(
+        tile_query.tile_query("location", BB_DICT),
+        query.geotile_grid_agg("location", 12, 1000, {"centroid": {"geo_centroid": {"field": "location"}}}),
+    )
+    assert body == dsl_body(tile_s)
+    assert tile_query.search_params == base_s._params  # pylint: disable=W0212
+
+    # Composite grid
+    tile_s = base_s.filter("geo_bounding_box", location=BB_DICT)[0:0]
+    tile_s.aggs.bucket("comp", "composite", sources=[{"grids": A("geotile_grid", field="location", precision=12)}], size=99)
+
+    body = query.agg_body(
+        tile_query.tile_query("location", BB_DICT),
+        query.composite_agg([("grids", query.geotile_grid_agg("location", 12))], 99),
+    )
+    assert body == dsl_body(tile_s)
+
+def test_template_leaves_base_query_alone():
+    params = make_params(lucene_query="qux:*")
+    base_query = elastic.build_base_query(params)
+    template = query.QueryTemplate(base_query)
+
+    template.query(query.bbox_filter("location", BB_DICT))
+    assert base_query == elastic.build_base_query(params)
+
+def make_response(buckets, after_key=None):
+    comp = {"buckets": buckets}
+    if after_key:
+        comp["after_key"] = after_key
+
+    return {
+        "took": 3,
+        "_shards": {"total": 2, "skipped": 0, "successful": 2, "failed": 0},
+        "aggregations": {"comp": comp},
+    }
+
+def test_compiled_scan_pages():
+    tile_query = MagicMock()
+    tile_query.search.side_effect = [
+        make_response([{"key": {"grids": "1/0/0"}, "doc_count": 1}], {"grids": "1/0/0"}),
+        make_response([{"key": {"grids": "1/1/1"}, "doc_count": 2}], {"grids": "1/1/1"}),
+        make_response([]),
+    ]
+    body = query.agg_body({"match_all": {}}, query.composite_agg([("grids", query.geotile_grid_agg("location", 1))], 1))
+    scan = query.CompiledScan(tile_query, body)
+
+    assert [bucket.doc_count for bucket in scan.execute()] == [1, 2]
+    assert scan.num_searches == 3
+    assert scan.total_took == 9
+    assert scan.total_shards == 6
+
+    first, second, _ = [call.args[0] for call in tile_query.search.call_args_list]
+    assert "after" not in first["aggs"]["comp"]["composite"]
+    assert second["aggs"]["comp"]["composite"]["after"] == {"grids": "1/0/0"}
+    assert body == first
+
+def test_compiled_scan_single_search():
+    tile_query = MagicMock()
+    tile_query.search.return_value = make_response([{"key": "1/0/0", "doc_count": 1}, {"key": "1/1/1", "doc_count": 2}])
+    scan = query.CompiledScan(tile_query, query.agg_body({"match_all": {}}, query.geotile_grid_agg("location", 1, 10)))
+
+    assert [bucket.key for bucket in scan.execute()] == ["1/0/0", "1/1/1"]
+    assert scan.num_searches == 1
@@ -0,0 +1,90 @@
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+from elasticsearch_dsl import AttrDict
+
+import numpy as np
+
+from elastic_datashader import rolling
+
+START = datetime(2024, 3, 1, 11, 0, tzinfo=timezone.utc)
+STOP = datetime(2024, 3, 1, 11, 20, tzinfo=timezone.utc)
+
+def make_params(**kwargs):
+    return {
+        "time_relative": True,
+        "timestamp_field": "@timestamp",
+        "geopoint_field": "location",
+        "geofield_type": "geo_point",
+        "start_time": START,
+        "stop_time": STOP,
+        "category_field": None,
+        "use_centroid": False,
+        "timeOverlap": False,
+        "bucket_min": 0,
+        "bucket_max": 1,
+        **kwargs,
+    }
+
+def test_rolling_eligible():
+    assert rolling.rolling_eligible(make_params())
+    assert not rolling.rolling_eligible(make_params(time_relative=False))
+    assert not rolling.rolling_eligible(make_params(category_field="foo"))
+    assert not rolling.rolling_eligible(make_params(use_centroid=True))
+    assert not rolling.rolling_eligible(make_params(bucket_min=0.5))
+    assert not rolling.rolling_eligible(make_params(stop_time=STOP + timedelta(seconds=1)))
+
+def test_slice_starts():
+    starts = rolling.slice_starts(START, STOP)
+    assert len(starts) == 4
+    assert starts[0] == START.timestamp()
+    assert starts[-1] == (STOP - rolling.SLICE).timestamp()
+
+def test_slice_store(tmp_path):
+    store = rolling.SliceStore(tmp_path)
+    points = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+    store.put_many("key", 1, 2, 3, 11, {100.0: points, 400.0: np.empty((0, 3))})
+
+    slices = store.get_many("key", 1, 2, 3, 11, 0, 1000)
+    assert set(slices) == {100.0, 400.0}
+    np.testing.assert_array_equal(slices[100.0], points)
+    assert slices[400.0].shape == (0, 3)
+    assert not store.get_many("key", 1, 2, 3, 12, 0, 1000)
+
+    store.prune(timedelta(seconds=-1))
+    assert not store.get_many("key", 1, 2, 3, 11, 0, 1000)
+
+def bucket(slice_start: datetime, count: int):
+    return AttrDict({"key": {"grids": "11/1/2", "slice": int(slice_start.timestamp() * 1000)}, "doc_count": count})
+
+def test_rolling_tile_points(tmp_path, monkeypatch):
+    monkeypatch.setattr(rolling, "slice_store", rolling.SliceStore(tmp_path))
+    monkeypatch.setattr(rolling, "time", lambda: STOP.timestamp() + 60)
+    tile_s = MagicMock()
+    scans = []
+
+    def fake_scan(search, sources, size, timeout):  # pylint: disable=W0613
+        gte = tile_s.filter.call_args.kwargs["@timestamp"]["gte"]
+        scan = MagicMock(aborted=False)
+        scan.execute.return_value = [bucket(START + i * rolling.SLICE, i + 1) for i in range(4) if START + i * rolling.SLICE >= gte]
+        scans.append(gte)
+        return scan
+
+    monkeypatch.setattr(rolling, "ScanAggs", fake_scan)
+    params = make_params()
+
+    df, _ = rolling.rolling_tile_points(tile_s, "idx", 0, 0, 3, params, 11, 100)
+    assert scans == [START]
+    assert df["c"].sum() == 1 + 2 + 3 + 4
+
+    # slices that ended at least five minutes ago have settled, so only the last is queried again
+    df, _ = rolling.rolling_tile_points(tile_s, "idx", 0, 0, 3, params, 11, 100)
+    assert scans[-1] == START + 3 * rolling.SLICE
+    assert df["c"].sum() == 1 + 2 + 3 + 4
+
+    # a longer settle time keeps requerying more of the recent slices
+    monkeypatch.setattr(rolling, "config", replace(rolling.config, rolling_settle_time=timedelta(minutes=15)))
+    df, _ = rolling.rolling_tile_points(tile_s, "idx", 0, 0, 3, params, 11, 100)
+    assert scans[-1] == START + rolling.SLICE
+    assert df["c"].sum() == 1 + 2 + 3 + 4
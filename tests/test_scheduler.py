@@ -0,0 +1,141 @@
+from concurrent.futures import wait
+from threading import Event
+from time import time
+from unittest.mock import patch
+
+import mercantile
+
+from elastic_datashader import scheduler
+
+def test_prefetch_tiles():
+    tiles = scheduler.prefetch_tiles(0, 0, 2)
+
+    # Neighbours wrap around the antimeridian but not the poles
+    assert set(tiles[:5]) == {
+        mercantile.Tile(3, 0, 2), mercantile.Tile(1, 0, 2),
+        mercantile.Tile(3, 1, 2), mercantile.Tile(0, 1, 2), mercantile.Tile(1, 1, 2),
+    }
+    assert tiles[5:] == mercantile.children(0, 0, 2)
+    assert scheduler.prefetch_tiles(0, 0, 0) == mercantile.children(0, 0, 0)
+    assert len(scheduler.prefetch_tiles(0, 0, scheduler.MAX_PREFETCH_ZOOM)) == 5
+
+def test_priority_order():
+    render_scheduler = scheduler.RenderScheduler(1)
+    started = Event()
+    release = Event()
+    ran = []
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    render_scheduler.submit(scheduler.PRIORITY_TILE, block)
+    assert started.wait(5)
+
+    layer = ("foo", "hash")
+    render_scheduler.view(None, layer)
+    prefetch = render_scheduler.submit(scheduler.PRIORITY_PREFETCH, ran.append, "prefetch", key="a", layer=layer)
+    tile = render_scheduler.submit(scheduler.PRIORITY_TILE, ran.append, "tile", key="b")
+
+    # Queuing the same key again shares its render
+    assert render_scheduler.submit(scheduler.PRIORITY_PREFETCH, ran.append, "again", key="a", layer=layer) is prefetch
+    assert render_scheduler.queued() == 2
+
+    release.set()
+    prefetch.result(5)
+    tile.result(5)
+    assert ran == ["tile", "prefetch"]
+
+def test_resubmit_moves_up_queue():
+    render_scheduler = scheduler.RenderScheduler(1)
+    release = Event()
+    ran = []
+
+    render_scheduler.submit(scheduler.PRIORITY_TILE, release.wait, 5)
+    layer = ("foo", "hash")
+    render_scheduler.view(None, layer)
+    first = render_scheduler.submit(scheduler.PRIORITY_PREFETCH, ran.append, "a", key="a", layer=layer)
+    render_scheduler.submit(scheduler.PRIORITY_PREFETCH, ran.append, "b", key="b", layer=layer)
+    render_scheduler.submit(scheduler.PRIORITY_TILE, ran.append, "b", key="b")
+
+    release.set()
+    first.result(5)
+    assert ran == ["b", "a"]
+
+def test_idle_layer_prefetch_dropped():
+    render_scheduler = scheduler.RenderScheduler(1)
+    release = Event()
+    ran = []
+
+    render_scheduler.submit(scheduler.PRIORITY_TILE, release.wait, 5)
+    layer = ("foo", "hash")
+    render_scheduler.view(None, layer)
+    prefetch = render_scheduler.submit(scheduler.PRIORITY_PREFETCH, ran.append, "prefetch", layer=layer)
+    tile = render_scheduler.submit(scheduler.PRIORITY_TILE, ran.append, "tile")
+
+    with patch.object(scheduler, "PREFETCH_IDLE", -1):
+        release.set()
+        tile.result(5)
+        wait([prefetch], 5)
+
+    assert prefetch.cancelled()
+    assert ran == ["tile"]
+
+def test_tile_rank():
+    view = scheduler.View(lon=0.0, lat=0.0, zoom=2)
+
+    assert scheduler.tile_rank(mercantile.Tile(2, 2, 2), view) == 0
+    assert scheduler.tile_rank(mercantile.Tile(0, 2, 2), view) == 2
+    assert scheduler.tile_rank(mercantile.Tile(4, 4, 3), view) == scheduler.ZOOM_RANK
+    assert scheduler.tile_rank(mercantile.Tile(0, 0, 2), None) == 0
+
+def test_users_share_threads():
+    render_scheduler = scheduler.RenderScheduler(1)
+    release = Event()
+    ran = []
+
+    render_scheduler.submit(scheduler.PRIORITY_TILE, release.wait, 5, user="heavy")
+
+    for i in range(3):
+        render_scheduler.submit(scheduler.PRIORITY_TILE, ran.append, f"heavy{i}", user="heavy")
+
+    light = render_scheduler.submit(scheduler.PRIORITY_TILE, ran.append, "light", user="light")
+
+    release.set()
+    light.result(5)
+    assert ran[0] == "light"
+
+def test_closest_to_view_first():
+    render_scheduler = scheduler.RenderScheduler(1)
+    release = Event()
+    ran = []
+    layer = ("foo", "hash")
+
+    render_scheduler.submit(scheduler.PRIORITY_TILE, release.wait, 5)
+    render_scheduler.view("user", layer, {"minLon": -170.0, "minLat": 60.0, "maxLon": -100.0, "maxLat": 80.0}, 2)
+    near = mercantile.Tile(0, 0, 2)
+    far = mercantile.Tile(2, 2, 2)
+    render_scheduler.submit(scheduler.PRIORITY_TILE, ran.append, near, user="user", layer=layer, tile=near)
+    last = render_scheduler.submit(scheduler.PRIORITY_TILE, ran.append, far, user="user", layer=layer, tile=far)
+
+    # Panning re-ranks what is already queued
+    render_scheduler.view("user", layer, {"minLon": 10.0, "minLat": -60.0, "maxLon": 80.0, "maxLat": -10.0}, 2)
+
+    release.set()
+    last.result(5)
+    assert ran == [far, near]
+
+def test_deadline_drops_render():
+    render_scheduler = scheduler.RenderScheduler(1)
+    release = Event()
+
+    render_scheduler.submit(scheduler.PRIORITY_TILE, release.wait, 5)
+    stale = render_scheduler.submit(scheduler.PRIORITY_TILE, print, key="a", deadline=0.0)
+
+    # Queuing it again pushes the deadline back
+    fresh = render_scheduler.submit(scheduler.PRIORITY_TILE, print, key="b", deadline=0.0)
+    render_scheduler.submit(scheduler.PRIORITY_TILE, print, key="b", deadline=time() + 60)
+
+    release.set()
+    fresh.result(5)
+    assert stale.cancelled()
@@ -0,0 +1,139 @@
+from datashader import transfer_functions as tf
+
+import colorcet as cc
+import datashader as ds
+import numpy as np
+import pandas as pd
+import pytest
+
+from elastic_datashader import shading
+
+def make_agg(width=32, height=32, num_points=200, seed=42):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "x": rng.uniform(0, 1, num_points),
+        "y": rng.uniform(0, 1, num_points),
+        "c": rng.integers(1, 5000, num_points).astype(np.float64),
+    })
+
+    return ds.Canvas(
+        plot_width=width,
+        plot_height=height,
+        x_range=(0, 1),
+        y_range=(0, 1),
+    ).points(df, "x", "y", agg=ds.sum("c"))
+
+def datashader_rgba(agg, cmap, span, spread):
+    img = tf.shade(agg, cmap=cc.palette[cmap], how="log", span=span)
+
+    if spread > 0:
+        img = tf.spread(img, spread)
+
+    return np.array(img.to_pil())
+
+@pytest.mark.parametrize(
+    "cmap, span, spread",
+    (
+        ("bmy", [0, 20.0], 0),
+        ("bmy", [0, 20.0], 2),
+        ("fire", [0, 5.0], 1),
+        ("bmy", [0, 0], 0),
+        ("bmy", None, 3),
+    )
+)
+def test_shade_heatmap_matches_datashader(cmap, span, spread):
+    agg = make_agg()
+    expected = datashader_rgba(agg, cmap, span, spread)
+    actual = shading.shade_heatmap(agg.data, cmap, span, spread)
+
+    assert actual.shape == expected.shape
+    assert actual.dtype == np.uint8
+    np.testing.assert_array_equal(actual[:, :, 3], expected[:, :, 3])
+    assert np.abs(actual.astype(int) - expected.astype(int)).max() <= 1
+
+def test_shade_heatmap_empty():
+    data = np.full((8, 8), np.nan)
+    actual = shading.shade_heatmap(data, "bmy", [0, 10], 2)
+    assert actual.shape == (8, 8, 4)
+    assert not actual.any()
+
+def test_circle_mask():
+    assert shading.circle_mask(0).shape == (1, 1)
+    mask = shading.circle_mask(2)
+    assert mask.shape == (5, 5)
+    assert mask[2, 2]
+    assert not mask[0, 0]
+
+def make_category_df(num_points=400, num_categories=6, seed=7):
+    rng = np.random.default_rng(seed)
+    categories = [f"cat{i}" for i in range(num_categories)]
+
+    return pd.DataFrame({
+        "x": rng.uniform(0, 1, num_points),
+        "y": rng.uniform(0, 1, num_points),
+        "c": rng.integers(1, 500, num_points).astype(np.float64),
+        "t": pd.Categorical(rng.choice(categories, num_points), categories=categories),
+    })
+
+@pytest.mark.parametrize(
+    "span, min_alpha, spread",
+    (
+        ([0, 2000.0], 40, 0),
+        ([0, 2000.0], 40, 2),
+        (None, 40, 0),
+        ([100, 300.0], 0, 1),
+    )
+)
+def test_shade_categories_matches_datashader(span, min_alpha, spread):
+    df = make_category_df(num_points=4000)
+    color_key = dict(zip(df["t"].cat.categories, cc.glasbey_light))
+    agg = ds.Canvas(
+        plot_width=32,
+        plot_height=32,
+        x_range=(0, 1),
+        y_range=(0, 1),
+    ).points(df, "x", "y", agg=ds.by("t", ds.sum("c")))
+    img = tf.shade(agg, color_key=color_key, min_alpha=min_alpha, how="log", span=span)
+
+    if spread > 0:
+        img = tf.spread(img, spread)
+
+    expected = np.array(img.to_pil())
+    actual = shading.shade_categories(
+        df,
+        shading.category_colors(df["t"].cat.categories, color_key),
+        (0, 1),
+        (0, 1),
+        32,
+        32,
+        span,
+        min_alpha,
+        spread,
+        top_k=len(color_key),
+    )
+
+    assert actual.shape == expected.shape
+    np.testing.assert_array_equal(actual[:, :, 3], expected[:, :, 3])
+    assert np.abs(actual.astype(int) - expected.astype(int)).max() <= 1
+
+def test_shade_categories_top_k():
+    df = pd.DataFrame({
+        "x": [0.5, 0.5, 0.5],
+        "y": [0.5, 0.5, 0.5],
+        "c": [10.0, 1.0, 5.0],
+        "t": pd.Categorical(["a", "b", "c"]),
+    })
+    colors = np.array([[255, 0, 0], [0, 255, 0], [0, 0, 255]], dtype=np.float64)
+    actual = shading.shade_categories(df, colors, (0, 1), (0, 1), 2, 2, [0, 16.0], 40, top_k=2)
+
+    # The lightest category is evicted from the colour but still counts towards alpha
+    # and the remaining colours are weighted above the lightest kept count, as in datashader
+    np.testing.assert_array_equal(actual[0, 1], [255, 0, 0, 255])
+    assert not actual[1, :].any()
+
+def test_shade_categories_empty():
+    df = make_category_df(num_points=10)
+    colors = shading.category_colors(df["t"].cat.categories, dict.fromkeys(df["t"].cat.categories, "#ff0000"))
+    actual = shading.shade_categories(df, colors, (10, 11), (10, 11), 8, 8, None, 40)
+    assert actual.shape == (8, 8, 4)
+    assert not actual.any()
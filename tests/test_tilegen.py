@@ -1,9 +1,16 @@
+from dataclasses import replace
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+
 import pytest
 
 from geopy.distance import distance
 from mercantile import tile
 
+import pandas as pd
+
 from elastic_datashader import tilegen
+from elastic_datashader.parameters import create_default_params
 
 @pytest.mark.parametrize(
     "lon, lat, zoom, search_meters",
@@ -28,3 +35,27 @@ def test_create_bounding_box_for_ellipses(lon, lat, zoom, search_meters):
     bb_top_right = (bb_dict["top_left"]["lat"], bb_dict["bottom_right"]["lon"])
     actual_bb_top_meters = distance(bb_top_left, bb_top_right).m
     assert actual_bb_top_meters > 2 * search_meters
+
+def test_generate_tile_counts_rolling_slices(monkeypatch):
+    tile_query = MagicMock()
+    monkeypatch.setattr(tilegen.TileQuery, "from_params", MagicMock(return_value=tile_query))
+    monkeypatch.setattr(tilegen, "config", replace(tilegen.config, rolling_windows=True))
+    points = pd.DataFrame({"x": [0.0, 1000.0], "y": [0.0, 1000.0], "c": [3.0, 4.0]})
+    scan = MagicMock(total_took=1, num_searches=1, aborted=False, total_shards=1, total_skipped=0, total_successful=1, total_failed=0)
+    monkeypatch.setattr(tilegen, "rolling_tile_points", MagicMock(return_value=(points, scan)))
+
+    params = {
+        **create_default_params(),
+        "geopoint_field": "location",
+        "time_relative": True,
+        "start_time": datetime(2024, 3, 1, 11, 0, tzinfo=timezone.utc),
+        "stop_time": datetime(2024, 3, 1, 11, 20, tzinfo=timezone.utc),
+        "cmap": "bmy",
+        "span_range": "auto",
+        "tile_format": "png",
+    }
+    _, metrics = tilegen.generate_tile("idx", 0, 0, 1, {}, params)
+
+    # The rolling window's document count comes from its slices rather than a count query
+    tile_query.count.assert_not_called()
+    assert metrics["doc_cnt"] == 7
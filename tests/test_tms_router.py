@@ -1,8 +1,22 @@
+from dataclasses import replace
+from threading import Barrier
+from datetime import datetime, timedelta, timezone
+from time import sleep, time
+from unittest.mock import MagicMock
+
+import json
+import os
+
 import pytest
 
+from prometheus_client import REGISTRY
 from starlette.datastructures import URL
 
-from elastic_datashader.routers.tms import get_next_wait, make_next_wait_url
+from elastic_datashader.cache import tile_name
+from elastic_datashader.cache_backends import FilesystemTileCache
+from elastic_datashader.config import config
+from elastic_datashader.routers import tms
+from elastic_datashader.routers.tms import get_next_wait, make_image_response, make_next_wait_url
 
 def test_get_next_wait():
     assert get_next_wait(0) == 2
@@ -27,3 +41,343 @@ def test_get_next_wait():
 )
 def test_make_next_wait_url(idx, x, y, z, first_wait, next_wait, expected_url):
     assert make_next_wait_url(idx, x, y, z, first_wait, next_wait) == expected_url
+
+def test_make_image_response_stale_while_revalidate():
+    response = make_image_response(b"img", "user", "somehash", 3600)
+    assert response.headers["Cache-Control"] == "max-age=3600"
+
+    response = make_image_response(b"img", "user", "somehash", 0, stale_while_revalidate=60)
+    assert response.headers["Cache-Control"] == "max-age=0, stale-while-revalidate=60"
+
+def test_cached_response_stale(tmp_path, monkeypatch):
+    store = FilesystemTileCache(tmp_path)
+    monkeypatch.setattr(tms, "tile_cache", store)
+    es = MagicMock()
+    render_scheduler = MagicMock()
+    monkeypatch.setattr(tms, "render_scheduler", render_scheduler)
+    params = {"user": "someuser", "tile_format": "png"}
+
+    assert tms.cached_response(es, "foo", 1, 2, 3, params, "somehash") is None
+
+    store.put("foo", 1, 2, 3, "somehash", b"img")
+    tile_path = tmp_path / tile_name("foo", 1, 2, 3, "somehash")
+    response = tms.cached_response(es, "foo", 1, 2, 3, params, "somehash", None, refresh=True)
+    assert response.body == b"img"
+    assert not render_scheduler.submit.called
+
+    # expired, but within the grace period, so it is served while a refresh is scheduled
+    expired = time() - config.cache_timeout.total_seconds() - 1
+    os.utime(tile_path, (expired, expired))
+    response = tms.cached_response(es, "foo", 1, 2, 3, params, "somehash", None, refresh=True)
+    assert response.body == b"img"
+    assert response.headers["Cache-Control"].startswith("max-age=0, stale-while-revalidate=")
+    # Refreshes queue behind renders requests are waiting on
+    render_scheduler.submit.assert_called_once()
+    assert render_scheduler.submit.call_args.args[0] == tms.PRIORITY_PREFETCH
+    assert render_scheduler.submit.call_args.kwargs["key"] == tile_name("foo", 1, 2, 3, "somehash")
+
+    # past the grace period it's a miss
+    expired -= config.cache_stale_grace.total_seconds()
+    os.utime(tile_path, (expired, expired))
+    assert tms.cached_response(es, "foo", 1, 2, 3, params, "somehash", None, refresh=True) is None
+
+def test_generate_tile_to_cache_keeps_historical_tiles(tmp_path, monkeypatch):
+    store = FilesystemTileCache(tmp_path)
+    monkeypatch.setattr(tms, "tile_cache", store)
+    store.put("foo", 1, 2, 3, "somehash", b"img")
+    expired = time() - config.cache_timeout.total_seconds() - 1
+    os.utime(tmp_path / tile_name("foo", 1, 2, 3, "somehash"), (expired, expired))
+    claim = MagicMock(return_value=False)
+    monkeypatch.setattr(store, "claim", claim)
+
+    # A closed window's tile outlives the cache timeout, so it isn't rendered again
+    params = {"user": None, "time_relative": False, "stop_time": datetime(2024, 1, 2, tzinfo=timezone.utc)}
+    assert tms.generate_tile_to_cache("foo", 1, 2, 3, params, "somehash", MagicMock()) is None
+    claim.assert_not_called()
+
+    tms.generate_tile_to_cache("foo", 1, 2, 3, {"user": None}, "somehash", MagicMock())
+    claim.assert_called_once()
+
+def test_error_tile_response_format():
+    response = tms.error_tile_response(ValueError("bad"))
+    assert response.headers["Content-Type"] == "image/png"
+    assert response.body.startswith(b"\x89PNG")
+
+    response = tms.error_tile_response(ValueError("bad"), "webp")
+    assert response.headers["Content-Type"] == "image/webp"
+    assert response.body[8:12] == b"WEBP"
+    assert response.headers["Error"] == "bad"
+
+def test_get_tms_error_tile_format(monkeypatch):
+    from fastapi import FastAPI  # pylint: disable=C0415
+    from fastapi.testclient import TestClient  # pylint: disable=C0415
+
+    monkeypatch.setattr(tms, "Elasticsearch", MagicMock())
+    monkeypatch.setattr(tms, "create_datashader_tiles_entry", MagicMock())
+    app = FastAPI()
+    app.include_router(tms.router)
+
+    # Invalid parameters are answered with an X tile in the requested format
+    response = TestClient(app).get("/tms/foo/1/0/0.png?tile_format=webp&params=notjson")
+    assert response.headers["Content-Type"] == "image/webp"
+    assert "Error" in response.headers
+
+    response = TestClient(app).get("/tms/foo/1/0/0.png?tile_format=gif")
+    assert response.headers["Content-Type"] == "image/png"
+
+def test_make_image_response_immutable():
+    response = make_image_response(b"img", "user", "somehash", 604800, stale_while_revalidate=60, immutable=True)
+    assert response.headers["Cache-Control"] == "max-age=604800, immutable"
+
+def test_post_viewport(tmp_path, monkeypatch):
+    from fastapi import FastAPI  # pylint: disable=C0415
+    from fastapi.testclient import TestClient  # pylint: disable=C0415
+
+    store = FilesystemTileCache(tmp_path)
+    monkeypatch.setattr(tms, "tile_cache", store)
+    monkeypatch.setattr(tms, "viewport_eligible", lambda params: False)
+    rendered = []
+    # Each tile renders on its own thread, so neither finishes until both have started
+    barrier = Barrier(2, timeout=5)
+
+    def render(idx, x, y, z, params, parameter_hash, request, prefetched=None):  # pylint: disable=W0613
+        rendered.append((x, y, z))
+        barrier.wait()
+        store.put(idx, x, y, z, parameter_hash, b"img")
+
+    monkeypatch.setattr(tms, "generate_tile_to_cache", render)
+    app = FastAPI()
+    app.include_router(tms.router)
+    payload = {
+        "geopoint_field": "location",
+        "params": {
+            "zoom": 1,
+            "extent": {"minLon": -10.0, "minLat": 5.0, "maxLon": 10.0, "maxLat": 10.0},
+            "timeFilters": {"from": "2024-01-01T00:00:00Z", "to": "2024-01-02T00:00:00Z"},
+        },
+    }
+
+    response = TestClient(app).post("/tms/foo/viewport", json=payload)
+    assert response.status_code == 200
+    body = response.json()
+    assert [tile["url"] for tile in body["tiles"]] == ["1/0/0.png", "1/1/0.png"]
+    assert all(tile["cached"] for tile in body["tiles"])
+    assert len(rendered) == 2
+
+    # Tiles already cached aren't rendered again
+    TestClient(app).post("/tms/foo/viewport", json=payload)
+    assert len(rendered) == 2
+
+    payload["params"] = {"zoom": 1}
+    assert TestClient(app).post("/tms/foo/viewport", json=payload).status_code == 400
+
+def test_prefetch_viewport_points_skips_density_layers(monkeypatch):
+    prefetch_viewport = MagicMock(return_value={"tile": "points"})
+    monkeypatch.setattr(tms, "prefetch_viewport", prefetch_viewport)
+    params = {"geofield_type": "geo_point", "generated_params": {}}
+    monkeypatch.setattr(tms, "merge_generated_parameters", lambda headers, params, idx: params)
+    assert tms.prefetch_viewport_points("foo", ["tile"], params, MagicMock()) == {"tile": "points"}
+
+    # Tiles of layers with a density pyramid each pick their own precision
+    density = {"generated_params": {"density": {"precision": 8, "cells": ""}}}
+    monkeypatch.setattr(tms, "merge_generated_parameters", lambda headers, params, idx: {**params, **density})
+    assert tms.prefetch_viewport_points("foo", ["tile"], params, MagicMock()) == {}
+    prefetch_viewport.assert_called_once()
+
+def test_get_tms_waits_for_render(tmp_path, monkeypatch):
+    from fastapi import FastAPI  # pylint: disable=C0415
+    from fastapi.testclient import TestClient  # pylint: disable=C0415
+
+    store = FilesystemTileCache(tmp_path)
+    monkeypatch.setattr(tms, "tile_cache", store)
+    monkeypatch.setattr(tms, "Elasticsearch", MagicMock())
+    renders = []
+
+    def render(idx, x, y, z, params, parameter_hash, request, prefetched=None):  # pylint: disable=W0613
+        renders.append((x, y, z))
+        store.put(idx, x, y, z, parameter_hash, b"img")
+        return {"count": 0.25, "aggregation_page": 0.5, "encode": 0.125}
+
+    monkeypatch.setattr(tms, "generate_tile_to_cache", render)
+    app = FastAPI()
+    app.include_router(tms.router)
+    url = "/tms/foo/1/0/0.png?geopoint_field=location&params=" + json.dumps(
+        {"timeFilters": {"from": "2024-01-01T00:00:00Z", "to": "2024-01-02T00:00:00Z"}}
+    )
+
+    # The tile is returned once it renders rather than redirecting
+    response = TestClient(app).get(url, follow_redirects=False)
+    assert response.status_code == 200
+    assert response.content == b"img"
+    assert renders == [(0, 0, 1)]
+    # The render's stages are timed along with reading it from the cache
+    assert response.headers["Server-Timing"].startswith("es;dur=750.0, encode;dur=125.0, cache;dur=")
+
+def test_get_tms_redirects_without_wait(tmp_path, monkeypatch):
+    from fastapi import FastAPI  # pylint: disable=C0415
+    from fastapi.testclient import TestClient  # pylint: disable=C0415
+
+    monkeypatch.setattr(tms, "tile_cache", FilesystemTileCache(tmp_path))
+    monkeypatch.setattr(tms, "Elasticsearch", MagicMock())
+    monkeypatch.setattr(tms, "generate_tile_to_cache", MagicMock())
+    monkeypatch.setattr(tms, "config", replace(config, tile_wait=timedelta(0)))
+    app = FastAPI()
+    app.include_router(tms.router)
+    url = "/tms/foo/1/0/0.png?geopoint_field=location&params=" + json.dumps(
+        {"timeFilters": {"from": "2024-01-01T00:00:00Z", "to": "2024-01-02T00:00:00Z"}}
+    )
+
+    redirects = REGISTRY.get_sample_value("datashader_redirects_total")
+    misses = REGISTRY.get_sample_value("datashader_cache_misses_total")
+
+    response = TestClient(app).get(url, follow_redirects=False)
+    assert response.status_code == 307
+    assert REGISTRY.get_sample_value("datashader_redirects_total") == redirects + 1
+    assert REGISTRY.get_sample_value("datashader_cache_misses_total") == misses + 1
+
+def test_get_viewport_events(tmp_path, monkeypatch):
+    from fastapi import FastAPI  # pylint: disable=C0415
+    from fastapi.testclient import TestClient  # pylint: disable=C0415
+
+    store = FilesystemTileCache(tmp_path)
+    monkeypatch.setattr(tms, "tile_cache", store)
+    monkeypatch.setattr(tms, "viewport_eligible", lambda params: False)
+
+    def render(idx, x, y, z, params, parameter_hash, request, prefetched=None):  # pylint: disable=W0613
+        if x == 1:
+            raise RuntimeError("render failed")
+        store.put(idx, x, y, z, parameter_hash, b"img")
+
+    monkeypatch.setattr(tms, "generate_tile_to_cache", render)
+    app = FastAPI()
+    app.include_router(tms.router)
+    url = "/tms/foo/viewport/events?geopoint_field=location&params=" + json.dumps({
+        "zoom": 1,
+        "extent": {"minLon": -10.0, "minLat": 5.0, "maxLon": 10.0, "maxLat": 10.0},
+        "timeFilters": {"from": "2024-01-01T00:00:00Z", "to": "2024-01-02T00:00:00Z"},
+    })
+
+    response = TestClient(app).get(url)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [
+        (event.split("\n")[0][len("event: "):], json.loads(event.split("\n")[1][len("data: "):]))
+        for event in response.text.strip().split("\n\n")
+    ]
+    parameter_hash = events[0][1]["hash"]
+    assert events[0] == ("viewport", {"hash": parameter_hash, "tiles": 2})
+    assert ("ready", {"x": 0, "y": 0, "z": 1, "url": "1/0/0.png"}) in events
+    assert ("failed", {"x": 1, "y": 0, "z": 1, "url": "1/1/0.png"}) in events
+    assert events[-1] == ("done", {"ready": 1, "failed": 1})
+
+    # Cached tiles are ready straight away
+    events = TestClient(app).get(url + f"&hash={parameter_hash}").text
+    assert "event: ready" in events
+
+    assert TestClient(app).get(url + "&hash=other").status_code == 400
+
+def test_schedule_prefetch(tmp_path, monkeypatch):
+    store = FilesystemTileCache(tmp_path)
+    store.put("foo", 1, 0, 2, "hash", b"img")
+    monkeypatch.setattr(tms, "tile_cache", store)
+    render_scheduler = MagicMock()
+    monkeypatch.setattr(tms, "render_scheduler", render_scheduler)
+
+    # The request only queues the lookups, which run on a render thread
+    tms.schedule_prefetch("foo", 0, 0, 2, {}, "hash", MagicMock())
+    render_scheduler.submit.assert_called_once()
+    check = render_scheduler.submit.call_args
+    assert check.args[:2] == (tms.PRIORITY_PREFETCH, tms.queue_prefetch_renders)
+    assert check.kwargs["key"] == ("prefetch", tile_name("foo", 0, 0, 2, "hash"))
+    render_scheduler.reset_mock()
+
+    check.args[1](*check.args[2:])
+
+    prefetched = {call.args[3:6] for call in render_scheduler.submit.call_args_list}
+    assert (1, 0, 2) not in prefetched
+    assert (3, 0, 2) in prefetched
+    assert (0, 0, 3) in prefetched
+    assert all(call.args[0] == tms.PRIORITY_PREFETCH for call in render_scheduler.submit.call_args_list)
+    assert all(call.kwargs["layer"] == ("foo", "hash") for call in render_scheduler.submit.call_args_list)
+
+def test_get_tms_profile(tmp_path, monkeypatch):
+    from fastapi import FastAPI  # pylint: disable=C0415
+    from fastapi.testclient import TestClient  # pylint: disable=C0415
+
+    store = FilesystemTileCache(tmp_path)
+    monkeypatch.setattr(tms, "tile_cache", store)
+    monkeypatch.setattr(tms, "Elasticsearch", MagicMock())
+    monkeypatch.setattr(tms, "merge_generated_parameters", lambda headers, params, idx: params)
+    entries = []
+    monkeypatch.setattr(tms, "create_datashader_tiles_entry", lambda es, **info: entries.append(info))
+
+    def generate_tile(idx, x, y, z, headers, params, prefetched=None, stages=None):  # pylint: disable=W0613
+        with stages("shading"):
+            sleep(0.05)
+        return b"profiled", {}
+
+    monkeypatch.setattr(tms, "generate_tile", generate_tile)
+    app = FastAPI()
+    app.include_router(tms.router)
+    url = "/tms/foo/1/0/0.png?profile=true&geopoint_field=location&params=" + json.dumps(
+        {"timeFilters": {"from": "2024-01-01T00:00:00Z", "to": "2024-01-02T00:00:00Z"}}
+    )
+
+    # Without a proxy key the tile is rendered into the cache as usual
+    monkeypatch.setattr(tms, "generate_tile_to_cache", MagicMock())
+    monkeypatch.setattr(tms, "config", replace(config, tile_wait=timedelta(0)))
+    assert TestClient(app).get(url, follow_redirects=False).status_code == 307
+    assert not entries
+
+    monkeypatch.setattr(tms, "config", replace(config, tms_key="secret"))
+    assert TestClient(app).get(url, follow_redirects=False).status_code == 403
+
+    response = TestClient(app).get(url, headers={"tms-proxy-key": "secret"}, follow_redirects=False)
+    assert response.status_code == 200
+    assert response.content == b"profiled"
+    assert response.headers["Cache-Control"] == "max-age=0"
+    assert response.headers["Server-Timing"].startswith("es;dur=")
+    assert "shade;dur=" in response.headers["Server-Timing"]
+
+    # The profile is saved beside the tile's entry, and the tile isn't cached
+    assert entries[0]["_id"].endswith("-profile")
+    assert "generate_tile (test_tms_router.py:" in entries[0]["profile"]
+    assert not store.exists("foo", 0, 0, 1, entries[0]["hash"])
+
+def test_wait_for_tile_outlasts_unclaimed_renders(tmp_path, monkeypatch):
+    import asyncio  # pylint: disable=C0415
+    import threading  # pylint: disable=C0415
+    from elastic_datashader.waiters import TileWaiters  # pylint: disable=C0415
+
+    store = FilesystemTileCache(tmp_path)
+    monkeypatch.setattr(tms, "tile_cache", store)
+    waiters = TileWaiters()
+    name = tile_name("foo", 0, 0, 1, "hash")
+    request = MagicMock()
+
+    async def is_disconnected():
+        return False
+
+    request.is_disconnected = is_disconnected
+    assert store.claim("foo", 0, 0, 1, "hash")
+
+    def renders():
+        # A duplicate render that couldn't claim the tile finishes first
+        waiters.notify(name)
+        sleep(0.2)
+        store.put("foo", 0, 0, 1, "hash", b"img")
+        store.release("foo", 0, 0, 1, "hash")
+        waiters.notify(name)
+
+    es = MagicMock()
+
+    async def wait():
+        with waiters.waiting(name) as waiter:
+            threading.Thread(target=renders).start()
+            return await tms.wait_for_tile(es, "foo", 0, 0, 1, {"tile_format": "png"}, "hash", request, waiter, 5)
+
+    response = asyncio.run(wait())
+    assert response is not None
+    assert response.body == b"img"
+    # The tile was just rendered, so it isn't counted as a cache hit
+    es.update.assert_not_called()
@@ -0,0 +1,62 @@
+from unittest.mock import MagicMock
+
+import mercantile
+import pytest
+
+from elastic_datashader import viewport
+
+def test_viewport_tiles():
+    extent = {"minLon": -10.0, "minLat": -10.0, "maxLon": 10.0, "maxLat": 10.0}
+    assert viewport.viewport_tiles(extent, 1) == [mercantile.Tile(0, 0, 1), mercantile.Tile(0, 1, 1), mercantile.Tile(1, 0, 1), mercantile.Tile(1, 1, 1)]
+
+    with pytest.raises(ValueError):
+        viewport.viewport_tiles(None, 1)
+
+    with pytest.raises(ValueError):
+        viewport.viewport_tiles({"minLon": -180.0, "minLat": -85.0, "maxLon": 180.0, "maxLat": 85.0}, 10)
+
+def test_viewport_eligible():
+    params = {"geofield_type": "geo_point", "render_mode": "points", "category_field": None, "bucket_min": 0, "bucket_max": 1}
+    assert viewport.viewport_eligible(params)
+    assert not viewport.viewport_eligible({**params, "category_field": "foo"})
+    assert not viewport.viewport_eligible({**params, "render_mode": "ellipses"})
+    assert not viewport.viewport_eligible({**params, "geofield_type": "geo_shape"})
+    assert not viewport.viewport_eligible({**params, "bucket_min": 0.5})
+    assert not viewport.viewport_eligible({**params, "generated_params": {"density": {"precision": 8, "cells": ""}}})
+    assert viewport.viewport_eligible({**params, "generated_params": {"density": None}})
+
+def test_prefetch_viewport(monkeypatch):
+    tile_query = MagicMock()
+    tile_query.search.return_value = {
+        "took": 1,
+        "_shards": {"total": 1, "skipped": 0, "successful": 1, "failed": 0},
+        "aggregations": {"comp": {"buckets": [
+            {"key": {"grids": "9/0/0"}, "doc_count": 3},
+            {"key": {"grids": "9/255/1"}, "doc_count": 4},
+            {"key": {"grids": "9/256/0"}, "doc_count": 5},
+        ]}},
+    }
+    tile_query.search.side_effect = [tile_query.search.return_value, {**tile_query.search.return_value, "aggregations": {"comp": {"buckets": []}}}]
+    monkeypatch.setattr(viewport.TileQuery, "from_params", MagicMock(return_value=tile_query))
+
+    params = {"geopoint_field": "location", "max_bins": 10000, "resolution": "finest", "use_centroid": False}
+    tiles = [mercantile.Tile(0, 0, 1), mercantile.Tile(1, 0, 1), mercantile.Tile(1, 1, 1)]
+    prefetched = viewport.prefetch_viewport({}, params, "foo", tiles)
+
+    assert sorted(prefetched[mercantile.Tile(0, 0, 1)][0]["c"]) == [3, 4]
+    assert list(prefetched[mercantile.Tile(1, 0, 1)][0]["c"]) == [5]
+    assert prefetched[mercantile.Tile(1, 1, 1)][0].empty
+    assert prefetched[mercantile.Tile(0, 0, 1)][2] == 7
+
+    # One aggregation at the tiles' precision covers the whole viewport
+    body = tile_query.search.call_args_list[0].args[0]
+    assert body["aggs"]["comp"]["composite"]["sources"] == [{"grids": {"geotile_grid": {"field": "location", "precision": 9}}}]
+    tile_query.tile_query.assert_called_once()
+    assert prefetched[mercantile.Tile(0, 0, 1)][1].num_searches == 2
+
+    # Tiles keep only their densest max_bins cells, but count all their documents
+    tile_query.search.side_effect = [tile_query.search.return_value, {**tile_query.search.return_value, "aggregations": {"comp": {"buckets": []}}}]
+    tile_query.reset_mock()
+    prefetched = viewport.prefetch_viewport({}, {**params, "max_bins": 1}, "foo", tiles)
+    assert list(prefetched[mercantile.Tile(0, 0, 1)][0]["c"]) == [4]
+    assert prefetched[mercantile.Tile(0, 0, 1)][2] == 7
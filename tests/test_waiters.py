@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+from elastic_datashader.waiters import TileWaiters
+
+def test_notify_wakes_waiter():
+    waiters = TileWaiters()
+
+    async def wait_and_notify():
+        with waiters.waiting("a", "b") as waiter:
+            # Notify from another thread, as renders do
+            threading.Thread(target=waiters.notify, args=("b",)).start()
+            assert await waiter.wait(5)
+            assert waiter.notified == {"b"}
+
+            # Each wait waits for the next render
+            assert not await waiter.wait(0.01)
+
+    asyncio.run(wait_and_notify())
+    assert not waiters._waiters  # pylint: disable=W0212
+
+def test_notify_passes_stage_seconds():
+    waiters = TileWaiters()
+
+    async def wait_and_notify():
+        with waiters.waiting("tile") as waiter:
+            threading.Thread(target=waiters.notify, args=("tile", {"encode": 0.5})).start()
+            assert await waiter.wait(5)
+            return waiter.stage_seconds
+
+    assert asyncio.run(wait_and_notify()) == {"tile": {"encode": 0.5}}
+
+def test_wait_times_out():
+    waiters = TileWaiters()
+
+    async def wait():
+        with waiters.waiting("tile") as waiter:
+            return await waiter.wait(0.01)
+
+    assert not asyncio.run(wait())
+    assert not waiters._waiters  # pylint: disable=W0212
+
+    # Notifying with nothing waiting does nothing
+    waiters.notify("tile")
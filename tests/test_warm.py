@@ -0,0 +1,103 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+import mercantile
+import pytest
+
+from elastic_datashader import warm
+from tests.test_density import make_pyramid
+
+def test_geojson_bboxes():
+    geojson = {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [1.0, 2.0]}},
+            {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [10, 0], [10, 5], [0, 0]]]}},
+            {"type": "Feature", "geometry": None},
+        ],
+    }
+
+    assert warm.geojson_bboxes(geojson) == [(1.0, 2.0, 1.0, 2.0), (0, 0, 10, 5)]
+
+def test_enumerate_tiles():
+    assert list(warm.enumerate_tiles([warm.WORLD], 0, 0)) == [mercantile.Tile(0, 0, 0)]
+    assert len(list(warm.enumerate_tiles([warm.WORLD], 1, 2))) == 4 + 16
+
+    # Overlapping areas share tiles
+    tiles = list(warm.enumerate_tiles([(1.0, 1.0, 2.0, 2.0), (1.5, 1.5, 3.0, 3.0)], 1, 1))
+    assert tiles == [mercantile.Tile(1, 0, 1)]
+
+    # Areas outside the data are skipped
+    assert not list(warm.enumerate_tiles([(1.0, 1.0, 2.0, 2.0)], 1, 1, data_bounds=(-10.0, -10.0, -5.0, -5.0)))
+
+    # Data bounds may cross the antimeridian
+    tiles = list(warm.enumerate_tiles([warm.WORLD], 2, 2, data_bounds=(170.0, 10.0, -170.0, 20.0)))
+    assert tiles == [mercantile.Tile(3, 1, 2), mercantile.Tile(0, 1, 2)]
+
+def test_intersect_bbox():
+    assert warm.intersect_bbox((0.0, 0.0, 10.0, 10.0), (5.0, 5.0, 20.0, 20.0)) == [(5.0, 5.0, 10.0, 10.0)]
+    assert not warm.intersect_bbox((0.0, 0.0, 10.0, 10.0), (20.0, 20.0, 30.0, 30.0))
+    assert warm.intersect_bbox((-180.0, 0.0, 180.0, 10.0), (170.0, 0.0, -170.0, 10.0)) == [
+        (170.0, 0.0, 180.0, 10.0),
+        (-180.0, 0.0, -170.0, 10.0),
+    ]
+    assert warm.intersect_bbox((175.0, 0.0, -175.0, 10.0), (170.0, 0.0, -170.0, 10.0)) == [
+        (175.0, 0.0, 180.0, 10.0),
+        (-180.0, 0.0, -175.0, 10.0),
+    ]
+
+def test_enumerate_tiles_skips_empty():
+    tiles = list(warm.enumerate_tiles([warm.WORLD], 1, 1, density=make_pyramid()))
+    assert tiles == [mercantile.Tile(0, 0, 1), mercantile.Tile(1, 1, 1)]
+
+def test_warm_tiles_checkpoint(tmp_path):
+    tiles = list(warm.enumerate_tiles([warm.WORLD], 1, 1))
+    checkpoint = warm.Checkpoint(tmp_path / "checkpoint", "idx hash")
+
+    stats = warm.warm_tiles(tiles, lambda tile: tile.x == 0, 2, checkpoint)
+    checkpoint.close()
+    assert (stats.warmed, stats.failed, stats.skipped) == (2, 2, 0)
+    assert len(stats.latencies) == 4
+
+    # Resuming only retries the failed tiles
+    checkpoint = warm.Checkpoint(tmp_path / "checkpoint", "idx hash")
+    retried = []
+    stats = warm.warm_tiles(tiles, lambda tile: retried.append(tile) or True, 2, checkpoint)
+    checkpoint.close()
+    assert (stats.warmed, stats.failed, stats.skipped) == (2, 0, 2)
+    assert sorted(retried) == [mercantile.Tile(1, 0, 1), mercantile.Tile(1, 1, 1)]
+    assert "Warmed 2 tiles" in stats.summary()
+
+    # Another layer's checkpoint isn't reused
+    with pytest.raises(ValueError):
+        warm.Checkpoint(tmp_path / "checkpoint", "idx other-hash")
+
+class RedirectingHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=C0103
+        if self.path.startswith("/tms/idx/"):
+            self.send_response(307)
+            self.send_header("Location", "/tms/2/idx" + self.path[len("/tms/idx"):])
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+        elif self.path.startswith("/tms/2/idx/1/1/2.png?params="):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.end_headers()
+            self.wfile.write(b"img")
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+def test_fetch_tile_follows_retry_after():
+    server = HTTPServer(("127.0.0.1", 0), RedirectingHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        base_url = f"http://127.0.0.1:{server.server_port}/tms/idx"
+        assert warm.fetch_tile(base_url, "params=%7B%7D", mercantile.Tile(1, 2, 1), 10)
+        assert not warm.fetch_tile(f"http://127.0.0.1:{server.server_port}/missing", "", mercantile.Tile(1, 2, 3), 10)
+    finally:
+        server.shutdown()